@@ -0,0 +1 @@
+default_app_config = 'cms_templates.apps.CmsTemplatesConfig'
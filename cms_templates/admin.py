@@ -1,46 +1,88 @@
 from django.contrib.sites.models import Site
-from django.contrib.admin.widgets import FilteredSelectMultiple
-from django.core.exceptions import ValidationError, ImproperlyConfigured
+from django.contrib.admin import SimpleListFilter
+from django.core.exceptions import ValidationError, PermissionDenied
 from django.core.urlresolvers import reverse
 from django.conf import settings
-from django.template import Engine
+from django.db import DEFAULT_DB_ALIAS
 from django.db.models import Q, Count
 from django.forms import ModelMultipleChoiceField
 from django.template import (Template as _Template, TemplateSyntaxError)
 from django.template.base import TemplateDoesNotExist
-from django.db.models import Q, Count, fields
-from django.http.response import HttpResponseRedirect
-from cms.models import Page
-from cms.plugin_pool import plugin_pool
+from django.http.response import (HttpResponseRedirect, JsonResponse,
+                                  HttpResponseNotAllowed)
+from django.http import Http404
+from django.contrib.admin.utils import unquote
+from django.core.paginator import Paginator, PageNotAnInteger, EmptyPage
+from django.utils.encoding import force_text
+from django.utils.translation import get_language
+from cms.models import Page, Title
 from dbtemplates.models import Template
 from cms_templates import settings as cms_templates_settings
-from cms_templates.template_analyzer import get_all_templates_used
+from cms_templates.template_analyzer import (get_all_templates_used,
+    DBTemplateSource, _chunks, _QUERY_CHUNK_SIZE, get_validation_engine)
+from cms_templates.dependencies import get_dependent_names
+from cms_templates.impact import get_template_change_impact
+from cms_templates.inheritance import (filter_pages_using,
+                                       get_effective_templates)
+from cms_templates.models import TemplateMetadata, get_content_digest
+from cms_templates.routing import get_read_alias
+from cms_templates.search import search_templates
 from cms_templates.recursive_validator import handle_recursive_calls, \
     InfiniteRecursivityError, format_recursive_msg
 from admin_extend.extend import registered_form, registered_modeladmin, \
     extend_registered, add_bidirectional_m2m
-from functools import wraps
+from cms_templates.dependency_graph import TemplateDependencyGraph
+from cms_templates.profiling import profiled
+from cms_templates.singleflight import SingleFlight
+from cms_templates.widgets import TemplatePickerWidget
+from cms_templates.plugins import (get_plugin_templates_from_site,
+    get_plugin_templates_from_sites, get_pages_for_plugins_templates)
 from collections import defaultdict
+from itertools import chain
 
 
-def with_template_debug_on(clean_func):
+_validation_flight = SingleFlight(
+    'cms_templates:validation',
+    timeout=cms_templates_settings.validation_lock_timeout)
 
-    @wraps(clean_func)
-    def wrapper(*args, **kwargs):
-        engine = Engine.get_default()
-        initial_setting = engine.debug
-        try:
-            engine.debug = True
-            return clean_func(*args, **kwargs)
-        finally:
-            engine.debug = initial_setting
 
-    return wrapper
+def _get_template_source():
+    """
+    Returns the source used to resolve the templates found while analyzing
+    a template: the content stored in dbtemplates when static analysis is
+    enabled, otherwise the loader chain (None).
+    """
+    if cms_templates_settings.static_analysis:
+        return DBTemplateSource()
+    return None
 
 
 def _format_pages(page_qs):
-    return ', '.join(['%s(%d)' % (page.get_title() or '', page.id)
-                      for page in page_qs])
+    """
+    Formats the pages from `page_qs` as `title(id)` for error messages.
+    At most DBTEMPLATES_ERROR_PAGES_LIMIT pages are listed, followed by
+    the number of pages left out.
+    """
+    limit = cms_templates_settings.error_pages_limit
+    page_ids = list(page_qs.order_by('id').values_list('id', flat=True)[:limit])
+    titles = _get_page_titles(page_ids)
+    formatted = ', '.join(['%s(%d)' % (titles.get(page_id) or '', page_id)
+                           for page_id in page_ids])
+    if len(page_ids) == limit:
+        more = page_qs.count() - limit
+        if more > 0:
+            formatted += ' +%d more' % more
+    return formatted
+
+def _describe_template_form(form):
+    sites = (form.cleaned_data or {}).get('sites') or []
+    return 'template_%s-sites_%s' % (
+        form.instance.pk, '_'.join(str(site.pk) for site in sites))
+
+
+def _describe_site_form(form):
+    return 'site_%s' % form.instance.pk
+
 
 class ExtendedTemplateAdminForm(registered_form(Template)):
 
@@ -103,19 +145,44 @@ class ExtendedTemplateAdminForm(registered_form(Template)):
     def _error_msg(self, msg_key, *args):
         return self.custom_error_messages[msg_key].format(*args)
 
-    def _handle_sites_not_assigned(self, template, required_sites):
+    def _get_assigned_sites(self, template_names):
         """
-            Checks whether a template B that is used by template A
-        has the sites from template A assigned.
+        Returns the domains of the sites assigned to each of the existing
+        templates from `template_names` with a single query (per 500
+        templates): {template_name: set(domains)}.
         """
+        assigned = defaultdict(set)
+        for chunk in _chunks(template_names):
+            for name, domain in Template.objects.filter(
+                    name__in=chunk).values_list('name', 'sites__domain'):
+                # templates with no sites have a single (name, None) row
+                assigned[name]
+                if domain is not None:
+                    assigned[name].add(domain)
+        return assigned
+
+    def _handle_sites_not_assigned(self, template_names, required_sites,
+                                   template_name=None):
+        """
+            Checks whether templates B that are used by template A
+        have the sites from template A assigned.
+        Also checks that templates B exist if `template_name` (the name of
+        template A) is given.
+        """
+        assigned = self._get_assigned_sites(template_names)
+        for used_template in sorted(template_names):
+            if used_template not in assigned:
+                if template_name is not None:
+                    raise ValidationError(self._error_msg(
+                        'missing_template_use', template_name, used_template))
+                continue
+            need_assigning = set(required_sites) - assigned[used_template]
+            if need_assigning:
+                raise ValidationError(self._error_msg(
+                    'missing_sites', used_template, ', '.join(need_assigning)))
 
-        already_assigned = template.sites.values_list('domain', flat=True)
-        need_assigning = set(required_sites) - set(already_assigned)
-        if need_assigning:
-            raise ValidationError(self._error_msg(
-                'missing_sites', template.name, ', '.join(need_assigning)))
-
-    def _get_used_templates(self, template_name, site_domain, pages_search):
+    def _get_used_templates(self, template_name, site_domain, pages_search,
+                            graph):
         """
         Returns a set of templates that template `A` uses.
         Raises validation errors if the templates used are invalid.
@@ -128,18 +195,19 @@ class ExtendedTemplateAdminForm(registered_form(Template)):
                          - is true if this method is called when checking
                             templates from pages of a site that is about to be
                             unassigned
+            graph - TemplateDependencyGraph shared by all the checks; the
+                    template must have been added to it if it exists
         """
-        try:
-            template = Template.objects.get(name=template_name)
-            return set(get_all_templates_used(_Template(
-                template.content).nodelist))
-        except Template.DoesNotExist:
+        if not graph.has_template(template_name):
             if pages_search:
-                pages_to_print = Page.objects.filter(
-                    site__domain=site_domain, template=template_name)
+                pages_to_print = filter_pages_using(Page.objects.filter(
+                    site__domain=site_domain), [template_name])
                 raise ValidationError(self._error_msg(
                     'nonexistent_in_pages', template_name, site_domain,
                     _format_pages(pages_to_print)))
+            return set()
+        try:
+            return graph.get_closure(template_name)
         except TemplateSyntaxError, e:
             raise ValidationError(self._error_msg(
                 'syntax_error_unassigning', template_name, e, site_domain))
@@ -156,11 +224,10 @@ class ExtendedTemplateAdminForm(registered_form(Template)):
                     'missing_template_use', template_name, e))
 
     def _build_site_to_templates(self, template_site_pairs):
-        new_dict = defaultdict(list)
-        for pair in template_site_pairs:
-            template, site = pair[0], pair[1]
-            if template and not template == 'INHERIT':
-                new_dict[site].append(template)
+        new_dict = defaultdict(set)
+        for template, site in template_site_pairs:
+            if template:
+                new_dict[site].add(template)
         return new_dict
 
 
@@ -175,6 +242,8 @@ class ExtendedTemplateAdminForm(registered_form(Template)):
         use template A
             * site does not have plugins(that support template assigning) with
         template A in any of its pages
+        All sites are checked with a fixed number of queries and the templates
+        used are analyzed once, on a dependency graph shared by all sites.
         """
         assigned_in_form = cleaned_data['sites'].values_list('id', flat=True)
         all_in_form = self.base_fields['sites'].queryset.values_list('id', flat=True)
@@ -185,53 +254,70 @@ class ExtendedTemplateAdminForm(registered_form(Template)):
         # sites that were initially assigned and are now in
         #       the unassigned section
         sites_to_unassign_ids = unassigned_in_form & assigned_in_db
-        sites_to_unassign = Site.objects.filter(id__in=sites_to_unassign_ids)
-
-        unassigned_page_templates = self._build_site_to_templates(
-            sites_to_unassign.values_list('page__template', 'domain').distinct())
-
-        unassigned_site_templates = {
-            s.domain: s.template_set.exclude(name=self.instance.name).\
-                            values_list('name', flat=True)
-            for s in sites_to_unassign}
-
-        if not (unassigned_page_templates or unassigned_site_templates):
+        if not sites_to_unassign_ids:
             return
+        site_chunks = list(_chunks(sites_to_unassign_ids))
+        sites_to_unassign = sorted(
+            chain.from_iterable(Site.objects.filter(id__in=chunk)
+                                for chunk in site_chunks),
+            key=lambda site: site.domain)
+        domains = [site.domain for site in sites_to_unassign]
+
+        # pages that inherit their template use the template of an ancestor
+        unassigned_page_templates = self._build_site_to_templates(
+            chain.from_iterable(get_effective_templates(
+                Page.objects.filter(site__in=chunk).order_by().distinct(),
+                'site__domain') for chunk in site_chunks))
+
+        unassigned_site_templates = defaultdict(list)
+        for chunk in site_chunks:
+            site_templates = Template.sites.through.objects.filter(
+                site__in=chunk).exclude(template=self.instance).values_list(
+                'site__domain', 'template__name')
+            for domain, template_name in site_templates:
+                unassigned_site_templates[domain].append(template_name)
 
         current_templ = self.instance.name
-        compiled = {}
-        for domain, templates in unassigned_page_templates.iteritems():
+        graph = TemplateDependencyGraph(_get_template_source())
+        graph.add_templates(
+            set(chain(*unassigned_page_templates.values())) |
+            set(chain(*unassigned_site_templates.values())))
+
+        for domain in domains:
+            templates = unassigned_page_templates.get(domain, [])
             # check if it used by pages
             if current_templ in templates:
-                pages_to_print = Page.objects.filter(
-                    site__domain=domain, template=current_templ)
+                pages_to_print = filter_pages_using(Page.objects.filter(
+                    site__domain=domain), [current_templ])
                 raise ValidationError(self._error_msg(
                     'page_use', domain, _format_pages(pages_to_print)))
 
             # check if it is used by templates of pages
-            for template_name in templates:
-                _templs_of_template = compiled.setdefault(template_name,
-                    self._get_used_templates(template_name, domain, True))
+            for template_name in sorted(templates):
+                _templs_of_template = self._get_used_templates(
+                    template_name, domain, True, graph)
 
                 if current_templ in _templs_of_template:
-                    pages_to_print = Page.objects.filter(
-                        site__domain=domain, template=template_name)
+                    pages_to_print = filter_pages_using(Page.objects.filter(
+                        site__domain=domain), [template_name])
                     raise ValidationError(self._error_msg(
                         'page_template_use', domain, template_name,
                         _format_pages(pages_to_print)))
 
-        for domain, other_templates in unassigned_site_templates.iteritems():
+        for domain in domains:
             # check if it is used by templates of the unassigned site
-            for template_name in other_templates:
-                _templs_of_template = compiled.setdefault(template_name,
-                    self._get_used_templates(template_name, domain, False))
+            for template_name in unassigned_site_templates.get(domain, []):
+                _templs_of_template = self._get_used_templates(
+                    template_name, domain, False, graph)
 
                 if current_templ in _templs_of_template:
                     raise ValidationError(self._error_msg(
                         'site_template_use', domain, current_templ, template_name))
 
+        templates_by_site = get_plugin_templates_from_sites(
+            sites_to_unassign_ids)
         for site in sites_to_unassign:
-            templ_with_plugins = get_plugin_templates_from_site(site)
+            templ_with_plugins = templates_by_site.get(site.id, {})
             if current_templ in templ_with_plugins:
                 pages_ids = get_pages_for_plugins_templates(
                     site, current_templ, templ_with_plugins[current_templ])
@@ -241,7 +327,84 @@ class ExtendedTemplateAdminForm(registered_form(Template)):
                     ', '.join(templ_with_plugins[current_templ]),
                     _format_pages(pages_to_print)))
 
-    @with_template_debug_on
+    def _validate_content(self, name, content, sites_assigned_in_widget):
+        """
+        Checks that `content` compiles, has no infinite recursion and that
+        the templates it uses exist and have all the sites assigned.
+        With DBTEMPLATES_EDGES_ONLY_ANALYSIS set, the templates used are
+        found on a dependency graph that keeps no compiled template.
+        """
+        source = _get_template_source()
+        edges_only = cms_templates_settings.edges_only_analysis
+        try:
+            if edges_only:
+                graph = TemplateDependencyGraph(source)
+                graph.add_content(name, content)
+                graph.get_edges(name)
+            else:
+                compiled_template = _Template(content,
+                                              engine=get_validation_engine())
+
+            #at this point template content does not have any syntax errors
+            handle_recursive_calls(name, content, source)
+
+            if edges_only:
+                used_templates = graph.get_closure(name)
+            else:
+                used_templates = get_all_templates_used(
+                    compiled_template.nodelist, source=source)
+        except TemplateSyntaxError, e:
+            raise ValidationError(
+                self._error_msg('syntax_error', name, e))
+        except InfiniteRecursivityError, e:
+            msg = format_recursive_msg(name, e)
+            raise ValidationError(
+                self._error_msg('infinite_recursivity', msg))
+        except TemplateDoesNotExist, e:
+            try:
+                existing_template = Template.objects.get(name=str(e))
+                self._handle_sites_not_assigned(
+                    [existing_template.name], sites_assigned_in_widget)
+                raise ValidationError(self._error_msg('not_found', e))
+            except Template.DoesNotExist:
+                raise ValidationError(self._error_msg(
+                        'missing_template_use', name, e))
+
+        # make sure all used templates exist and have all necessary sites
+        #   assigned
+        self._handle_sites_not_assigned(
+            set(used_templates), sites_assigned_in_widget, name)
+
+    def _get_content_errors(self, name, content, sites_assigned_in_widget):
+        """
+        Returns the messages of the errors found by _validate_content. They
+        can be shared by the concurrent validations of the same content.
+        """
+        try:
+            self._validate_content(name, content, sites_assigned_in_widget)
+        except ValidationError, e:
+            return e.messages
+        return []
+
+    def _is_unchanged(self, cleaned_data):
+        """
+        Whether neither the content nor the sites of the existing template
+        were changed. The content is compared with the stored digest.
+        """
+        if not self.instance.pk:
+            return False
+        digest = get_content_digest(cleaned_data['content'])
+        if not TemplateMetadata.objects.filter(
+                template=self.instance, content_digest=digest).exists():
+            return False
+        in_form_ids = self.base_fields['sites'].queryset.values_list(
+            'id', flat=True)
+        assigned_in_form = set(cleaned_data['sites'].values_list(
+            'id', flat=True))
+        return assigned_in_form == set(self.instance.sites.filter(
+            id__in=in_form_ids).values_list('id', flat=True))
+
+    @profiled('template_clean', _describe_template_form)
     def clean(self):
         """
         Validates whether this template will work on site pages.
@@ -263,59 +426,40 @@ class ExtendedTemplateAdminForm(registered_form(Template)):
         if not cleaned_data['sites']:
             cleaned_data['sites'] = Site.objects.none()
 
+        if self._is_unchanged(cleaned_data):
+            # the template was validated when this content was saved
+            cleaned_data['sites'] = self.instance.sites.all()
+            return cleaned_data
+
         sites_assigned_in_widget = [site.domain
                                     for site in cleaned_data['sites']]
-        try:
-            compiled_template = _Template(cleaned_data.get('content'))
-
-            #at this point template content does not have any syntax errors
-            handle_recursive_calls(cleaned_data['name'],
-                                   cleaned_data['content'])
-
-            used_templates = get_all_templates_used(compiled_template.nodelist)
-        except TemplateSyntaxError, e:
-            raise ValidationError(
-                self._error_msg('syntax_error', cleaned_data['name'], e))
-        except InfiniteRecursivityError, e:
-            msg = format_recursive_msg(cleaned_data['name'], e)
-            raise ValidationError(
-                self._error_msg('infinite_recursivity', msg))
-        except TemplateDoesNotExist, e:
-            try:
-                existing_template = Template.objects.get(name=str(e))
-                self._handle_sites_not_assigned(
-                    existing_template, sites_assigned_in_widget)
-                raise ValidationError(self._error_msg('not_found', e))
-            except Template.DoesNotExist:
-                raise ValidationError(self._error_msg(
-                        'missing_template_use', cleaned_data['name'], e))
-
-        # make sure all used templates have all necessary sites assigned
-        for used_template in set(used_templates):
-            try:
-                _used_template = Template.objects.get(name=used_template)
-            except Template.DoesNotExist, e:
-                raise ValidationError(self._error_msg(
-                     'missing_template_use', cleaned_data['name'], used_template))
-            else:
-                self._handle_sites_not_assigned(
-                    _used_template, sites_assigned_in_widget)
+        # concurrent validations of the same content for the same sites
+        #   share a single computation
+        errors = _validation_flight.do(
+            (cleaned_data['name'],
+             get_content_digest(cleaned_data['content']),
+             tuple(sorted(sites_assigned_in_widget))),
+            self._get_content_errors, cleaned_data['name'],
+            cleaned_data['content'], sites_assigned_in_widget)
+        if errors:
+            raise ValidationError(errors)
 
         if self.instance.pk:
             self._validate_unassigned_sites(cleaned_data)
             # if the sites widget doesn't show all sites make sure the sites
             #   assigned and unchaged will remain assigned
-            all_in_form = self.base_fields['sites'].queryset
-            assigned_in_form_ids = list(
+            #   (the ids are compared here, they may not fit in a query)
+            all_in_form_ids = set(self.base_fields['sites'].queryset
+                                  .values_list('id', flat=True))
+            assigned_in_form_ids = set(
                 cleaned_data['sites'].values_list('id', flat=True))
-            unassigned_in_form_ids = list(
-                all_in_form.exclude(id__in=assigned_in_form_ids)
-                    .values_list('id', flat=True))
-            assigned_and_unchanged_ids = list(
-                self.instance.sites.exclude(id__in=unassigned_in_form_ids)
-                    .values_list('id', flat=True))
-            all_assigned = assigned_and_unchanged_ids + assigned_in_form_ids
-            cleaned_data['sites'] = Site.objects.filter(id__in=all_assigned)
+            assigned_and_unchanged_ids = set(
+                self.instance.sites.values_list('id', flat=True)) - \
+                all_in_form_ids
+            all_assigned = assigned_and_unchanged_ids | assigned_in_form_ids
+            cleaned_data['sites'] = list(chain.from_iterable(
+                Site.objects.filter(id__in=chunk)
+                for chunk in _chunks(sorted(all_assigned))))
 
         if hasattr(self.fields['sites'], '_validate_empty_sites'):
             sites = cleaned_data['sites']
@@ -325,16 +469,34 @@ class ExtendedTemplateAdminForm(registered_form(Template)):
         return cleaned_data
 
 
-def get_templates_that_use_template(template_name, only_one_required=False):
+def _scan_templates_that_use_template(template_name, only_one_required=False,
+                                      using=None):
     quoted_name = "'%s'" % template_name
     double_quoted_name = '"%s"' % template_name
 
-    candidates = Template.objects.filter(Q(content__contains=quoted_name) |
-                                         Q(content__contains=double_quoted_name))
+    # the content index narrows down the templates scanned with LIKE
+    candidates = search_templates(
+        Template.objects.using(using), template_name).filter(
+        Q(content__contains=quoted_name) |
+        Q(content__contains=double_quoted_name))
+    source = _get_template_source()
+    graph = None
+    if cms_templates_settings.edges_only_analysis:
+        graph = TemplateDependencyGraph(source)
     child_templates = []
     for child_template in candidates:
         try:
-            parents = get_all_templates_used(_Template(child_template.content).nodelist)
+            if graph is not None:
+                graph.add_content(child_template.name, child_template.content)
+                parents = graph.get_closure(child_template.name)
+            else:
+                if source is not None:
+                    source.add_content(child_template.name,
+                                       child_template.content)
+                parents = get_all_templates_used(
+                    _Template(child_template.content,
+                              engine=get_validation_engine()).nodelist,
+                    source=source)
         except TemplateDoesNotExist:
             parents = []
         if template_name in parents:
@@ -344,29 +506,133 @@ def get_templates_that_use_template(template_name, only_one_required=False):
     return child_templates
 
 
-def _page_usage(page):
-    return (page.get_title(), reverse("admin:cms_page_change", args=[page.id]))
+def get_templates_that_use_template(template_name, only_one_required=False,
+                                    transitive=False, using=None):
+    """
+    Returns the templates that use template `template_name`. With
+    `transitive` set, the templates that use it through other templates
+    are returned too. They are read from database `using`
+    (DBTEMPLATES_READ_DATABASE by default).
+    """
+    using = using or get_read_alias()
+    if not cms_templates_settings.dependency_index:
+        child_templates = _scan_templates_that_use_template(
+            template_name, only_one_required, using)
+        to_visit = list(child_templates) if transitive else []
+        seen = set([template_name] + [t.name for t in child_templates])
+        while to_visit and not only_one_required:
+            for child in _scan_templates_that_use_template(
+                    to_visit.pop().name, using=using):
+                if child.name not in seen:
+                    seen.add(child.name)
+                    child_templates.append(child)
+                    to_visit.append(child)
+        return child_templates
+
+    if transitive:
+        names = get_dependent_names([template_name], transitive=True,
+                                    using=using)
+        child_templates = []
+        for chunk in _chunks(sorted(names)):
+            child_templates += Template.objects.using(using).filter(
+                name__in=chunk)
+            if child_templates and only_one_required:
+                return child_templates[:1]
+        return child_templates
+
+    child_templates = Template.objects.using(using).filter(
+        dependencies__name=template_name).exclude(name=template_name)
+    if only_one_required:
+        return list(child_templates[:1])
+    return list(child_templates)
+
+
+def _get_page_titles(page_ids, using=None):
+    """
+    Returns the titles of the given pages in the current language, or in
+    any available language for untranslated pages, using a single query.
+    """
+    language = get_language()
+    titles = {}
+    for page_id, title_language, title in Title.objects.using(using).filter(
+            page__in=page_ids).values_list('page', 'language', 'title'):
+        if page_id not in titles or title_language == language:
+            titles[page_id] = title
+    return titles
+
+
+def _page_usage(page_id, title):
+    return (title, reverse("admin:cms_page_change", args=[page_id]))
 
 
 def _template_usage(template):
     return (template.name, reverse("admin:dbtemplates_template_change", args=[template.id]))
 
 
-def get_template_usages(template, only_one_required=False):
-    pages = Page.objects.filter(template=template.name).select_related("site")
-    if pages and only_one_required:
-        page = pages[0]
-        return {'pages': {page.site: [_page_usage(pages[0]),]}}
+def get_template_usages(template, only_one_required=False, using=None):
+    """
+    Returns the pages and templates that use `template` or None if it is
+    not used. Pages are reported as the number of pages per site (one
+    aggregate query) and a sample of at most DBTEMPLATES_USAGE_PAGES_LIMIT
+    pages. Use get_template_site_usages for the complete list of pages.
+    They are read from database `using` (DBTEMPLATES_READ_DATABASE by
+    default).
+    """
+    using = using or get_read_alias()
+    pages = filter_pages_using(Page.objects.using(using), [template.name])
+    if only_one_required:
+        page = pages.select_related("site").order_by('id').first()
+        if page:
+            usage = _page_usage(
+                page.id, _get_page_titles([page.id], using).get(page.id))
+            return {'pages': {page.site: [usage,]}}
+        child_templates = get_templates_that_use_template(
+            template.name, True, using=using)
+        if child_templates:
+            return {'child_templates': [_template_usage(child_templates[0]),]}
+        return None
+
+    counts = dict(pages.order_by().values_list('site').annotate(Count('id')))
+    sites = Site.objects.using(using).in_bulk(counts.keys()) if counts else {}
+    page_counts = dict((sites[site_id], count)
+                       for site_id, count in counts.iteritems())
+
+    sample = list(pages.order_by('site', 'id').values_list('id', 'site')
+                  [:cms_templates_settings.usage_pages_limit])
+    titles = _get_page_titles([page_id for page_id, site_id in sample], using)
     pages_by_site = {}
-    for page in pages:
-        pages_by_site.setdefault(page.site, []).append(_page_usage(page))
-    child_templates = get_templates_that_use_template(template.name, only_one_required)
-    if child_templates and only_one_required:
-        return {'child_templates': [_template_usage(child_templates[0]),]}
+    for page_id, site_id in sample:
+        pages_by_site.setdefault(sites[site_id], []).append(
+            _page_usage(page_id, titles.get(page_id)))
+
+    child_templates = get_templates_that_use_template(template.name,
+                                                      using=using)
     return {
         "pages": pages_by_site,
+        "page_counts": page_counts,
         "child_templates":[_template_usage(temp) for temp in child_templates]
-    } if pages_by_site or child_templates else None
+    } if page_counts or child_templates else None
+
+
+def get_template_site_usages(template, site_id, page_number=1):
+    """
+    Returns a paginator page with the usages of `template` in the pages
+    of site `site_id`.
+    """
+    using = get_read_alias()
+    pages = filter_pages_using(Page.objects.using(using).filter(site=site_id),
+                               [template.name]).order_by('id')
+    paginator = Paginator(pages.values_list('id', flat=True),
+                          cms_templates_settings.usage_pages_limit)
+    try:
+        usages = paginator.page(page_number)
+    except (PageNotAnInteger, EmptyPage):
+        usages = paginator.page(1)
+    page_ids = list(usages.object_list)
+    titles = _get_page_titles(page_ids, using)
+    usages.object_list = [_page_usage(page_id, titles.get(page_id))
+                          for page_id in page_ids]
+    return usages
 
 
 class TemplateUsedException(Exception):
@@ -375,25 +641,106 @@ class TemplateUsedException(Exception):
         super(TemplateUsedException, self).__init__(*args, **kwargs)
 
 
+class TemplateUsageListFilter(SimpleListFilter):
+    title = 'usage'
+    parameter_name = 'usage'
+
+    def lookups(self, request, model_admin):
+        return (('unused', 'Unused'), ('used', 'Used'))
+
+    def queryset(self, request, queryset):
+        unused = Q(cms_metadata__page_count=0,
+                   cms_metadata__dependent_count=0,
+                   cms_metadata__plugin_count=0)
+        if self.value() == 'unused':
+            return queryset.filter(unused)
+        if self.value() == 'used':
+            return queryset.filter(cms_metadata__isnull=False).exclude(unused)
+        return queryset
+
+
+def _usage_counter(counter, description):
+    def get_counter(self, obj):
+        try:
+            return getattr(obj.cms_metadata, counter)
+        except TemplateMetadata.DoesNotExist:
+            return None
+    get_counter.short_description = description
+    get_counter.admin_order_field = 'cms_metadata__%s' % counter
+    return get_counter
+
+
 @extend_registered
 class RestrictedTemplateAdmin(registered_modeladmin(Template)):
-    list_filter = ('sites__name', )
+    list_filter = ('sites__name', TemplateUsageListFilter)
     change_form_template = 'cms_templates/change_form.html'
     delete_confirmation_template = 'cms_templates/admin_delete_confirmation.html'
     form = ExtendedTemplateAdminForm
 
+    lookup_page_size = 50
+    search_fields = ('name',)
+
+    page_count = _usage_counter('page_count', 'Pages')
+    dependent_count = _usage_counter('dependent_count', 'Used by templates')
+    plugin_count = _usage_counter('plugin_count', 'Plugins')
+
+    def get_list_display(self, request):
+        return tuple(super(RestrictedTemplateAdmin, self).get_list_display(
+            request)) + ('page_count', 'dependent_count', 'plugin_count')
+
+    def get_queryset(self, request):
+        return super(RestrictedTemplateAdmin, self).get_queryset(
+            request).select_related('cms_metadata')
+
+    def get_search_results(self, request, queryset, search_term):
+        """
+        Matches the names containing the search term and the contents that
+        contain its words, through the content index.
+        """
+        if not search_term.strip():
+            return queryset, False
+        by_content = search_templates(
+            Template.objects.all(), search_term).values('pk')
+        return queryset.filter(Q(name__icontains=search_term) |
+                               Q(pk__in=by_content)), False
+
     def delete_model(self, request, obj):
-        template_usage = get_template_usages(obj, only_one_required=True)
+        # the replica may not have the last pages and templates using it yet
+        template_usage = get_template_usages(obj, only_one_required=True,
+                                             using=DEFAULT_DB_ALIAS)
         if template_usage:
             raise TemplateUsedException(usages=template_usage)
         super(RestrictedTemplateAdmin, self).delete_model(request, obj)
 
+    def _get_usage_sites(self, request, template, usages):
+        """
+        Summary of the pages that use `template` grouped by site. The
+        detailed list of pages is loaded only for the site requested with
+        the `usage_site` parameter.
+        """
+        detail_site = request.GET.get('usage_site')
+        usage_sites = []
+        for site, count in sorted(usages['page_counts'].items(),
+                                  key=lambda item: item[0].domain):
+            sample = usages['pages'].get(site, [])
+            usage_site = {'site': site, 'count': count, 'pages': sample,
+                          'more': count - len(sample)}
+            if detail_site == str(site.id):
+                usage_site['detail'] = get_template_site_usages(
+                    template, site.id, request.GET.get('usage_page', 1))
+            usage_sites.append(usage_site)
+        return usage_sites
+
     def delete_view(self, request, object_id, extra_context=None):
         if request.method == 'GET':
             try:
                 template = Template.objects.get(id=object_id)
                 extra_context = extra_context or {}
-                extra_context['usage_errors'] = get_template_usages(template)
+                usages = get_template_usages(template)
+                extra_context['usage_errors'] = usages
+                if usages:
+                    extra_context['usage_sites'] = self._get_usage_sites(
+                        request, template, usages)
             except Template.DoesNotExist:
                 # Let the error be handled by the default view
                 pass
@@ -404,6 +751,54 @@ class RestrictedTemplateAdmin(registered_modeladmin(Template)):
             redirect_url = reverse("admin:dbtemplates_template_change", args=[object_id])
             return HttpResponseRedirect(redirect_url)
 
+    def get_urls(self):
+        from django.conf.urls import url
+        info = self.model._meta.app_label, self.model._meta.model_name
+        return [
+            url(r'^lookup/$', self.admin_site.admin_view(self.lookup_view),
+                name='%s_%s_lookup' % info),
+            url(r'^(.+)/impact/$', self.admin_site.admin_view(self.impact_view),
+                name='%s_%s_impact' % info),
+        ] + super(RestrictedTemplateAdmin, self).get_urls()
+
+    def lookup_view(self, request):
+        """
+        Returns as JSON a page of the ids and names of the templates whose
+        name contains the `q` parameter, ordered by name, used by the
+        template picker of the site admin.
+        """
+        if not self.has_change_permission(request):
+            raise PermissionDenied
+        try:
+            page = max(int(request.GET.get('page', 1)), 1)
+        except ValueError:
+            page = 1
+        limit = self.lookup_page_size
+        templates = super(RestrictedTemplateAdmin, self).get_queryset(
+            request).filter(name__icontains=request.GET.get('q', ''))
+        # one more row tells whether there is a next page without a COUNT
+        rows = list(templates.order_by('name').values_list('id', 'name')[
+            (page - 1) * limit:page * limit + 1])
+        return JsonResponse({
+            'results': [{'id': pk, 'name': name} for pk, name in rows[:limit]],
+            'more': len(rows) > limit,
+        })
+
+    def impact_view(self, request, object_id):
+        """
+        Returns as JSON the impact of changing the content of the template
+        to the `content` POST parameter.
+        """
+        if request.method != 'POST':
+            return HttpResponseNotAllowed(['POST'])
+        template = self.get_object(request, unquote(object_id))
+        if template is None:
+            raise Http404
+        if not self.has_change_permission(request, template):
+            raise PermissionDenied
+        return JsonResponse(get_template_change_impact(
+            template, request.POST.get('content', '')))
+
     def get_actions(self, request):
         """
         Overriden get_actions so we don't allow bulk deletions. Validations would get more
@@ -418,22 +813,58 @@ class RestrictedTemplateAdmin(registered_modeladmin(Template)):
 @extend_registered
 class DynamicTemplatesPageAdmin(registered_modeladmin(Page)):
     def get_form(self, request, obj=None, **kwargs):
+        """
+        The template choices of the form are the tuple shared by all the
+        requests for the current site.
+        """
         f = super(DynamicTemplatesPageAdmin, self).get_form(
             request, obj, **kwargs)
-        choices = settings.CMS_TEMPLATES
-        f.base_fields['template'].choices = choices
+        field = f.base_fields['template']
+        # the choices setter would copy the shared tuple into a list
+        field._choices = field.widget.choices = settings.CMS_TEMPLATES
         return f
 
 
+class ChunkedModelMultipleChoiceField(ModelMultipleChoiceField):
+    """
+    Loads the selected objects in chunks, so that selections larger than
+    the number of parameters allowed in a query can be cleaned. Returns a
+    list of the objects instead of a queryset.
+    """
+
+    def _check_values(self, value):
+        key = self.to_field_name or 'pk'
+        try:
+            value = frozenset(value)
+        except TypeError:
+            raise ValidationError(self.error_messages['list'], code='list')
+        for pk in value:
+            try:
+                self.queryset.filter(**{key: pk})
+            except (ValueError, TypeError):
+                raise ValidationError(
+                    self.error_messages['invalid_pk_value'],
+                    code='invalid_pk_value', params={'pk': pk})
+        objects = list(chain.from_iterable(
+            self.queryset.filter(**{'%s__in' % key: chunk})
+            for chunk in _chunks(value)))
+        found = set(force_text(getattr(o, key)) for o in objects)
+        for val in value:
+            if force_text(val) not in found:
+                raise ValidationError(
+                    self.error_messages['invalid_choice'],
+                    code='invalid_choice', params={'value': val})
+        return objects
+
+
 @extend_registered
 class ExtendedSiteAdminForm(add_bidirectional_m2m(registered_form(Site))):
-    templates = ModelMultipleChoiceField(
+    # only the selected templates are loaded, by the widget and when the
+    #   field is cleaned
+    templates = ChunkedModelMultipleChoiceField(
         queryset=Template.objects.all(),
         required=False,
-        widget=FilteredSelectMultiple(
-            verbose_name='Templates',
-            is_stacked=False
-        )
+        widget=TemplatePickerWidget()
     )
 
     def _get_bidirectional_m2m_fields(self):
@@ -470,10 +901,9 @@ class ExtendedSiteAdminForm(add_bidirectional_m2m(registered_form(Site))):
     def _error_msg(self, msg_key, *args):
         return self.custom_error_messages[msg_key].format(*args)
 
-    def _get_templates_used(self, template_instance):
+    def _get_templates_used(self, template_instance, graph):
         try:
-            compiled_template = _Template(template_instance.content)
-            used_templates = get_all_templates_used(compiled_template.nodelist)
+            return graph.get_closure(template_instance.name)
         except TemplateSyntaxError, e:
             raise ValidationError(
                 self._error_msg('syntax_error', template_instance.name, e))
@@ -486,15 +916,41 @@ class ExtendedSiteAdminForm(add_bidirectional_m2m(registered_form(Site))):
             except Template.DoesNotExist:
                 raise ValidationError(self._error_msg(
                     'required_not_exist', template_instance.name, e))
-        return used_templates
+        return set()
 
-    @with_template_debug_on
+    def _get_templates_to_validate(self, assigned_templates):
+        """
+        Returns the assigned templates whose dependencies need to be checked.
+        Unless DBTEMPLATES_SITE_FULL_VALIDATION is set, only the assignment
+        delta is checked: the newly assigned templates and, found through
+        the dependency index, the templates that still remain assigned but
+        use some of the unassigned ones.
+        """
+        if (self.instance.pk is None or
+                cms_templates_settings.site_full_validation or
+                not cms_templates_settings.dependency_index):
+            return list(assigned_templates)
+
+        assigned_names = set([t.name for t in assigned_templates])
+        previous_names = set(self.instance.template_set.values_list(
+            'name', flat=True))
+        unassigned_names = previous_names - assigned_names
+        affected_names = (assigned_names - previous_names) | (
+            get_dependent_names(unassigned_names, transitive=True) &
+            assigned_names)
+        return [t for t in assigned_templates if t.name in affected_names]
+
+    @profiled('site_clean_templates', _describe_site_form)
     def clean_templates(self):
         assigned_templates = self.cleaned_data['templates']
 
         assigned_names = set([t.name for t in assigned_templates])
-        for assigned_templ in assigned_templates:
-            used = set(self._get_templates_used(assigned_templ))
+        graph = TemplateDependencyGraph(_get_template_source())
+        to_validate = self._get_templates_to_validate(assigned_templates)
+        for assigned_templ in to_validate:
+            graph.add_content(assigned_templ.name, assigned_templ.content)
+        for assigned_templ in to_validate:
+            used = set(self._get_templates_used(assigned_templ, graph))
             if not used <= assigned_names:
                 raise ValidationError(self._error_msg(
                     'all_required', ', '.join(used - assigned_names),
@@ -503,9 +959,14 @@ class ExtendedSiteAdminForm(add_bidirectional_m2m(registered_form(Site))):
         if self.instance.pk is None:
             return assigned_templates
 
-        required_templates = set(self.instance.page_set
-            .exclude(template__in=list(assigned_names) + ['INHERIT'])
-            .values_list('template', flat=True).distinct())
+        pages = self.instance.page_set.all()
+        if len(assigned_names) <= _QUERY_CHUNK_SIZE:
+            # otherwise they are only filtered out below
+            pages = pages.exclude(template__in=assigned_names)
+        required_templates = set(
+            template for (template,) in get_effective_templates(
+                pages.order_by().distinct())
+            if template and template not in assigned_names)
 
         templates_to_plugins = get_plugin_templates_from_site(self.instance)
         plg_tmpl_not_assigned = set(templates_to_plugins.keys()) - assigned_names
@@ -516,8 +977,8 @@ class ExtendedSiteAdminForm(add_bidirectional_m2m(registered_form(Site))):
 
             nonexistent = required_templates - all_existing_templates
             if nonexistent:
-                pages_to_print = self.instance.page_set.filter(
-                    template__in=nonexistent)
+                pages_to_print = filter_pages_using(
+                    self.instance.page_set.all(), nonexistent)
                 raise ValidationError(self._error_msg(
                     'nonexistent_in_pages',
                     ', '.join(nonexistent), _format_pages(pages_to_print)))
@@ -534,8 +995,8 @@ class ExtendedSiteAdminForm(add_bidirectional_m2m(registered_form(Site))):
                     _format_pages(pages_to_print)))
 
             if required_templates:
-                pages_to_print = self.instance.page_set.filter(
-                    template__in=required_templates)
+                pages_to_print = filter_pages_using(
+                    self.instance.page_set.all(), required_templates)
                 raise ValidationError(self._error_msg(
                     'required_in_pages', ', '.join(required_templates),
                     _format_pages(pages_to_print)))
@@ -550,97 +1011,22 @@ class ExtendedSiteAdminForm(add_bidirectional_m2m(registered_form(Site))):
                     ', '.join(templates_to_plugins[first_required]),
                     _format_pages(pages_to_print)))
 
-        pks = [s.pk for s in assigned_templates]
-        unassigned = self.instance.template_set.exclude(pk__in=pks)\
-            .values_list('id', flat=True)
+        pks = set(s.pk for s in assigned_templates)
+        unassigned = [pk for pk in self.instance.template_set.values_list(
+            'id', flat=True) if pk not in pks]
 
         if cms_templates_settings.include_orphan:
             return assigned_templates
 
-        orphan_templates = Template.objects.filter(id__in=unassigned)\
-            .annotate(Count('sites')).filter(sites__count=1)\
-            .values_list('name', flat=True)
+        orphan_templates = []
+        for chunk in _chunks(unassigned):
+            orphan_templates.extend(Template.objects.filter(id__in=chunk)
+                                    .annotate(Count('sites'))
+                                    .filter(sites__count=1)
+                                    .values_list('name', flat=True))
 
         if orphan_templates:
             raise ValidationError(
                 self._error_msg('orphan', ", ".join(orphan_templates)))
 
         return assigned_templates
-
-
-# validate PLUGIN_TEMPLATE_REFERENCES configuration
-_VALID_TEMPLATE_FIELDS = [fields.related.ForeignKey, fields.CharField]
-for plugin_name in cms_templates_settings.PLUGIN_TEMPLATE_REFERENCES:
-    # make sure all plugins are dicovered
-    plugin_pool.get_all_plugins()
-
-    if plugin_name not in plugin_pool.plugins:
-        raise ImproperlyConfigured(
-            'setting PLUGIN_TEMPLATE_REFERENCES improperly configured: '
-            'CMS Plugin %s not found' % plugin_name)
-
-    plugin_class = plugin_pool.get_plugin(plugin_name)
-    if not hasattr(plugin_class, 'get_template_field_name'):
-        raise AttributeError(
-            'CMS plugin %s must implement \'get_template_field_name\' '
-            'staticmethod.' % plugin_name)
-
-    model_opts = plugin_class.model._meta
-    field_name = plugin_class.get_template_field_name()
-    if field_name not in model_opts.get_all_field_names():
-        raise fields.FieldDoesNotExist(
-            'CMS plugin %s must implement \'get_template_field_name\' '
-            'class method that returns a valid model template field '
-            'name.' % plugin_name)
-
-    field_type = model_opts.get_field_by_name(field_name)[0].__class__
-    if field_type not in _VALID_TEMPLATE_FIELDS:
-        raise AttributeError(
-            'CMS Plugin %s method \'get_template_field_name\' must return '
-            'the name of a valid template field. The template field '
-            'type must be one of: %s' % (
-                plugin_name, ','.join(_VALID_TEMPLATE_FIELDS)))
-
-
-def _get_template_name_attr(model, field_name):
-    field_type = model._meta.get_field_by_name(field_name)[0].__class__
-    is_str = field_type is fields.CharField
-    return field_name if is_str else '%s__name' % field_name
-
-
-def _get_plugin_metadata(plugin_name):
-    plugin_class = plugin_pool.get_plugin(plugin_name)
-    plugin_model = plugin_class.model
-    field_name = plugin_class.get_template_field_name()
-    template_name_attr = _get_template_name_attr(
-        plugin_model, field_name)
-    return plugin_model, field_name, template_name_attr
-
-
-def _get_templates_from_plugin(site, plugin_name):
-    plugin_model, field_name, template_name_attr = _get_plugin_metadata(plugin_name)
-
-    return plugin_model.objects.filter(**{
-        'placeholder__page__site': site,
-        '%s__isnull' % field_name: False
-    }).values_list(template_name_attr, flat=True)
-
-
-def get_plugin_templates_from_site(site):
-    templates = defaultdict(set)
-    for plugin in cms_templates_settings.PLUGIN_TEMPLATE_REFERENCES:
-        for template in _get_templates_from_plugin(site, plugin):
-            templates[template].add(plugin)
-    return templates
-
-
-def get_pages_for_plugins_templates(site, template_name, plugins):
-    pages = []
-    for plugin in plugins:
-        plugin_model, field_name, template_name_attr = _get_plugin_metadata(plugin)
-        pages += plugin_model.objects.filter(**{
-            'placeholder__page__site': site,
-            '%s__isnull' % field_name: False,
-            template_name_attr: template_name
-        }).values_list('placeholder__page', flat=True)
-    return pages
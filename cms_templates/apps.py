@@ -0,0 +1,20 @@
+from django.apps import AppConfig
+
+
+class CmsTemplatesConfig(AppConfig):
+    name = 'cms_templates'
+
+    def ready(self):
+        from cms_templates.plugins import load_plugin_metadata
+        from cms_templates.counters import connect_counter_signals
+        from cms_templates.middleware import connect_generation_signals
+        from cms_templates.inheritance import connect_inheritance_signals
+        from cms_templates.routing import connect_routing_signals
+        from cms_templates.search import connect_search_signals
+        # validates PLUGIN_TEMPLATE_REFERENCES once all the apps are loaded
+        load_plugin_metadata()
+        connect_counter_signals()
+        connect_generation_signals()
+        connect_inheritance_signals()
+        connect_routing_signals()
+        connect_search_signals()
@@ -0,0 +1,183 @@
+from collections import defaultdict
+
+from django.db import transaction
+from django.db.models import Count, F
+from django.db.models.signals import (pre_save, post_save, post_delete,
+                                      pre_delete)
+from cms.models import Page
+from dbtemplates.models import Template
+
+from cms_templates.models import (TemplateDependency, TemplateMetadata,
+                                  get_content_digest)
+from cms_templates.plugins import get_plugin_metadata
+from cms_templates.template_analyzer import _chunks
+
+
+def _count_by_name(queryset, name_attr, names):
+    counts = defaultdict(int)
+    for chunk in _chunks(names):
+        for name, count in queryset.filter(**{
+                '%s__in' % name_attr: chunk}).order_by().values_list(
+                name_attr).annotate(count=Count('pk')):
+            counts[name] += count
+    return counts
+
+
+def get_page_counts(names):
+    return _count_by_name(Page.objects.all(), 'template', names)
+
+
+def get_dependent_counts(names):
+    return _count_by_name(TemplateDependency.objects.all(), 'name', names)
+
+
+def get_plugin_counts(names):
+    counts = defaultdict(int)
+    for plugin in get_plugin_metadata():
+        for name, count in _count_by_name(
+                plugin.model.objects.all(), plugin.template_name_attr,
+                names).iteritems():
+            counts[name] += count
+    return counts
+
+
+def _group_by_counters(counters):
+    """
+    Returns {counters: [keys]} for {key: counters}, so the templates with
+    the same counters are updated together.
+    """
+    groups = defaultdict(list)
+    for key, values in counters.iteritems():
+        groups[values].append(key)
+    return groups
+
+
+def update_dependent_counts(names):
+    """Recounts the templates that use each of the templates `names`."""
+    counts = get_dependent_counts(names)
+    groups = _group_by_counters(dict((name, counts[name]) for name in names))
+    for count, grouped in groups.iteritems():
+        for chunk in _chunks(grouped):
+            TemplateMetadata.objects.filter(template__name__in=chunk).update(
+                dependent_count=count)
+
+
+def rebuild_template_counters(queryset=None):
+    """
+    Recounts the pages, templates and plugins that use each template from
+    `queryset` (all templates by default). Returns the number of templates.
+    """
+    if queryset is None:
+        queryset = Template.objects.all()
+    templates = dict(queryset.values_list('name', 'pk'))
+    page_counts = get_page_counts(templates)
+    dependent_counts = get_dependent_counts(templates)
+    plugin_counts = get_plugin_counts(templates)
+    counters = dict(
+        (pk, (page_counts[name], dependent_counts[name], plugin_counts[name]))
+        for name, pk in templates.iteritems())
+    with transaction.atomic():
+        existing = set()
+        for chunk in _chunks(counters.keys()):
+            existing.update(TemplateMetadata.objects.filter(
+                template__in=chunk).values_list('template', flat=True))
+        groups = _group_by_counters(counters)
+        for (pages, dependents, plugins), pks in groups.iteritems():
+            for chunk in _chunks(pks):
+                TemplateMetadata.objects.filter(template__in=chunk).update(
+                    page_count=pages, dependent_count=dependents,
+                    plugin_count=plugins)
+
+        missing = [pk for pk in counters if pk not in existing]
+        created = []
+        for chunk in _chunks(missing):
+            for pk, content in Template.objects.filter(
+                    pk__in=chunk).values_list('pk', 'content').iterator():
+                pages, dependents, plugins = counters[pk]
+                created.append(TemplateMetadata(
+                    template_id=pk, content_digest=get_content_digest(content),
+                    page_count=pages, dependent_count=dependents,
+                    plugin_count=plugins))
+        TemplateMetadata.objects.bulk_create(created, batch_size=500)
+    return len(templates)
+
+
+class _ReferenceCounter(object):
+    """
+    Keeps `counter` of TemplateMetadata equal to the number of `model`
+    instances that reference each template through field `field_name`.
+    `lookup` is the TemplateMetadata lookup for the field value. The value
+    replaced by a save is read right before it, so loading instances
+    costs nothing.
+    """
+
+    def __init__(self, model, field_name, lookup, counter):
+        self.model = model
+        self.field_name = field_name
+        self.attname = model._meta.get_field(field_name).attname
+        self.lookup = lookup
+        self.counter = counter
+        self.saved_attname = '_cms_templates_saved_%s' % self.attname
+
+    def _add(self, value, delta):
+        if not value:
+            return
+        metadata = TemplateMetadata.objects.filter(**{self.lookup: value})
+        if delta < 0:
+            metadata = metadata.filter(**{'%s__gt' % self.counter: 0})
+        metadata.update(**{self.counter: F(self.counter) + delta})
+
+    def remember(self, sender, instance, update_fields=None, **kwargs):
+        if instance.pk is None:
+            previous = None
+        elif update_fields is not None and \
+                self.field_name not in update_fields:
+            previous = instance.__dict__.get(self.attname)
+        else:
+            previous = self.model._base_manager.filter(
+                pk=instance.pk).values_list(self.attname, flat=True).first()
+        instance.__dict__[self.saved_attname] = previous
+
+    def saved(self, sender, instance, created, **kwargs):
+        previous = instance.__dict__.pop(self.saved_attname, None)
+        current = instance.__dict__.get(self.attname)
+        if previous != current:
+            self._add(previous, -1)
+            self._add(current, 1)
+
+    def deleted(self, sender, instance, **kwargs):
+        # deferred fields are not loaded
+        self._add(instance.__dict__.get(self.attname), -1)
+
+    def connect(self, uid):
+        pre_save.connect(self.remember, sender=self.model, weak=False,
+                         dispatch_uid='cms_templates_remember_%s' % uid)
+        post_save.connect(self.saved, sender=self.model, weak=False,
+                          dispatch_uid='cms_templates_count_saved_%s' % uid)
+        post_delete.connect(self.deleted, sender=self.model, weak=False,
+                            dispatch_uid='cms_templates_count_deleted_%s' % uid)
+
+
+def _remember_dependencies(sender, instance, **kwargs):
+    instance._cms_templates_dependencies = list(
+        instance.dependencies.values_list('name', flat=True))
+
+
+def _update_dependencies_counts(sender, instance, **kwargs):
+    update_dependent_counts(
+        getattr(instance, '_cms_templates_dependencies', []))
+
+
+def connect_counter_signals():
+    _ReferenceCounter(Page, 'template', 'template__name',
+                      'page_count').connect('page')
+    for plugin in get_plugin_metadata():
+        field = plugin.model._meta.get_field(plugin.field_name)
+        lookup = ('template__name' if field.attname == field.name
+                  else 'template')
+        _ReferenceCounter(plugin.model, plugin.field_name, lookup,
+                          'plugin_count').connect(plugin.plugin_name)
+    pre_delete.connect(_remember_dependencies, sender=Template,
+                       dispatch_uid='cms_templates_remember_dependencies')
+    post_delete.connect(_update_dependencies_counts, sender=Template,
+                        dispatch_uid='cms_templates_count_dependencies')
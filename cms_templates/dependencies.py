@@ -0,0 +1,122 @@
+from django.db import transaction
+from django.template import Template as _Template
+
+from dbtemplates.models import Template
+from cms_templates.models import (TemplateDependency, TemplateMetadata,
+                                  get_content_digest)
+from cms_templates.counters import (update_dependent_counts,
+                                    rebuild_template_counters)
+from cms_templates.recursive_validator import get_called_templates
+from cms_templates.template_analyzer import get_templates_referenced, _chunks
+
+
+def extract_dependencies(name, content):
+    """
+    Returns the names of the templates used directly by template `name`.
+    Templates with syntax errors fall back to a token level scan.
+    """
+    try:
+        used = get_templates_referenced(_Template(content).nodelist)
+    except Exception:
+        try:
+            used = [callee for callee, command, caller
+                    in get_called_templates(content, name)
+                    if command != 'ssi']
+        except Exception:
+            used = []
+    return set(used) - set([name])
+
+
+def update_template_dependencies(template):
+    """
+    Updates the dependencies of `template` unless its content did not
+    change since they were extracted. Returns whether they were updated.
+    """
+    digest = get_content_digest(template.content)
+    metadata = TemplateMetadata.objects.filter(template=template)
+    if digest in metadata.values_list('content_digest', flat=True):
+        return False
+    names = extract_dependencies(template.name, template.content)
+    dependencies = TemplateDependency.objects.filter(template=template)
+    with transaction.atomic():
+        previous_names = set(dependencies.values_list('name', flat=True))
+        dependencies.delete()
+        TemplateDependency.objects.bulk_create([
+            TemplateDependency(template_id=template.pk, name=name)
+            for name in names])
+        update_dependent_counts(names ^ previous_names)
+        if not metadata.update(content_digest=digest):
+            TemplateMetadata.objects.create(
+                template_id=template.pk, content_digest=digest)
+            rebuild_template_counters(Template.objects.filter(pk=template.pk))
+    return True
+
+
+def rebuild_template_dependencies(queryset=None):
+    """
+    Rebuilds the reverse-dependency index, the content digests and the
+    usage counters of the templates in `queryset` (all templates by
+    default). Returns the number of index entries created.
+    """
+    if queryset is None:
+        queryset = Template.objects.all()
+    entries = []
+    digests = []
+    template_ids = []
+    for pk, name, content in queryset.values_list(
+            'pk', 'name', 'content').iterator():
+        template_ids.append(pk)
+        entries.extend(TemplateDependency(template_id=pk, name=used)
+                       for used in extract_dependencies(name, content))
+        digests.append(TemplateMetadata(
+            template_id=pk, content_digest=get_content_digest(content)))
+    with transaction.atomic():
+        for chunk in _chunks(template_ids):
+            TemplateDependency.objects.filter(template__in=chunk).delete()
+            TemplateMetadata.objects.filter(template__in=chunk).delete()
+        TemplateDependency.objects.bulk_create(entries, batch_size=500)
+        TemplateMetadata.objects.bulk_create(digests, batch_size=500)
+        rebuild_template_counters(queryset)
+    return len(entries)
+
+
+def get_dependent_names(template_names, transitive=False, using=None):
+    """
+    Returns the names of the templates that use any of `template_names`.
+    With `transitive` set, templates that use them indirectly (through
+    other templates) are returned too.
+    """
+    template_names = set(template_names)
+    found = set()
+    to_visit = set(template_names)
+    while to_visit:
+        callers = set()
+        for chunk in _chunks(to_visit):
+            callers.update(TemplateDependency.objects.using(using).filter(
+                name__in=chunk).values_list('template__name', flat=True))
+        to_visit = callers - found - template_names
+        found |= callers
+        if not transitive:
+            break
+    return found - template_names
+
+
+def get_used_names(template_names, transitive=False):
+    """
+    Returns the names of the templates used by any of `template_names`.
+    With `transitive` set, templates used indirectly (through other
+    templates) are returned too.
+    """
+    template_names = set(template_names)
+    found = set()
+    to_visit = set(template_names)
+    while to_visit:
+        used = set()
+        for chunk in _chunks(to_visit):
+            used.update(TemplateDependency.objects.filter(
+                template__name__in=chunk).values_list('name', flat=True))
+        to_visit = used - found - template_names
+        found |= used
+        if not transitive:
+            break
+    return found
@@ -0,0 +1,110 @@
+from django.template.base import (Template as _Template, TemplateSyntaxError,
+                                  TemplateDoesNotExist)
+
+from dbtemplates.models import Template
+from cms_templates.template_analyzer import (get_templates_referenced,
+                                             DBTemplateSource, _get_nodelist,
+                                             _chunks, get_validation_engine)
+
+
+class TemplateDependencyGraph(object):
+    """
+    Template dependency graph built lazily from the templates used
+    directly by each template. Every template is compiled at most once and
+    only the names it uses (its edges) are kept, the compiled template is
+    released as soon as they are extracted. The set of templates used by a
+    template (its closure) is computed from the edges already extracted,
+    so templates that share dependencies can be analyzed in one pass.
+
+    Templates are resolved through `source` (a DBTemplateSource or an
+    Engine); the loader chain of the validation engine is used by default.
+    """
+
+    def __init__(self, source=None):
+        if source is None:
+            source = get_validation_engine()
+        self.source = source
+        self.engine = source.engine if isinstance(
+            source, DBTemplateSource) else source
+        self._contents = {}
+        self._edges = {}
+        self._closures = {}
+
+    def add_templates(self, names):
+        """
+        Fetches the content of the db templates `names` in bulk.
+        Returns the names of the templates that exist.
+        """
+        found = set()
+        to_fetch = set(names) - set(self._contents)
+        for chunk in _chunks(to_fetch):
+            for name, content in Template.objects.filter(
+                    name__in=chunk).values_list('name', 'content'):
+                self.add_content(name, content)
+                found.add(name)
+        return found | (set(names) & set(self._contents))
+
+    def has_template(self, name):
+        """Whether the db template `name` was added to the graph."""
+        return name in self._contents
+
+    def add_content(self, name, content):
+        self._contents[name] = content
+        if isinstance(self.source, DBTemplateSource):
+            self.source.add_content(name, content)
+
+    def _compile(self, name):
+        content = self._contents.get(name)
+        if content is None and isinstance(self.source, DBTemplateSource):
+            # not compiled through the source, which would keep it
+            content = self.source.get_content(name)
+        if content is not None:
+            return _Template(content, name=name, engine=self.engine)
+        return self.source.get_template(name)
+
+    def set_edges(self, name, edges):
+        """
+        Sets the names of the templates used directly by template `name`, or
+        the exception raised when compiling it, computed outside the graph.
+        """
+        if not isinstance(edges, Exception):
+            edges = frozenset(edges)
+        self._edges[name] = edges
+
+    def get_edges(self, name):
+        """
+        Returns the names of the templates used directly by template `name`.
+        Raises TemplateSyntaxError or TemplateDoesNotExist if the template
+        can't be compiled.
+        """
+        if name not in self._edges:
+            try:
+                self._edges[name] = frozenset(get_templates_referenced(
+                    _get_nodelist(self._compile(name))))
+            except (TemplateSyntaxError, TemplateDoesNotExist) as e:
+                self._edges[name] = e
+        edges = self._edges[name]
+        if isinstance(edges, Exception):
+            raise edges
+        return edges
+
+    def get_closure(self, name):
+        """
+        Returns the names of all the templates used by template `name`,
+        directly or through other templates. Raises TemplateSyntaxError or
+        TemplateDoesNotExist if any of them can't be compiled.
+        """
+        if name not in self._closures:
+            found = set()
+            to_visit = list(self.get_edges(name))
+            while to_visit:
+                used = to_visit.pop()
+                if used in found:
+                    continue
+                found.add(used)
+                if used in self._closures:
+                    found |= self._closures[used]
+                else:
+                    to_visit.extend(self.get_edges(used))
+            self._closures[name] = frozenset(found)
+        return self._closures[name]
@@ -0,0 +1,120 @@
+from collections import defaultdict
+
+from django.contrib.sites.models import Site
+from django.db.models import Count
+from django.template.base import (Template as _Template, TemplateSyntaxError,
+                                  TemplateDoesNotExist)
+from django.utils.encoding import force_text
+from cms.models import Page
+from dbtemplates.models import Template
+
+from cms_templates.dependencies import (extract_dependencies,
+                                        get_dependent_names, get_used_names)
+from cms_templates.inheritance import filter_pages_using
+from cms_templates.plugins import get_plugin_template_references
+from cms_templates.template_analyzer import get_validation_engine, _chunks
+
+
+def _get_syntax_error(content):
+    try:
+        _Template(content, engine=get_validation_engine())
+    except TemplateSyntaxError as e:
+        return force_text(e)
+    return None
+
+
+def _get_missing(names, existing):
+    missing = set()
+    for name in names - existing:
+        # templates that are not stored in the db may be found by the loaders
+        try:
+            get_validation_engine().get_template(name)
+        except TemplateDoesNotExist:
+            missing.add(name)
+    return missing
+
+
+def _get_page_counts(template_names):
+    counts = defaultdict(int)
+    for chunk in _chunks(template_names):
+        for usage in filter_pages_using(Page.objects.all(), chunk).values(
+                'site').annotate(count=Count('id')).order_by():
+            counts[usage['site']] += usage['count']
+    return counts
+
+
+def _get_assigned(template_names, site_ids=None):
+    """
+    Returns {site_id: set(names)} of the given templates assigned to the
+    sites `site_ids` (all the sites by default).
+    """
+    assigned = defaultdict(set)
+    for chunk in _chunks(template_names):
+        for site_id, name in Template.sites.through.objects.filter(
+                template__name__in=chunk).values_list(
+                'site', 'template__name'):
+            # the sites are filtered here, they may not fit in the query
+            if site_ids is None or site_id in site_ids:
+                assigned[site_id].add(name)
+    return assigned
+
+
+def get_template_change_impact(template, content):
+    """
+    Returns the impact of changing the content of `template` to `content`:
+        * added, removed: the templates that the new content starts and
+        stops using directly
+        * syntax_error: the syntax error of the new content or None
+        * infinite_recursivity: whether the new content creates a cycle
+        * missing: the templates used by the new content that do not exist
+        * affected_templates: the templates that use `template`, directly or
+        through other templates, and are rendered with the new content
+        * sites: for each site with pages, plugins or templates that render
+        the new content, the number of such pages and plugins and the
+        templates used by the new content that are not assigned to it
+
+    The templates used are found through the dependency index, so only
+    the new content is compiled.
+    """
+    old_edges = set(template.dependencies.values_list('name', flat=True))
+    new_edges = extract_dependencies(template.name, content)
+    used = new_edges | get_used_names(new_edges, transitive=True)
+    existing = set()
+    for chunk in _chunks(used):
+        existing.update(Template.objects.filter(name__in=chunk)
+                        .values_list('name', flat=True))
+
+    affected = get_dependent_names([template.name], transitive=True)
+    rendered = affected | set([template.name])
+    page_counts = _get_page_counts(rendered)
+    site_ids = set(page_counts) | set(_get_assigned(rendered))
+    plugin_counts = defaultdict(int)
+    for site_id, references in get_plugin_template_references(
+            site_ids).iteritems():
+        plugin_counts[site_id] = len([
+            name for name, plugin, page_id in references if name in rendered])
+    used_assigned = _get_assigned(existing, site_ids)
+
+    domains = []
+    for chunk in _chunks(site_ids):
+        domains.extend(Site.objects.filter(id__in=chunk).values_list(
+            'id', 'domain'))
+    sites = []
+    for site_id, domain in sorted(domains, key=lambda site: site[1]):
+        sites.append({
+            'site': domain,
+            'pages': page_counts[site_id],
+            'plugins': plugin_counts[site_id],
+            'unassigned': sorted(existing - used_assigned[site_id]),
+        })
+
+    return {
+        'template': template.name,
+        'added': sorted(new_edges - old_edges),
+        'removed': sorted(old_edges - new_edges),
+        'syntax_error': _get_syntax_error(content),
+        'infinite_recursivity': template.name in used,
+        'missing': sorted(_get_missing(used, existing)),
+        'affected_templates': sorted(affected),
+        'sites': sites,
+    }
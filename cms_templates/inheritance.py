@@ -0,0 +1,147 @@
+from collections import defaultdict
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+from django.db.models.signals import pre_save, post_save
+from cms.models import Page
+
+from cms_templates.models import InheritedTemplate
+from cms_templates.template_analyzer import _chunks
+
+_SAVED_POSITION = '_cms_templates_saved_position'
+
+
+def _inherit():
+    return settings.CMS_TEMPLATE_INHERITANCE_MAGIC
+
+
+def filter_pages_using(pages, names):
+    """
+    Filters the pages from `pages` whose template is one of `names`,
+    either directly or inherited from an ancestor.
+    """
+    names = list(names)
+    return pages.filter(Q(template__in=names) | Q(
+        template=_inherit(), cms_inherited_template__template__in=names))
+
+
+def get_effective_templates(pages, *fields):
+    """
+    Returns (effective template, *fields) for each page from `pages`. The
+    effective template of a page that inherits is its ancestor's template,
+    or an empty string if no ancestor has one.
+    """
+    inherit = _inherit()
+    for row in pages.values_list(
+            'template', 'cms_inherited_template__template',
+            *fields).iterator():
+        template, inherited = row[:2]
+        if template == inherit:
+            template = inherited or ''
+        yield (template,) + row[2:]
+
+
+def _compute_inherited(pages, inherited=''):
+    """
+    Returns {page id: effective template} for the pages that inherit from
+    `pages`, (id, parent id, template) tuples ordered so that parents come
+    before their children. Pages whose parent is not in `pages` inherit
+    `inherited`.
+    """
+    inherit = _inherit()
+    effective, result = {}, {}
+    for page_id, parent_id, template in pages:
+        if template == inherit:
+            template = result[page_id] = effective.get(parent_id, inherited)
+        effective[page_id] = template
+    return result
+
+
+def _store_inherited(computed, existing):
+    """
+    Saves the `computed` {page id: template} that differ from `existing`
+    and deletes the rows of the `existing` pages that no longer inherit.
+    """
+    changed = defaultdict(list)
+    for page_id, template in computed.iteritems():
+        if page_id in existing and existing[page_id] != template:
+            changed[template].append(page_id)
+    with transaction.atomic():
+        stale = [page_id for page_id in existing if page_id not in computed]
+        for chunk in _chunks(stale):
+            InheritedTemplate.objects.filter(page__in=chunk).delete()
+        for template, page_ids in changed.iteritems():
+            for chunk in _chunks(page_ids):
+                InheritedTemplate.objects.filter(page__in=chunk).update(
+                    template=template)
+        InheritedTemplate.objects.bulk_create(
+            InheritedTemplate(page_id=page_id, template=template)
+            for page_id, template in computed.iteritems()
+            if page_id not in existing)
+
+
+def update_inherited_templates(page):
+    """
+    Recomputes the effective templates of `page` and its descendants that
+    inherit their template.
+    """
+    inherited = ''
+    if page.template == _inherit() and page.parent_id is not None:
+        inherited = page.get_ancestors(ascending=True).exclude(
+            template=_inherit()).values_list('template', flat=True).first()
+    subtree = page.get_descendants(include_self=True)
+    computed = _compute_inherited(
+        subtree.order_by('lft').values_list('id', 'parent', 'template'),
+        inherited or '')
+    existing = dict(InheritedTemplate.objects.filter(
+        page__tree_id=page.tree_id, page__lft__gte=page.lft,
+        page__rght__lte=page.rght).values_list('page', 'template'))
+    _store_inherited(computed, existing)
+
+
+def rebuild_inherited_templates():
+    """
+    Recomputes the effective templates of all the pages that inherit their
+    template. Returns the number of pages that inherit.
+    """
+    computed = _compute_inherited(Page.objects.order_by(
+        'tree_id', 'lft').values_list('id', 'parent', 'template').iterator())
+    existing = dict(InheritedTemplate.objects.values_list('page', 'template'))
+    _store_inherited(computed, existing)
+    return len(computed)
+
+
+def _get_position(page):
+    # deferred fields are not loaded
+    return tuple(page.__dict__.get(attname)
+                 for attname in ('template', 'parent_id', 'tree_id'))
+
+
+def _remember_position(sender, instance, **kwargs):
+    # read right before the save, so loading pages costs nothing
+    position = None
+    if instance.pk is not None:
+        position = Page._base_manager.filter(pk=instance.pk).values_list(
+            'template', 'parent', 'tree_id').first()
+    instance.__dict__[_SAVED_POSITION] = position
+
+
+def _page_saved(sender, instance, created, **kwargs):
+    saved = instance.__dict__.pop(_SAVED_POSITION, None)
+    if created or _get_position(instance) != saved:
+        update_inherited_templates(instance)
+
+
+def _page_moved(sender, instance, **kwargs):
+    update_inherited_templates(instance)
+
+
+def connect_inheritance_signals():
+    from cms.signals import page_moved
+    pre_save.connect(_remember_position, sender=Page,
+                     dispatch_uid='cms_templates_remember_position')
+    post_save.connect(_page_saved, sender=Page,
+                      dispatch_uid='cms_templates_inherited_templates')
+    page_moved.connect(_page_moved, sender=Page,
+                       dispatch_uid='cms_templates_page_moved')
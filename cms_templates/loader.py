@@ -1,9 +1,35 @@
+from django.contrib.sites.models import Site
+from django.db import DEFAULT_DB_ALIAS
 from dbtemplates.loader import Loader
+from dbtemplates.models import Template
+
+from cms_templates.releases import get_live_release_id, get_released_content
+from cms_templates.routing import get_read_alias
 
 
 class CmsTemplatesLoader(Loader):
 
+    def load_template_source(self, template_name, template_dirs=None):
+        # sites with a live release are served the templates of the release
+        release_id = get_live_release_id(Site.objects.get_current().pk)
+        if release_id is not None:
+            content = get_released_content(release_id, template_name)
+            if content is not None:
+                return content, 'cms_templates:release:%s:%s' % (
+                    release_id, template_name)
+        return super(CmsTemplatesLoader, self).load_template_source(
+            template_name, template_dirs)
+
     def load_and_store_template(self, template_name, cache_key, site, **params):
         params.pop('sites__in', None)
-        return super(CmsTemplatesLoader, self).load_and_store_template(
-                template_name, cache_key, site, **params)
+        using = get_read_alias()
+        if using == DEFAULT_DB_ALIAS:
+            return super(CmsTemplatesLoader, self).load_and_store_template(
+                    template_name, cache_key, site, **params)
+        # the replica may lag behind, so what it returns is not stored in
+        #   the template cache shared with the other processes
+        template = Template.objects.using(using).get(
+            name__exact=template_name, **params)
+        display_name = 'dbtemplates:%s:%s:%s' % (
+            using, template_name, site.domain)
+        return template.content, display_name
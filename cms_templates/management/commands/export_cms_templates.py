@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand
+
+from cms_templates.transfer import export_templates
+
+
+class Command(BaseCommand):
+    help = ('Writes the templates, with their content and the domains of '
+            'their sites, as JSON Lines.')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'names', nargs='*',
+            help='Names of the templates to export (all by default).')
+        parser.add_argument(
+            '--output', default=None,
+            help='File the templates are written to (stdout by default).')
+
+    def handle(self, *args, **options):
+        names = options['names'] or None
+        if not options['output']:
+            export_templates(self.stdout, names)
+            return
+        with open(options['output'], 'w') as output:
+            count = export_templates(output, names)
+        self.stdout.write('Exported %d templates.' % count)
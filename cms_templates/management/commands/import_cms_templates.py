@@ -0,0 +1,43 @@
+import json
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from cms_templates.transfer import (read_templates, validate_import,
+                                    import_templates)
+
+
+class Command(BaseCommand):
+    help = ('Creates or updates the templates written by '
+            'export_cms_templates. The templates are validated together '
+            'and nothing is imported if any of them is invalid.')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'input', help='JSON Lines file to import ("-" for stdin).')
+        parser.add_argument(
+            '--dry-run', action='store_true', default=False,
+            help='Only validate the templates.')
+
+    def handle(self, *args, **options):
+        try:
+            if options['input'] == '-':
+                templates = read_templates(sys.stdin)
+            else:
+                with open(options['input']) as stream:
+                    templates = read_templates(stream)
+        except (IOError, ValueError) as e:
+            raise CommandError(str(e))
+
+        errors = validate_import(templates)
+        if errors:
+            for error in errors:
+                self.stderr.write(json.dumps(error, sort_keys=True))
+            raise CommandError('Found %d errors in %d templates, nothing '
+                               'was imported.' % (len(errors), len(templates)))
+        if options['dry_run']:
+            self.stdout.write('%d templates are valid.' % len(templates))
+            return
+        created, updated = import_templates(templates)
+        self.stdout.write('Created %d and updated %d of %d templates.' % (
+            created, updated, len(templates)))
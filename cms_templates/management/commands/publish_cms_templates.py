@@ -0,0 +1,44 @@
+from collections import defaultdict
+
+from django.contrib.sites.models import Site
+from django.core.management.base import BaseCommand, CommandError
+
+from cms_templates.releases import publish_release, rollback_release
+
+
+class Command(BaseCommand):
+    help = ('Publishes the current templates of a group of sites as a new '
+            'release, or rolls the sites back to their previous release.')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'domains', nargs='+', help='Domains of the sites.')
+        parser.add_argument(
+            '--comment', default='', help='Description of the release.')
+        parser.add_argument(
+            '--rollback', action='store_true', default=False,
+            help='Make the previous release live again.')
+
+    def handle(self, *args, **options):
+        domains = options['domains']
+        sites = list(Site.objects.filter(domain__in=domains).order_by('domain'))
+        missing = set(domains) - set(site.domain for site in sites)
+        if missing:
+            raise CommandError('Sites not found: %s' % ', '.join(
+                sorted(missing)))
+
+        if options['rollback']:
+            rolled_back = rollback_release(sites)
+            if not rolled_back:
+                raise CommandError('There is no previous release.')
+            counts = defaultdict(int)
+            for release in rolled_back.itervalues():
+                counts[release.pk] += 1
+            for release_id, count in sorted(counts.items()):
+                self.stdout.write('Release %d is live again for %d sites.' % (
+                    release_id, count))
+            return
+        release = publish_release(sites, options['comment'])
+        self.stdout.write('Published release %d with %d templates for %d '
+                          'sites.' % (release.pk, release.templates.count(),
+                                      len(sites)))
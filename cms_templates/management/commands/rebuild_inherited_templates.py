@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+
+from cms_templates.inheritance import rebuild_inherited_templates
+
+
+class Command(BaseCommand):
+    help = ('Recomputes the effective template of the pages that inherit '
+            'the template of an ancestor.')
+
+    def handle(self, *args, **options):
+        pages = rebuild_inherited_templates()
+        self.stdout.write('Updated the effective templates of %d pages.' %
+                          pages)
@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+
+from cms_templates.counters import rebuild_template_counters
+
+
+class Command(BaseCommand):
+    help = ('Recounts the pages, templates and plugins that use each '
+            'template.')
+
+    def handle(self, *args, **options):
+        templates = rebuild_template_counters()
+        self.stdout.write('Updated the usage counters of %d templates.' %
+                          templates)
@@ -0,0 +1,12 @@
+from django.core.management.base import BaseCommand
+
+from cms_templates.dependencies import rebuild_template_dependencies
+
+
+class Command(BaseCommand):
+    help = ('Rebuilds the reverse-dependency index used to find the '
+            'templates that use a template.')
+
+    def handle(self, *args, **options):
+        entries = rebuild_template_dependencies()
+        self.stdout.write('Indexed %d template dependencies.' % entries)
@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+
+from cms_templates.search import get_search_backend
+
+
+class Command(BaseCommand):
+    help = ('Creates the index used to search the content of the templates '
+            '(an FTS5 table with SQLite, a trigram index with PostgreSQL).')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--database', default=None,
+            help='Database to index (the one templates are written to by '
+                 'default).')
+
+    def handle(self, *args, **options):
+        backend = get_search_backend(options['database'])
+        backend.create_index()
+        self.stdout.write('Created the template search index with %s.' %
+                          backend.__class__.__name__)
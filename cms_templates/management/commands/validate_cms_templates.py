@@ -0,0 +1,41 @@
+import json
+
+from django.core.management.base import BaseCommand
+
+from cms_templates.validation import validate_templates
+
+
+class Command(BaseCommand):
+    help = ('Checks that all templates compile, have no cycles or missing '
+            'dependencies and that the templates used by each site are '
+            'assigned to it. Writes a JSON report.')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--processes', type=int, default=None,
+            help='Number of worker processes (one per CPU by default).')
+        parser.add_argument(
+            '--edges-only', action='store_true', dest='edges_only',
+            default=None,
+            help='Keep only the names of the templates used by each '
+                 'template in this process, as with '
+                 'DBTEMPLATES_EDGES_ONLY_ANALYSIS.')
+        parser.add_argument(
+            '--output', default=None,
+            help='File the JSON report is written to (stdout by default).')
+
+    def handle(self, *args, **options):
+        report = validate_templates(processes=options['processes'],
+                                    edges_only=options['edges_only'])
+        output = json.dumps(report, indent=2, sort_keys=True)
+        if not options['output']:
+            self.stdout.write(output)
+            return
+        with open(options['output'], 'w') as report_file:
+            report_file.write(output)
+        self.stdout.write(
+            'Found %d errors in %d templates and %d sites. Peak memory: '
+            '%s KB (workers: %s KB).' % (
+                len(report['errors']), report['templates'], report['sites'],
+                report['peak_memory']['process'],
+                report['peak_memory']['workers']))
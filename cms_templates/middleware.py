@@ -1,10 +1,15 @@
 import logging
+import threading
+import uuid
 
 from django.conf import settings
 from django.http import Http404
 from django.core.urlresolvers import resolve
 from django.core.exceptions import ImproperlyConfigured
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS
 from django.db.models import Q
+from django.db.models.signals import post_save, post_delete, m2m_changed
 from djangotoolbox.utils import make_tls_property
 from djangotoolbox.sites.dynamicsite import DynamicSiteIDMiddleware
 from django.contrib.sites.models import Site
@@ -14,6 +19,11 @@ from importlib import import_module
 from dbtemplates.models import Template
 from cms.models import Page
 from settings import include_orphan
+from cms_templates import settings as cms_templates_settings
+from cms_templates.models import ReleasedTemplate, LiveRelease
+from cms_templates.releases import get_live_release_id, get_released_names
+from cms_templates.profiling import profiled
+from cms_templates.routing import get_read_alias
 from django.core.exceptions import PermissionDenied
 
 logger = logging.getLogger(__name__)
@@ -39,6 +49,74 @@ def get_user_allowed_sites(user):
     return list(get_user_sites_queryset(user).values_list('id', flat=True))
 
 
+_EMPTY_CHOICES = (('dummy', 'Please create a template first.'),)
+_GENERATION_KEY = 'cms_templates:templates_generation'
+_MAX_CACHED_SITES = 1000
+
+# {(site_id, generation): choices tuple}, shared by the requests of a process
+_site_choices = {}
+_site_choices_lock = threading.Lock()
+
+
+def get_templates_generation():
+    """
+    Returns the current generation of the template sets: it changes
+    whenever a template is created, deleted or (un)assigned to a site,
+    and when it expires so processes that don't share the cache catch up.
+    """
+    generation = cache.get(_GENERATION_KEY)
+    if generation is None:
+        cache.add(_GENERATION_KEY, uuid.uuid4().hex,
+                  cms_templates_settings.generation_timeout)
+        # without a cache (e.g. the dummy cache) every call is a generation
+        generation = cache.get(_GENERATION_KEY) or uuid.uuid4().hex
+    return generation
+
+
+def bump_templates_generation(*args, **kwargs):
+    cache.set(_GENERATION_KEY, uuid.uuid4().hex,
+              cms_templates_settings.generation_timeout)
+
+
+def _inheritance_choice():
+    return ((settings.CMS_TEMPLATE_INHERITANCE_MAGIC,
+             CMS_TEMPLATE_INHERITANCE_TITLE),)
+
+
+def get_site_template_choices(site_id, refresh=False):
+    """
+    Returns the CMS_TEMPLATES choices for a site as a tuple. The tuple is
+    built once per template set generation and shared by all the requests
+    for the site, so it must not be modified. With `refresh` it is built
+    again from the default database, e.g. when this process may not have
+    seen the generation change yet.
+    """
+    key = (site_id, get_templates_generation())
+    choices = None if refresh else _site_choices.get(key)
+    if choices is None:
+        release_id = get_live_release_id(site_id, refresh)
+        if release_id is not None:
+            names = get_released_names(
+                release_id, site_id, cms_templates_settings.include_orphan)
+        else:
+            names = get_site_templates(
+                site_id, DEFAULT_DB_ALIAS if refresh else None).values_list(
+                'name', flat=True)
+        choices = tuple((name, name) for name in names) or _EMPTY_CHOICES
+        choices += _inheritance_choice()
+        with _site_choices_lock:
+            if len(_site_choices) >= _MAX_CACHED_SITES:
+                _site_choices.clear()
+            _site_choices[key] = choices
+    return choices
+
+
+def _get_submitted_template(request):
+    if request.method != 'POST':
+        return None
+    return request.POST.get('template') or None
+
+
 def _set_cms_templates_for_request(request):
     '''Sets the CMS_TEMPLATES to the list of templates for the current site.
 
@@ -47,24 +125,43 @@ def _set_cms_templates_for_request(request):
     with respect to the current request.
     '''
     CMS_TEMPLATES = settings.__class__.CMS_TEMPLATES
-    CMS_TEMPLATES.value = [('dummy', 'Please create a template first.'),
-        (settings.CMS_TEMPLATE_INHERITANCE_MAGIC,
-        CMS_TEMPLATE_INHERITANCE_TITLE)
-    ]
+    CMS_TEMPLATES.value = _EMPTY_CHOICES + _inheritance_choice()
     site_id = request.session.get('cms_admin_site', settings.SITE_ID)
     try:
-        templates = get_site_templates(site_id).only('name')
+        choices = get_site_template_choices(site_id)
+        submitted = _get_submitted_template(request)
+        if submitted and submitted not in dict(choices):
+            # the template may have been created through another process
+            #   whose cache this one doesn't share
+            choices = get_site_template_choices(site_id, refresh=True)
+        CMS_TEMPLATES.value = choices
     except (Site.DoesNotExist, ImproperlyConfigured, ValueError):
         logger.error('Current site not found: %s. '
                      'It was probably deleted' % site_id)
         raise Http404
-    CMS_TEMPLATES = settings.__class__.CMS_TEMPLATES
-    CMS_TEMPLATES.value = [(templ.name, templ.name) for templ in templates]
-    if not CMS_TEMPLATES.value:
-        CMS_TEMPLATES.value = [('dummy',
-                                'Please create a template first.')]
-    CMS_TEMPLATES.value.append((settings.CMS_TEMPLATE_INHERITANCE_MAGIC,
-                                CMS_TEMPLATE_INHERITANCE_TITLE))
+
+
+def connect_generation_signals():
+    post_save.connect(_template_saved, sender=Template,
+                      dispatch_uid='cms_templates_generation_saved')
+    post_delete.connect(bump_templates_generation, sender=Template,
+                        dispatch_uid='cms_templates_generation_deleted')
+    m2m_changed.connect(bump_templates_generation,
+                        sender=Template.sites.through,
+                        dispatch_uid='cms_templates_generation_sites')
+    post_delete.connect(bump_templates_generation, sender=Site,
+                        dispatch_uid='cms_templates_generation_site_deleted')
+
+
+def _template_saved(sender, instance, created, **kwargs):
+    # template names are read only, only new templates change the sets
+    if created:
+        bump_templates_generation()
+
+
+def _describe_request(middleware, request):
+    return 'site_%s' % getattr(request, 'session', {}).get(
+        'cms_admin_site', settings.SITE_ID)
 
 
 class SiteIDPatchMiddleware(object):
@@ -75,6 +172,7 @@ class SiteIDPatchMiddleware(object):
     """
     fallback = DynamicSiteIDMiddleware()
 
+    @profiled('site_id_middleware', _describe_request)
     def process_request(self, request):
         # Use cms_admin_site session variable to guess on what site
         # the user is trying to edit stuff.
@@ -133,27 +231,50 @@ class SiteIDPatchMiddleware(object):
         return response
 
 
-def get_site_templates(site_id=None):
+def get_site_templates(site_id=None, using=None):
     """Return the list of templates defined for a given site.
 
        In case no site is specified, the current site is considered.
+       They are read from DBTEMPLATES_READ_DATABASE unless `using` is set.
     """
+    using = using or get_read_alias()
     if site_id:
-        f = Q(sites=Site.objects.get(pk=site_id))
+        f = Q(sites=Site.objects.using(using).get(pk=site_id))
     else:
         f = Q(sites=Site.objects.get_current())
-    return Template.objects.filter(f).distinct()
+    return Template.objects.using(using).filter(f).distinct()
 
 
 class DBTemplatesMiddleware(object):
+    # generation of the choices of the Page template field in this process
+    _page_choices_generation = None
+
+    @profiled('dbtemplates_middleware', _describe_request)
     def process_request(self, request):
         _set_cms_templates_for_request(request)
 
+        field = Page._meta.get_field_by_name('template')[0]
+        generation = get_templates_generation()
+        submitted = _get_submitted_template(request)
+        # a template created through a process that doesn't share the
+        #   cache of this one is not a valid choice until they are rebuilt
+        refresh = submitted is not None and submitted not in dict(
+            field.choices)
+        if (generation == DBTemplatesMiddleware._page_choices_generation and
+                not refresh):
+            return
         # This is a huge hack.
         # Expand the model choices field to contain all templates.
-        all_templates = Template.objects.all().values_list('name')
-        choices = [templates * 2 for templates in all_templates]
+        using = DEFAULT_DB_ALIAS if refresh else get_read_alias()
+        names = set(Template.objects.using(using).values_list(
+            'name', flat=True))
+        # the templates of the live releases may have been deleted since
+        live = LiveRelease.objects.using(using).values('release')
+        names.update(ReleasedTemplate.objects.using(using).filter(
+            release__in=live).values_list('name', flat=True).distinct())
+        choices = [(name, name) for name in sorted(names)]
         if settings.CMS_TEMPLATE_INHERITANCE:
             choices += [(settings.CMS_TEMPLATE_INHERITANCE_MAGIC,
                          CMS_TEMPLATE_INHERITANCE_TITLE)]
-        Page._meta.get_field_by_name('template')[0].choices[:] = choices
+        field.choices[:] = choices
+        DBTemplatesMiddleware._page_choices_generation = generation
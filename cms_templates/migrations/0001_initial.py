@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dbtemplates', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TemplateDependency',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('name', models.CharField(max_length=100, db_index=True)),
+                ('template', models.ForeignKey(related_name='dependencies', to='dbtemplates.Template')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='templatedependency',
+            unique_together=set([('template', 'name')]),
+        ),
+    ]
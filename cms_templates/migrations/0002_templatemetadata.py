@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dbtemplates', '0001_initial'),
+        ('cms_templates', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TemplateMetadata',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('content_digest', models.CharField(max_length=40)),
+                ('template', models.OneToOneField(related_name='cms_metadata', to='dbtemplates.Template')),
+            ],
+        ),
+    ]
@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+def build_dependency_index(apps, schema_editor):
+    # the index protects the templates in use, so existing installs get it
+    #   filled along with its tables
+    from cms_templates.dependencies import rebuild_template_dependencies
+    rebuild_template_dependencies()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cms', '0001_initial'),
+        ('cms_templates', '0002_templatemetadata'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='templatemetadata',
+            name='dependent_count',
+            field=models.PositiveIntegerField(default=0, db_index=True),
+        ),
+        migrations.AddField(
+            model_name='templatemetadata',
+            name='page_count',
+            field=models.PositiveIntegerField(default=0, db_index=True),
+        ),
+        migrations.AddField(
+            model_name='templatemetadata',
+            name='plugin_count',
+            field=models.PositiveIntegerField(default=0, db_index=True),
+        ),
+        migrations.RunPython(build_dependency_index,
+                             migrations.RunPython.noop),
+    ]
@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+def build_inherited_templates(apps, schema_editor):
+    from cms_templates.inheritance import rebuild_inherited_templates
+    rebuild_inherited_templates()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cms', '0001_initial'),
+        ('cms_templates', '0003_templatemetadata_counters'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='InheritedTemplate',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('template', models.CharField(db_index=True, max_length=100, blank=True)),
+                ('page', models.OneToOneField(related_name='cms_inherited_template', to='cms.Page')),
+            ],
+        ),
+        migrations.RunPython(build_inherited_templates,
+                             migrations.RunPython.noop),
+    ]
@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sites', '0001_initial'),
+        ('cms_templates', '0004_inheritedtemplate'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TemplateRelease',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('comment', models.CharField(max_length=255, blank=True)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('sites', models.ManyToManyField(related_name='cms_template_releases', to='sites.Site')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='ReleasedTemplate',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('name', models.CharField(max_length=100)),
+                ('content', models.TextField(blank=True)),
+                ('release', models.ForeignKey(related_name='templates', to='cms_templates.TemplateRelease')),
+                ('sites', models.ManyToManyField(related_name='+', to='sites.Site')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='releasedtemplate',
+            unique_together=set([('release', 'name')]),
+        ),
+        migrations.CreateModel(
+            name='LiveRelease',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('release', models.ForeignKey(related_name='+', to='cms_templates.TemplateRelease')),
+                ('site', models.OneToOneField(related_name='cms_live_release', to='sites.Site')),
+            ],
+        ),
+    ]
@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+def create_search_index(apps, schema_editor):
+    # the searches only read the FTS5 table of SQLite, so it is created
+    #   here; the trigram index of PostgreSQL needs the pg_trgm extension
+    #   and is left to rebuild_template_search_index
+    from cms_templates.search import get_search_backend, SqliteSearchBackend
+    backend = get_search_backend(schema_editor.connection.alias)
+    if isinstance(backend, SqliteSearchBackend):
+        backend.create_index()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dbtemplates', '0001_initial'),
+        ('cms_templates', '0005_template_releases'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index,
+                             migrations.RunPython.noop),
+    ]
@@ -1,2 +1,105 @@
+import hashlib
+
 from django.db import models
+from django.utils.encoding import smart_str
+from django.db.models.signals import post_save
+from django.contrib.sites.models import Site
+from cms.models import Page
+from dbtemplates.models import Template
+
+
+class TemplateDependency(models.Model):
+    """
+    Reverse-dependency index entry: `template` uses (includes, extends or
+    references through a menu tag) the template named `name`.
+    """
+    template = models.ForeignKey(Template, related_name='dependencies')
+    name = models.CharField(max_length=100, db_index=True)
+
+    class Meta:
+        unique_together = ('template', 'name')
+
+    def __unicode__(self):
+        return u'%s -> %s' % (self.template_id, self.name)
+
+
+def get_content_digest(content):
+    return hashlib.sha1(smart_str(content or '')).hexdigest()
+
+
+class TemplateMetadata(models.Model):
+    """
+    Data derived from the content of `template`, updated when the template
+    is saved with a different content, and usage counters of the template:
+    the number of pages, templates (directly) and plugins that use it.
+    """
+    template = models.OneToOneField(Template, related_name='cms_metadata')
+    content_digest = models.CharField(max_length=40)
+    page_count = models.PositiveIntegerField(default=0, db_index=True)
+    dependent_count = models.PositiveIntegerField(default=0, db_index=True)
+    plugin_count = models.PositiveIntegerField(default=0, db_index=True)
+
+    def __unicode__(self):
+        return u'%s: %s' % (self.template_id, self.content_digest)
+
+
+class InheritedTemplate(models.Model):
+    """
+    Effective template of a `page` that inherits the template of its
+    nearest ancestor: the template of that ancestor, or an empty string if
+    none of its ancestors has one. Recomputed for the whole subtree when
+    the template or the position of a page changes.
+    """
+    page = models.OneToOneField(Page, related_name='cms_inherited_template')
+    template = models.CharField(max_length=100, db_index=True, blank=True)
+
+    def __unicode__(self):
+        return u'%s: %s' % (self.page_id, self.template)
+
+
+class TemplateRelease(models.Model):
+    """
+    A published version of the templates of a group of `sites`: a
+    snapshot of the templates assigned to them (and of the orphan ones)
+    taken when the release was published.
+    """
+    sites = models.ManyToManyField(Site, related_name='cms_template_releases')
+    comment = models.CharField(max_length=255, blank=True)
+    created = models.DateTimeField(auto_now_add=True)
+
+    def __unicode__(self):
+        return u'%s (%s)' % (self.pk, self.created)
+
+
+class ReleasedTemplate(models.Model):
+    """
+    Content of template `name` in `release`. `sites` are the sites of the
+    release the template was assigned to.
+    """
+    release = models.ForeignKey(TemplateRelease, related_name='templates')
+    name = models.CharField(max_length=100)
+    content = models.TextField(blank=True)
+    sites = models.ManyToManyField(Site, related_name='+')
+
+    class Meta:
+        unique_together = ('release', 'name')
+
+    def __unicode__(self):
+        return u'%s: %s' % (self.release_id, self.name)
+
+
+class LiveRelease(models.Model):
+    """The release whose templates are served for `site`."""
+    site = models.OneToOneField(Site, related_name='cms_live_release')
+    release = models.ForeignKey(TemplateRelease, related_name='+')
+
+    def __unicode__(self):
+        return u'%s: %s' % (self.site_id, self.release_id)
+
+
+def _update_template_dependencies(sender, instance, **kwargs):
+    from cms_templates.dependencies import update_template_dependencies
+    update_template_dependencies(instance)
 
+post_save.connect(_update_template_dependencies, sender=Template,
+                  dispatch_uid='cms_templates_update_dependencies')
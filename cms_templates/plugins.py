@@ -0,0 +1,159 @@
+from collections import defaultdict, namedtuple
+
+from django.core.exceptions import ImproperlyConfigured
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.db.models import fields
+from cms.plugin_pool import plugin_pool
+
+from cms_templates import settings as cms_templates_settings
+from cms_templates.template_analyzer import _chunks, _QUERY_CHUNK_SIZE
+
+
+_VALID_TEMPLATE_FIELDS = [fields.related.ForeignKey, fields.CharField]
+
+PluginTemplateReference = namedtuple(
+    'PluginTemplateReference', 'plugin_name model field_name template_name_attr')
+
+_plugin_metadata = None
+
+
+def _get_template_name_attr(model, field_name):
+    field_type = model._meta.get_field_by_name(field_name)[0].__class__
+    is_str = field_type is fields.CharField
+    return field_name if is_str else '%s__name' % field_name
+
+
+def _load_plugin_metadata(plugin_name):
+    """
+    Validates the PLUGIN_TEMPLATE_REFERENCES entry `plugin_name` and
+    returns its PluginTemplateReference.
+    """
+    if plugin_name not in plugin_pool.plugins:
+        raise ImproperlyConfigured(
+            'setting PLUGIN_TEMPLATE_REFERENCES improperly configured: '
+            'CMS Plugin %s not found' % plugin_name)
+
+    plugin_class = plugin_pool.get_plugin(plugin_name)
+    if not hasattr(plugin_class, 'get_template_field_name'):
+        raise AttributeError(
+            'CMS plugin %s must implement \'get_template_field_name\' '
+            'staticmethod.' % plugin_name)
+
+    plugin_model = plugin_class.model
+    field_name = plugin_class.get_template_field_name()
+    if field_name not in plugin_model._meta.get_all_field_names():
+        raise fields.FieldDoesNotExist(
+            'CMS plugin %s must implement \'get_template_field_name\' '
+            'class method that returns a valid model template field '
+            'name.' % plugin_name)
+
+    field_type = plugin_model._meta.get_field_by_name(field_name)[0].__class__
+    if field_type not in _VALID_TEMPLATE_FIELDS:
+        raise AttributeError(
+            'CMS Plugin %s method \'get_template_field_name\' must return '
+            'the name of a valid template field. The template field '
+            'type must be one of: %s' % (
+                plugin_name, ','.join(field_class.__name__ for field_class
+                                      in _VALID_TEMPLATE_FIELDS)))
+
+    return PluginTemplateReference(
+        plugin_name, plugin_model, field_name,
+        _get_template_name_attr(plugin_model, field_name))
+
+
+def load_plugin_metadata():
+    """
+    Validates the PLUGIN_TEMPLATE_REFERENCES setting and computes the
+    metadata of its plugins. Plugins are discovered only once, when the
+    app is ready.
+    """
+    global _plugin_metadata
+    plugins = cms_templates_settings.PLUGIN_TEMPLATE_REFERENCES
+    if plugins:
+        # make sure all plugins are discovered
+        plugin_pool.get_all_plugins()
+    _plugin_metadata = tuple(_load_plugin_metadata(plugin_name)
+                             for plugin_name in plugins)
+    return _plugin_metadata
+
+
+def get_plugin_metadata():
+    """
+    Returns a PluginTemplateReference(plugin_name, model, field_name,
+    template_name_attr) for each plugin from PLUGIN_TEMPLATE_REFERENCES.
+    """
+    if _plugin_metadata is None:
+        return load_plugin_metadata()
+    return _plugin_metadata
+
+
+def _query_plugin_template_references(site_ids, using=DEFAULT_DB_ALIAS):
+    """
+    Returns (site id, template name, plugin name, page id) tuples for the
+    plugins from PLUGIN_TEMPLATE_REFERENCES in the pages of the given sites
+    using a UNION ALL query over all the plugin models of database `using`
+    for each chunk of sites.
+    """
+    plugins = get_plugin_metadata()
+    if not plugins or not site_ids:
+        return []
+    references = []
+    # the sites are parameters of the select of every plugin model
+    for chunk in _chunks(site_ids, max(1, _QUERY_CHUNK_SIZE // len(plugins))):
+        selects, params = [], []
+        for index, plugin in enumerate(plugins):
+            query = plugin.model.objects.using(using).filter(**{
+                'placeholder__page__site__in': chunk,
+                '%s__isnull' % plugin.field_name: False
+            }).order_by().values_list(
+                'placeholder__page__site', plugin.template_name_attr,
+                'placeholder__page').query
+            sql, query_params = query.get_compiler(using).as_sql()
+            # the plugin is identified by its index in
+            #   PLUGIN_TEMPLATE_REFERENCES
+            selects.append('SELECT %d, u%d.* FROM (%s) u%d' % (
+                index, index, sql, index))
+            params.extend(query_params)
+        cursor = connections[using].cursor()
+        cursor.execute(' UNION ALL '.join(selects), params)
+        references.extend(
+            (site_id, template, plugins[index].plugin_name, page_id)
+            for index, site_id, template, page_id in cursor.fetchall())
+    return references
+
+
+def get_plugin_template_references(site_ids):
+    """
+    Returns the templates used by plugins in the pages of the given sites:
+        {site_id: [(template_name, plugin_name, page_id), ...]}
+    They are read from the default database on every call since they are
+    used to validate changes that can't be undone.
+    """
+    references = dict((site_id, []) for site_id in site_ids)
+    rows = _query_plugin_template_references(list(references))
+    for site_id, template, plugin, page_id in rows:
+        references[site_id].append((template, plugin, page_id))
+    return references
+
+
+def get_plugin_templates_from_sites(site_ids):
+    """
+    Returns the templates used by plugins in the pages of the given sites:
+        {site_id: {template_name: set(plugin_names)}}
+    """
+    templates = defaultdict(lambda: defaultdict(set))
+    references = get_plugin_template_references(site_ids)
+    for site_id, site_references in references.iteritems():
+        for template, plugin, page_id in site_references:
+            templates[site_id][template].add(plugin)
+    return templates
+
+
+def get_plugin_templates_from_site(site):
+    return get_plugin_templates_from_sites([site.id])[site.id]
+
+
+def get_pages_for_plugins_templates(site, template_name, plugins):
+    references = get_plugin_template_references([site.id])[site.id]
+    return [page_id for template, plugin, page_id in references
+            if template == template_name and plugin in plugins]
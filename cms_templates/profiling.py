@@ -0,0 +1,106 @@
+import cProfile
+import glob
+import logging
+import os
+import random
+import re
+import sys
+import threading
+import time
+from functools import wraps
+
+try:
+    import resource
+except ImportError:
+    # not available on Windows
+    resource = None
+
+from cms_templates import settings as cms_templates_settings
+
+logger = logging.getLogger(__name__)
+
+_local = threading.local()
+
+
+def get_peak_memory(children=False):
+    """
+    Returns the peak resident memory in KB of this process, or of its
+    largest terminated child process with `children` set. Returns None
+    where it can't be measured.
+    """
+    if resource is None:
+        return None
+    usage = resource.getrusage(
+        resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF)
+    # bytes on OS X
+    if sys.platform == 'darwin':
+        return usage.ru_maxrss // 1024
+    return usage.ru_maxrss
+
+
+def _prune(directory, max_files):
+    """Deletes the oldest profiles so that at most `max_files` are kept."""
+    paths = glob.glob(os.path.join(directory, '*.pstats'))
+    if len(paths) <= max_files:
+        return
+    paths.sort(key=lambda path: os.stat(path).st_mtime)
+    for path in paths[:len(paths) - max_files]:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+def _save(profile, label, description, elapsed, memory):
+    directory = cms_templates_settings.profile_dir
+    filename = '%s-%s-%s-%dms-%dkb-%d.pstats' % (
+        label, re.sub(r'[^\w.-]+', '_', description) or 'none',
+        time.strftime('%Y%m%dT%H%M%S'), elapsed * 1000, memory, os.getpid())
+    try:
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        profile.dump_stats(os.path.join(directory, filename))
+        _prune(directory, cms_templates_settings.profile_max_files)
+    except (IOError, OSError) as e:
+        logger.warning('Could not save profile %s: %s' % (filename, e))
+
+
+def profiled(label, describe=None):
+    """
+    Profiles a sample of the calls of the decorated function when
+    DBTEMPLATES_PROFILE_DIR is set, and saves the profile of the calls
+    slower than DBTEMPLATES_PROFILE_THRESHOLD seconds as a .pstats file
+    named after `label`, `describe(*args, **kwargs)` (e.g. the ids of the
+    template and sites) and the KB the call raised the peak memory of the
+    process by. Calls made while another call of the thread is being
+    profiled are part of its profile.
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            sample_rate = cms_templates_settings.profile_sample_rate
+            if (not cms_templates_settings.profile_dir or
+                    getattr(_local, 'active', False) or
+                    random.random() >= sample_rate):
+                return func(*args, **kwargs)
+            profile = cProfile.Profile()
+            _local.active = True
+            peak_memory = get_peak_memory()
+            started = time.time()
+            try:
+                return profile.runcall(func, *args, **kwargs)
+            finally:
+                _local.active = False
+                elapsed = time.time() - started
+                if elapsed >= cms_templates_settings.profile_threshold:
+                    try:
+                        description = describe(*args, **kwargs) \
+                            if describe else ''
+                    except Exception:
+                        description = ''
+                    memory = 0
+                    if peak_memory is not None:
+                        memory = get_peak_memory() - peak_memory
+                    _save(profile, label, description, elapsed, memory)
+        return wrapper
+    return decorator
@@ -8,6 +8,8 @@ from pygraph.classes.exceptions import AdditionError
 
 from dbtemplates.models import Template
 
+from cms_templates.profiling import profiled
+
 
 class InfiniteRecursivityError(Exception):
 
@@ -17,7 +19,17 @@ class InfiniteRecursivityError(Exception):
         self.graph = graph
 
 
-def handle_recursive_calls(tpl_name, content):
+def _get_content(name, source):
+    if source is None:
+        return Template.objects.get(name=name).content
+    content = source.get_content(name)
+    if content is None:
+        raise Template.DoesNotExist
+    return content
+
+
+@profiled('recursive_calls', lambda tpl_name, *args, **kwargs: tpl_name)
+def handle_recursive_calls(tpl_name, content, source=None):
     # create the call graph as a directed graph
     call_graph = digraph()
 
@@ -26,20 +38,31 @@ def handle_recursive_calls(tpl_name, content):
     visited_templates = [(tpl_name, '', '')]
 
     call_graph.add_node(tpl_name)
+    processed = set()
     i = 0
     while i < len(visited_templates):
         name = visited_templates[i][0]
+        # a template adds the same edges every time it is called
+        if i > 0 and name in processed:
+            i += 1
+            continue
+        processed.add(name)
         try:
-            tpl_content = content if i == 0 else Template.objects.get(name=name).content
+            tpl_content = content if i == 0 else _get_content(name, source)
         except:
             i += 1
             continue
 
         called_tpls = get_called_templates(tpl_content, name)
+        if i == 0 and source is not None:
+            # fetches all the templates called, one query per level
+            source.prefetch(callee for callee, command, caller
+                            in called_tpls if command != 'ssi')
         update_call_graph(call_graph, called_tpls)
 
         #raises InfiniteRecursivityError in case of a cycle
-        cycle_test(call_graph, called_tpls)
+        if _closes_cycle(call_graph, called_tpls):
+            cycle_test(call_graph, called_tpls)
 
         visited_templates.extend(called_tpls)
         i += 1
@@ -60,6 +83,25 @@ def update_call_graph(call_graph, called_tpls):
             pass
 
 
+def _closes_cycle(call_graph, called_tpls):
+    """
+    Whether one of the calls just added to the graph closes a cycle, i.e.
+    whether its caller can be reached from its callee. Only the templates
+    reachable from the callees are visited, instead of the whole graph.
+    """
+    for callee, command, caller in called_tpls:
+        seen = set()
+        to_visit = [callee]
+        while to_visit:
+            node = to_visit.pop()
+            if node == caller:
+                return True
+            if node not in seen:
+                seen.add(node)
+                to_visit.extend(call_graph.neighbors(node))
+    return False
+
+
 def cycle_test(call_graph, called_tpls):
     # the list of nodes in case of a cycle
     cycle_items = find_cycle(call_graph)
@@ -0,0 +1,155 @@
+import hashlib
+import threading
+from collections import defaultdict
+
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Q
+from dbtemplates.models import Template
+
+from cms_templates.models import TemplateRelease, ReleasedTemplate, LiveRelease
+from cms_templates.routing import record_write
+from cms_templates.template_analyzer import _chunks
+
+# cached value of the sites and names without a live release or template
+_NONE = 0
+_MAX_CACHED_SITES = 1000
+
+# {(site_id, generation): live release id}, shared by the loads of a process
+_live_releases = {}
+_live_releases_lock = threading.Lock()
+
+
+def _content_key(release_id, name):
+    return 'cms_templates:release:%s:%s' % (
+        release_id, hashlib.sha1(name.encode('utf-8')).hexdigest())
+
+
+def get_live_release_id(site_id, refresh=False):
+    """
+    Returns the id of the live release of a site or None. It is read from
+    the default database, since a replica may not have the last publish
+    yet, and kept in the process for the current generation of the
+    template sets, which a publish or a rollback changes. With `refresh`
+    it is read again.
+    """
+    # a publish or a rollback changes the generation of the template sets
+    from cms_templates.middleware import get_templates_generation
+    key = (site_id, get_templates_generation())
+    release_id = None if refresh else _live_releases.get(key)
+    if release_id is None:
+        release_id = LiveRelease.objects.filter(site=site_id).values_list(
+            'release', flat=True).first() or _NONE
+        with _live_releases_lock:
+            if len(_live_releases) >= _MAX_CACHED_SITES:
+                _live_releases.clear()
+            _live_releases[key] = release_id
+    return release_id or None
+
+
+def get_released_content(release_id, name):
+    """
+    Returns the content of template `name` in a release, or None if the
+    template is not part of it. Releases don't change once published, so
+    their contents are read from the default database and cached for good.
+    """
+    key = _content_key(release_id, name)
+    cached = cache.get(key)
+    if cached is None:
+        # wrapped so that missing templates are cached too
+        cached = (ReleasedTemplate.objects.filter(
+            release=release_id, name=name).values_list(
+            'content', flat=True).first(),)
+        cache.set(key, cached, None)
+    return cached[0]
+
+
+def get_released_names(release_id, site_id, include_orphan=False):
+    """
+    Returns the names of the templates of a release for a site and, with
+    `include_orphan`, of the orphan templates of the release.
+    """
+    assigned = Q(sites=site_id)
+    if include_orphan:
+        assigned |= Q(sites__isnull=True)
+    return ReleasedTemplate.objects.filter(assigned, release=release_id)\
+        .distinct().order_by('name').values_list('name', flat=True)
+
+
+def _flip(site_ids, release):
+    """Makes `release` the live release of the sites."""
+    with transaction.atomic():
+        LiveRelease.objects.filter(site__in=site_ids).update(release=release)
+        existing = set(LiveRelease.objects.filter(
+            site__in=site_ids).values_list('site', flat=True))
+        LiveRelease.objects.bulk_create(
+            LiveRelease(site_id=site_id, release=release)
+            for site_id in set(site_ids) - existing)
+
+
+def _invalidate():
+    # the only invalidation of a publish or a rollback: the contents are
+    #   cached per release and the live releases per generation
+    from cms_templates.middleware import bump_templates_generation
+    bump_templates_generation()
+    record_write()
+
+
+def publish_release(sites, comment=''):
+    """
+    Publishes the current content of the templates assigned to `sites`
+    and of the orphan templates as a new release, and makes it the live
+    release of all the sites at once. Returns the release.
+    """
+    site_ids = set(site.pk for site in sites)
+    templates = Template.objects.filter(
+        Q(sites__in=site_ids) | Q(sites__isnull=True)).distinct()
+    through = ReleasedTemplate.sites.through
+    with transaction.atomic():
+        release = TemplateRelease.objects.create(comment=comment)
+        release.sites.add(*site_ids)
+        ReleasedTemplate.objects.bulk_create(
+            (ReleasedTemplate(release=release, name=name, content=content)
+             for name, content in templates.values_list(
+                'name', 'content').iterator()), batch_size=500)
+        released = dict(release.templates.values_list('name', 'pk'))
+        assignments = []
+        for chunk in _chunks(released):
+            assignments.extend(
+                through(releasedtemplate_id=released[name], site_id=site_id)
+                for name, site_id in Template.sites.through.objects.filter(
+                    template__name__in=chunk, site__in=site_ids)
+                .values_list('template__name', 'site'))
+        through.objects.bulk_create(assignments, batch_size=500)
+        _flip(site_ids, release)
+    _invalidate()
+    return release
+
+
+def rollback_release(sites):
+    """
+    Makes the release published before the live release of each of `sites`
+    its live release again. The live releases are read from the default
+    database. Returns {site id: release} for the sites rolled back; the
+    sites without a previous release are left as they are.
+    """
+    site_ids = [site.pk for site in sites]
+    through = TemplateRelease.sites.through
+    with transaction.atomic():
+        live = dict(LiveRelease.objects.filter(
+            site__in=site_ids).values_list('site', 'release'))
+        previous = {}
+        for site_id, release_id in through.objects.filter(
+                site__in=live).values_list('site', 'templaterelease'):
+            if previous.get(site_id, 0) < release_id < live[site_id]:
+                previous[site_id] = release_id
+        grouped = defaultdict(list)
+        for site_id, release_id in previous.iteritems():
+            grouped[release_id].append(site_id)
+        releases = TemplateRelease.objects.in_bulk(grouped.keys())
+        for release_id, release_site_ids in grouped.iteritems():
+            _flip(release_site_ids, releases[release_id])
+    if previous:
+        _invalidate()
+    return dict((site_id, releases[release_id])
+                for site_id, release_id in previous.iteritems())
@@ -0,0 +1,48 @@
+from django.contrib.sites.models import Site
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS
+from django.db.models.signals import post_save, post_delete, m2m_changed
+from cms.models import Page
+from dbtemplates.models import Template
+
+from cms_templates import settings as cms_templates_settings
+
+_WRITE_KEY = 'cms_templates:recent_write'
+
+
+def get_read_alias():
+    """
+    Returns the database alias used by the read only queries for template
+    usages, plugin templates and site templates: DBTEMPLATES_READ_DATABASE,
+    except during the DBTEMPLATES_READ_YOUR_WRITES_WINDOW seconds after a
+    template, page, site or plugin is written, when the default database
+    is used.
+    """
+    alias = cms_templates_settings.read_database
+    if alias == DEFAULT_DB_ALIAS:
+        return alias
+    if (cms_templates_settings.read_your_writes_window > 0 and
+            cache.get(_WRITE_KEY)):
+        return DEFAULT_DB_ALIAS
+    return alias
+
+
+def record_write(*args, **kwargs):
+    window = cms_templates_settings.read_your_writes_window
+    if (window > 0 and
+            cms_templates_settings.read_database != DEFAULT_DB_ALIAS):
+        cache.set(_WRITE_KEY, True, window)
+
+
+def connect_routing_signals():
+    from cms_templates.plugins import get_plugin_metadata
+    models = [Template, Page, Site] + [
+        plugin.model for plugin in get_plugin_metadata()]
+    for model in models:
+        uid = '%s_%s' % (model._meta.app_label, model._meta.model_name)
+        post_save.connect(record_write, sender=model,
+                          dispatch_uid='cms_templates_write_saved_%s' % uid)
+        post_delete.connect(record_write, sender=model,
+                            dispatch_uid='cms_templates_write_deleted_%s' % uid)
+    m2m_changed.connect(record_write, sender=Template.sites.through,
+                        dispatch_uid='cms_templates_write_sites')
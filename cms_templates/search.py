@@ -0,0 +1,185 @@
+import logging
+import re
+
+from django.db import connections, router, transaction, DatabaseError
+from django.db.models.signals import post_save, post_delete
+from dbtemplates.models import Template
+
+logger = logging.getLogger(__name__)
+
+_FTS_TABLE = 'cms_templates_content_fts'
+_TRIGRAM_INDEX = 'cms_templates_content_trgm'
+
+
+class LikeSearchBackend(object):
+    """
+    Content search with LIKE queries, for the databases without a full
+    text index.
+    """
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    def create_index(self):
+        pass
+
+    def filter(self, queryset, text):
+        return queryset.filter(content__icontains=text)
+
+    def update(self, template_id, content):
+        pass
+
+    def delete(self, template_id):
+        pass
+
+
+class PostgresSearchBackend(LikeSearchBackend):
+    """
+    Content search with ILIKE queries that PostgreSQL answers from a
+    trigram (pg_trgm) index on the content, created by the
+    rebuild_template_search_index command.
+    """
+
+    def filter(self, queryset, text):
+        # icontains compiles to UPPER(content) LIKE UPPER(...), which the
+        #   index on the content can't answer
+        pattern = text.replace('\\', '\\\\').replace('%', '\\%').replace(
+            '_', '\\_')
+        return queryset.extra(
+            where=['%s.%s ILIKE %%s' % (
+                self.connection.ops.quote_name(Template._meta.db_table),
+                self.connection.ops.quote_name('content'))],
+            params=['%%%s%%' % pattern])
+
+    def create_index(self):
+        cursor = self.connection.cursor()
+        cursor.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+        cursor.execute(
+            'CREATE INDEX IF NOT EXISTS %s ON %s USING gin (%s gin_trgm_ops)'
+            % (_TRIGRAM_INDEX, Template._meta.db_table,
+               self.connection.ops.quote_name('content')))
+
+
+class SqliteSearchBackend(LikeSearchBackend):
+    """
+    Content search on an SQLite FTS5 table of the template contents, kept
+    up to date when templates are saved or deleted. The table is created
+    by the migrations and the rebuild_template_search_index command; the
+    databases without it, other than the one templates are written to,
+    and the text without any word are searched with LIKE.
+    """
+
+    tokenize = "unicode61 tokenchars '-_'"
+
+    def _has_table(self):
+        cursor = self.connection.cursor()
+        cursor.execute("SELECT 1 FROM sqlite_master WHERE name = %s",
+                       [_FTS_TABLE])
+        return cursor.fetchone() is not None
+
+    def create_index(self):
+        # the searches see either the previous table or the new one
+        with transaction.atomic(using=self.connection.alias):
+            cursor = self.connection.cursor()
+            cursor.execute('DROP TABLE IF EXISTS %s' % _FTS_TABLE)
+            cursor.execute('CREATE VIRTUAL TABLE %s USING fts5(content, '
+                           'tokenize="%s")' % (_FTS_TABLE, self.tokenize))
+            cursor.execute('INSERT INTO %s (rowid, content) SELECT id, '
+                           'content FROM %s' % (
+                               _FTS_TABLE, Template._meta.db_table))
+
+    def filter(self, queryset, text):
+        # the table of the other databases would not follow the changes
+        #   of the templates, and FTS5 only matches words
+        if (not re.search(r'\w', text, re.UNICODE) or
+                self.connection.alias != router.db_for_write(Template) or
+                not self._has_table()):
+            return super(SqliteSearchBackend, self).filter(queryset, text)
+        # the text is searched as a phrase: its tokens, in order
+        return queryset.extra(
+            where=['%s.%s IN (SELECT rowid FROM %s WHERE %s MATCH %%s)' % (
+                self.connection.ops.quote_name(Template._meta.db_table),
+                self.connection.ops.quote_name(Template._meta.pk.column),
+                _FTS_TABLE, _FTS_TABLE)],
+            params=['"%s"' % text.replace('"', '""')])
+
+    def update(self, template_id, content):
+        if self._has_table():
+            self.delete(template_id)
+            self.connection.cursor().execute(
+                'INSERT INTO %s (rowid, content) VALUES (%%s, %%s)' %
+                _FTS_TABLE, [template_id, content or ''])
+
+    def delete(self, template_id):
+        if self._has_table():
+            self.connection.cursor().execute(
+                'DELETE FROM %s WHERE rowid = %%s' % _FTS_TABLE,
+                [template_id])
+
+
+def _has_fts5(connection):
+    cursor = connection.cursor()
+    try:
+        cursor.execute('PRAGMA compile_options')
+        options = set(row[0] for row in cursor.fetchall())
+    except DatabaseError:
+        return False
+    return 'ENABLE_FTS5' in options
+
+
+# {alias: backend class}; the connections are per thread, so the backends
+#   are created for each call
+_backend_classes = {}
+
+
+def get_search_backend(using=None):
+    """
+    Returns the content search backend of database `using` (the database
+    templates are written to by default): FTS5 for SQLite (when compiled
+    in), trigram indexed ILIKE for PostgreSQL and LIKE otherwise.
+    """
+    using = using or router.db_for_write(Template)
+    connection = connections[using]
+    if using not in _backend_classes:
+        if connection.vendor == 'sqlite' and _has_fts5(connection):
+            backend_class = SqliteSearchBackend
+        elif connection.vendor == 'postgresql':
+            backend_class = PostgresSearchBackend
+        else:
+            backend_class = LikeSearchBackend
+        _backend_classes[using] = backend_class
+    return _backend_classes[using](connection)
+
+
+def search_templates(queryset, text):
+    """
+    Filters the templates from `queryset` whose content contains the
+    words of `text` in order, using the content index of the database.
+    Words are delimited by punctuation other than dashes and underscores,
+    so when `text` is delimited by punctuation in the content (e.g. a
+    quoted template name or a CSS class) the result includes all the
+    templates that contain it. Text without any word (e.g. a tag delimiter)
+    is searched with LIKE.
+    """
+    return get_search_backend(queryset.db).filter(queryset, text)
+
+
+def _template_saved(sender, instance, using=None, **kwargs):
+    try:
+        get_search_backend(using).update(instance.pk, instance.content)
+    except DatabaseError as e:
+        logger.warning('Could not index template %s: %s' % (instance.pk, e))
+
+
+def _template_deleted(sender, instance, using=None, **kwargs):
+    try:
+        get_search_backend(using).delete(instance.pk)
+    except DatabaseError as e:
+        logger.warning('Could not unindex template %s: %s' % (instance.pk, e))
+
+
+def connect_search_signals():
+    post_save.connect(_template_saved, sender=Template,
+                      dispatch_uid='cms_templates_search_saved')
+    post_delete.connect(_template_deleted, sender=Template,
+                        dispatch_uid='cms_templates_search_deleted')
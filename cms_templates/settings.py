@@ -1,8 +1,27 @@
 from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS
 
 shared_sites = getattr(settings, 'DBTEMPLATES_SHARED_SITES', [])
 include_orphan = getattr(settings, 'DBTEMPLATES_INCLUDE_ORPHAN', False)
 restrict_user = getattr(settings, 'DBTEMPLATES_RESTRICT_USER', False)
+static_analysis = getattr(settings, 'DBTEMPLATES_STATIC_ANALYSIS', False)
+dependency_index = getattr(settings, 'DBTEMPLATES_DEPENDENCY_INDEX', True)
+edges_only_analysis = getattr(
+    settings, 'DBTEMPLATES_EDGES_ONLY_ANALYSIS', False)
+usage_pages_limit = getattr(settings, 'DBTEMPLATES_USAGE_PAGES_LIMIT', 20)
+error_pages_limit = getattr(settings, 'DBTEMPLATES_ERROR_PAGES_LIMIT', 20)
+site_full_validation = getattr(
+    settings, 'DBTEMPLATES_SITE_FULL_VALIDATION', False)
+validation_lock_timeout = getattr(
+    settings, 'DBTEMPLATES_VALIDATION_LOCK_TIMEOUT', 60)
+generation_timeout = getattr(settings, 'DBTEMPLATES_GENERATION_TIMEOUT', 60)
+read_database = getattr(settings, 'DBTEMPLATES_READ_DATABASE', DEFAULT_DB_ALIAS)
+read_your_writes_window = getattr(
+    settings, 'DBTEMPLATES_READ_YOUR_WRITES_WINDOW', 0)
+profile_dir = getattr(settings, 'DBTEMPLATES_PROFILE_DIR', None)
+profile_threshold = getattr(settings, 'DBTEMPLATES_PROFILE_THRESHOLD', 5)
+profile_sample_rate = getattr(settings, 'DBTEMPLATES_PROFILE_SAMPLE_RATE', 1.0)
+profile_max_files = getattr(settings, 'DBTEMPLATES_PROFILE_MAX_FILES', 100)
 
 """
    For an example on how to configure PLUGIN_TEMPLATE_REFERENCES see
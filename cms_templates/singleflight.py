@@ -0,0 +1,99 @@
+import hashlib
+import threading
+import time
+
+from django.core.cache import caches
+from django.core.cache.backends.dummy import DummyCache
+
+
+class _Call(object):
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(object):
+    """
+    Coalesces concurrent calls with the same key: one of them runs the
+    function and the others wait for it and get its result.
+
+    The threads of a process wait on an event set by the thread running
+    the function. Between processes, the call is guarded by a lock stored
+    in the default cache and the result is shared through the cache too,
+    so it has to be picklable. With a cache that is not shared (the dummy
+    cache) only the threads of a process are coalesced.
+
+    `timeout` is the number of seconds a process waits for another one
+    before running the function itself.
+    """
+
+    poll_interval = 0.05
+    result_timeout = 10
+
+    def __init__(self, prefix, timeout=60):
+        self.prefix = prefix
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, func, *args, **kwargs):
+        with self._lock:
+            call = self._calls.get(key)
+            running = call is not None
+            if not running:
+                call = self._calls[key] = _Call()
+
+        if running:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = self._do_shared(key, func, args, kwargs)
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result
+
+    def _cache_key(self, key):
+        return '%s:%s' % (self.prefix, hashlib.sha1(repr(key)).hexdigest())
+
+    def _do_shared(self, key, func, args, kwargs):
+        backend = caches['default']
+        if self.timeout <= 0 or isinstance(backend, DummyCache):
+            return func(*args, **kwargs)
+
+        cache_key = self._cache_key(key)
+        lock_key = '%s:lock' % cache_key
+        result_key = '%s:result' % cache_key
+        deadline = time.time() + self.timeout
+        while True:
+            # the result of the process that held the lock, if it is done
+            shared = backend.get(result_key)
+            if shared is not None:
+                return shared[0]
+            if backend.add(lock_key, 1, self.timeout):
+                break
+            # another process is running it
+            if time.time() > deadline:
+                return func(*args, **kwargs)
+            time.sleep(self.poll_interval)
+
+        try:
+            # it may have been shared right before the lock was released
+            shared = backend.get(result_key)
+            if shared is not None:
+                return shared[0]
+            result = func(*args, **kwargs)
+            # results are wrapped so that None can be shared too
+            backend.set(result_key, (result,), self.result_timeout)
+            return result
+        finally:
+            backend.delete(lock_key)
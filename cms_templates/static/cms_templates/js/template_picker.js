@@ -0,0 +1,71 @@
+/*
+ * Search-as-you-type picker for the select rendered by TemplatePickerWidget:
+ * the select only holds the chosen templates, the others are fetched by
+ * name from the lookup url, a page at a time.
+ */
+(function($) {
+    function initPicker(select) {
+        var url = select.data('lookup-url'),
+            search = $('<input type="text" placeholder="Search templates">'),
+            results = $('<ul class="cms-templates-picker-results"></ul>'),
+            more = $('<a href="#">More</a>').hide(),
+            query = '', page = 1, pending = null;
+
+        select.before(search, results, more);
+        select.closest('form').submit(function() {
+            // only the selected options are sent
+            select.find('option').prop('selected', true);
+        });
+        select.dblclick(function() {
+            select.find('option:selected').remove();
+        });
+
+        function load(reset) {
+            if (pending) {
+                pending.abort();
+            }
+            if (reset) {
+                page = 1;
+                results.empty();
+            }
+            pending = $.getJSON(url, {q: query, page: page}, function(data) {
+                $.each(data.results, function(i, template) {
+                    $('<li><a href="#"></a></li>').appendTo(results)
+                        .find('a').text(template.name).click(function() {
+                            if (!select.find('option[value="' + template.id + '"]').length) {
+                                $('<option selected="selected"></option>')
+                                    .val(template.id).text(template.name)
+                                    .appendTo(select);
+                            }
+                            return false;
+                        });
+                });
+                more.toggle(data.more);
+                pending = null;
+            });
+        }
+
+        var timer = null;
+        search.keyup(function() {
+            clearTimeout(timer);
+            timer = setTimeout(function() {
+                if (search.val() !== query) {
+                    query = search.val();
+                    load(true);
+                }
+            }, 250);
+        });
+        more.click(function() {
+            page += 1;
+            load(false);
+            return false;
+        });
+        load(true);
+    }
+
+    $(function() {
+        $('select.cms-templates-picker').each(function() {
+            initPicker($(this));
+        });
+    });
+})(django.jQuery);
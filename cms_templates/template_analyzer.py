@@ -1,13 +1,150 @@
+import threading
+from collections import namedtuple
+
+from django.core.signals import setting_changed
+from django.template import Engine
 from django.template.base import Template
 from django.template.context import Context
 from django.template.loader_tags import (IncludeNode,
                                          ExtendsNode, BlockNode)
 from sekizai.templatetags.sekizai_tags import RenderBlock
-from sekizai.helpers import (
-    is_variable_extend_node, _extend_blocks, FAKE_CONTEXT)
+from sekizai.helpers import is_variable_extend_node
 from django.template.base import VariableNode, NodeList, Variable
 from menus.templatetags.menu_tags import ShowMenu, ShowSubMenu, ShowBreadcrumb
-from django.template.loader import get_template
+from dbtemplates.models import Template as DBTemplate
+
+from cms_templates.recursive_validator import get_called_templates
+
+# sqlite does not allow more than 999 variables in a single query
+_QUERY_CHUNK_SIZE = 500
+
+_FakeTemplate = namedtuple('Template', 'engine')
+_FakeContext = namedtuple('Context', 'template')
+
+_validation_engine = None
+_validation_engine_lock = threading.Lock()
+
+_CACHED_LOADER = 'django.template.loaders.cached.Loader'
+
+
+def _uncached_loaders(loaders):
+    # templates being validated are edited, so their compiled versions
+    # should not be cached
+    uncached = []
+    for loader in loaders:
+        if isinstance(loader, (tuple, list)) and loader[0] == _CACHED_LOADER:
+            uncached.extend(_uncached_loaders(loader[1]))
+        else:
+            uncached.append(loader)
+    return uncached
+
+
+def get_validation_engine():
+    """
+    Returns the engine used to compile templates while validating them.
+    It is configured like the default engine but with debug enabled, so
+    the engine used to render pages is never modified.
+    """
+    global _validation_engine
+    if _validation_engine is None:
+        with _validation_engine_lock:
+            if _validation_engine is None:
+                default = Engine.get_default()
+                # default.loaders already includes the app directories loader
+                # when app_dirs is set
+                _validation_engine = Engine(
+                    dirs=default.dirs,
+                    allowed_include_roots=default.allowed_include_roots,
+                    context_processors=default.context_processors,
+                    debug=True,
+                    loaders=_uncached_loaders(default.loaders),
+                    string_if_invalid=default.string_if_invalid,
+                    file_charset=default.file_charset)
+    return _validation_engine
+
+
+def _reset_validation_engine(setting, **kwargs):
+    global _validation_engine
+    if setting in ('TEMPLATES', 'TEMPLATE_DIRS', 'TEMPLATE_LOADERS',
+                   'TEMPLATE_CONTEXT_PROCESSORS', 'TEMPLATE_STRING_IF_INVALID',
+                   'ALLOWED_INCLUDE_ROOTS', 'FILE_CHARSET'):
+        _validation_engine = None
+
+setting_changed.connect(_reset_validation_engine,
+                        dispatch_uid='cms_templates_reset_validation_engine')
+
+
+def _chunks(items, size=_QUERY_CHUNK_SIZE):
+    items = list(items)
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+class DBTemplateSource(object):
+    """
+    Resolves template names from the content stored in dbtemplates instead
+    of walking the whole loader chain. Contents are fetched in bulk, each
+    template is compiled at most once and the configured loaders are used
+    only for templates that are not stored in the database.
+
+    It provides the `get_template` method of an Engine so it can also be
+    used to resolve the parents of {% extends %} nodes.
+    """
+
+    def __init__(self, engine=None):
+        self.engine = engine or get_validation_engine()
+        self._contents = {}
+        self._compiled = {}
+
+    def add_content(self, name, content):
+        self._contents.setdefault(name, content)
+
+    def prefetch(self, names):
+        """
+        Fetches the content of the given templates and of all templates
+        they reference, one query for each level of dependencies.
+        """
+        to_fetch = set(names) - set(self._contents)
+        while to_fetch:
+            found = {}
+            for chunk in _chunks(to_fetch):
+                found.update(DBTemplate.objects.filter(name__in=chunk)
+                                .values_list('name', 'content'))
+            referenced = set()
+            for name in to_fetch:
+                content = found.get(name)
+                self._contents[name] = content
+                if content is None:
+                    continue
+                try:
+                    referenced.update(
+                        callee for callee, command, caller
+                        in get_called_templates(content, name)
+                        if command != 'ssi')
+                except Exception:
+                    # errors are reported when the template gets compiled
+                    pass
+            to_fetch = referenced - set(self._contents)
+
+    def get_content(self, name):
+        """
+        Returns the content of the db template `name` or None if there is
+        no such template.
+        """
+        if name not in self._contents:
+            self.prefetch([name])
+        return self._contents[name]
+
+    def get_template(self, name):
+        if name in self._compiled:
+            return self._compiled[name]
+        content = self.get_content(name)
+        if content is None:
+            template = self.engine.get_template(name)
+        else:
+            template = Template(content, name=name, engine=self.engine)
+        self._compiled[name] = template
+        return template
 
 
 def _get_nodelist(tpl):
@@ -17,40 +154,93 @@ def _get_nodelist(tpl):
         return tpl.nodelist
 
 
+def _get_fake_context(source):
+    if source is None:
+        source = get_validation_engine()
+    return _FakeContext(_FakeTemplate(source))
+
+
+def _load_template(template_name, source):
+    if source is None:
+        source = get_validation_engine()
+    return source.get_template(template_name)
+
+
+# modified _extend_blocks from sekizai.helpers
+def _extend_blocks(extend_node, blocks, source=None):
+    if is_variable_extend_node(extend_node):
+        return
+
+    parent = extend_node.get_parent(_get_fake_context(source))
+    for node in _get_nodelist(parent).get_nodes_by_type(BlockNode):
+        if node.name not in blocks:
+            blocks[node.name] = node
+        else:
+            # set this node as the super node (for {{ block.super }})
+            block = blocks[node.name]
+            seen_supers = []
+            while (hasattr(block.super, 'nodelist') and
+                   block.super not in seen_supers):
+                seen_supers.append(block.super)
+                block = block.super
+            block.super = node
+
+    for node in _get_nodelist(parent).get_nodes_by_type(ExtendsNode):
+        _extend_blocks(node, blocks, source)
+        break
+
+
 # modified _extend_nodelist from sekizai.helpers
-def _extend_nodelist(extend_node):
+def _extend_nodelist(extend_node, source=None):
 
     if is_variable_extend_node(extend_node):
         return []
 
     blocks = extend_node.blocks
-    _extend_blocks(extend_node, blocks)
+    _extend_blocks(extend_node, blocks, source)
 
     found = []
     for block in blocks.values():
-        found += get_all_templates_used(block.nodelist, block)
+        found += get_all_templates_used(block.nodelist, block, source=source)
 
-    parent_template = extend_node.get_parent(FAKE_CONTEXT)
+    parent_template = extend_node.get_parent(_get_fake_context(source))
     if not _get_nodelist(parent_template).get_nodes_by_type(ExtendsNode):
         found += get_all_templates_used(
-            _get_nodelist(parent_template), None)
+            _get_nodelist(parent_template), None, source=source)
     else:
         found += get_all_templates_used(
-            _get_nodelist(parent_template), extend_node)
+            _get_nodelist(parent_template), extend_node, source=source)
 
     return found
 
 
-def _scan_nodelist(subnodelist, node, block):
+def _scan_nodelist(subnodelist, node, block, source=None):
     if isinstance(subnodelist, NodeList):
         if isinstance(node, BlockNode):
             block = node
-        return get_all_templates_used(subnodelist, block), block
+        return get_all_templates_used(subnodelist, block, source=source), block
     return [], block
 
 
+def _get_menu_template_name(node):
+    menu_template_node = node.kwargs.get('template', None)
+    if menu_template_node and hasattr(menu_template_node, 'var'):
+        template = Template('', engine=get_validation_engine())
+        context = Context()
+        with context.bind_template(template):
+            return menu_template_node.var.resolve(context)
+    return None
+
+
 # modified _scan_placeholders from cms.utils.plugins
-def get_all_templates_used(nodelist, current_block=None, ignore_blocks=None):
+def get_all_templates_used(nodelist, current_block=None, ignore_blocks=None,
+                           source=None):
+    """
+    Returns the names of all the templates used by `nodelist`.
+
+    Templates are resolved through the loader chain of the validation
+    engine unless a `source` (e.g. a DBTemplateSource) is given.
+    """
     if ignore_blocks is None:
         ignore_blocks = []
 
@@ -67,58 +257,98 @@ def get_all_templates_used(nodelist, current_block=None, ignore_blocks=None):
                 if isinstance(node.template.var, Variable):
                     continue
                 else:
-                    template = get_template(node.template.var)
+                    template = _load_template(node.template.var, source)
             else:
                 template = node.template
             if not hasattr(template, 'name'):
                 template = template.template
             found.append(template.name)
-            found += get_all_templates_used(_get_nodelist(template))
+            found += get_all_templates_used(
+                _get_nodelist(template), source=source)
         elif isinstance(node, ExtendsNode):
-            template = node.get_parent(FAKE_CONTEXT)
+            template = node.get_parent(_get_fake_context(source))
             if not hasattr(template, 'name'):
                 template = template.template
             found.append(template.name)
-            found += _extend_nodelist(node)
+            found += _extend_nodelist(node, source)
             if hasattr(node, 'child_nodelists'):
                 for child_lst in node.child_nodelists:
                     _found_to_add, current_block = _scan_nodelist(
-                        getattr(node, child_lst, ''), node, current_block)
+                        getattr(node, child_lst, ''), node, current_block,
+                        source)
                     found += _found_to_add
         elif isinstance(node, RenderBlock):
-            template = Template('')
+            template = Template('', engine=get_validation_engine())
             context = Context()
             with context.bind_template(template):
                 node.kwargs['name'].resolve(context)
-            found += get_all_templates_used(node.blocks['nodelist'], node)
+            found += get_all_templates_used(
+                node.blocks['nodelist'], node, source=source)
         elif (isinstance(node, VariableNode) and current_block and
               node.filter_expression.token == 'block.super' and
               hasattr(current_block.super, 'nodelist')):
             found += get_all_templates_used(
-                _get_nodelist(current_block.super), current_block.super)
+                _get_nodelist(current_block.super), current_block.super,
+                source=source)
         elif isinstance(node, BlockNode) and node.name in ignore_blocks:
             continue
         elif (isinstance(node, ShowMenu) or isinstance(node, ShowSubMenu) or
               isinstance(node, ShowBreadcrumb)):
-            menu_template_node = node.kwargs.get('template', None)
-            if menu_template_node and hasattr(menu_template_node, 'var'):
-                template = Template('')
-                context = Context()
-                with context.bind_template(template):
-                    menu_template_name = menu_template_node.var.resolve(context)
-
-                if menu_template_name:
-                    found.append(menu_template_name)
-                    compiled_template = get_template(menu_template_name)
-                    found += get_all_templates_used(_get_nodelist(compiled_template))
+            menu_template_name = _get_menu_template_name(node)
+            if menu_template_name:
+                found.append(menu_template_name)
+                compiled_template = _load_template(
+                    menu_template_name, source)
+                found += get_all_templates_used(
+                    _get_nodelist(compiled_template), source=source)
         elif hasattr(node, 'child_nodelists'):
             for child_lst in node.child_nodelists:
                 _found_to_add, current_block = _scan_nodelist(
-                    getattr(node, child_lst, ''), node, current_block)
+                    getattr(node, child_lst, ''), node, current_block, source)
                 found += _found_to_add
         else:
             for attr in dir(node):
                 _found_to_add, current_block = _scan_nodelist(
-                    getattr(node, attr), node, current_block)
+                    getattr(node, attr), node, current_block, source)
                 found += _found_to_add
     return found
+
+
+def get_templates_referenced(nodelist):
+    """
+    Returns the names of the templates referenced directly by `nodelist`
+    through include, extends and menu tags. Unlike get_all_templates_used,
+    the referenced templates are not loaded.
+    """
+    found = []
+    for node in nodelist:
+        if isinstance(node, IncludeNode) and node.template:
+            if not callable(getattr(node.template, 'render', None)):
+                if not isinstance(node.template.var, Variable):
+                    found.append(node.template.var)
+            else:
+                template = node.template
+                if not hasattr(template, 'name'):
+                    template = template.template
+                found.append(template.name)
+        elif isinstance(node, ExtendsNode):
+            if not is_variable_extend_node(node):
+                found.append(getattr(node.parent_name, 'var', node.parent_name))
+            found += get_templates_referenced(node.nodelist)
+        elif isinstance(node, RenderBlock):
+            found += get_templates_referenced(node.blocks['nodelist'])
+        elif (isinstance(node, ShowMenu) or isinstance(node, ShowSubMenu) or
+              isinstance(node, ShowBreadcrumb)):
+            menu_template_name = _get_menu_template_name(node)
+            if menu_template_name:
+                found.append(menu_template_name)
+        else:
+            if hasattr(node, 'child_nodelists'):
+                attrs = node.child_nodelists
+            else:
+                attrs = dir(node)
+            for attr in attrs:
+                subnodelist = getattr(node, attr, None)
+                if isinstance(subnodelist, NodeList):
+                    found += get_templates_referenced(subnodelist)
+    return found
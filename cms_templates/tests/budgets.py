@@ -0,0 +1,224 @@
+"""
+Query and time budgets of the hot paths of cms_templates.
+
+Each hot path is run on datasets of 10, 100 and 1000 sites, templates,
+pages and plugins. Its number of queries may only grow by a fixed number
+of queries for each tenfold increase of the data (the chunked queries).
+The queries and timings measured are written to stderr once the budgets
+are checked. Wall clock times depend on the machine, so the time budgets
+on the largest dataset are only checked when CMS_TEMPLATES_TIME_BUDGETS
+is set. Content validation is measured with DBTEMPLATES_STATIC_ANALYSIS
+enabled, the loader chain fetches the templates one by one.
+
+Run alone, with the time budgets, with:
+    CMS_TEMPLATES_TIME_BUDGETS=1 tox -- cms_templates.tests.budgets
+"""
+import math
+import os
+import sys
+import time
+
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.contrib.sites.models import Site
+from django.core.cache import cache
+from django.db import connection
+from django.utils import timezone
+from cms.models import Page, Title, Placeholder
+from dbtemplates.models import Template
+from mock import patch
+
+from cms_templates.admin import (ExtendedTemplateAdminForm,
+                                 ExtendedSiteAdminForm, _format_pages,
+                                 get_template_usages)
+from cms_templates.impact import get_template_change_impact
+from cms_templates.middleware import get_site_template_choices
+from cms_templates.plugins import get_plugin_templates_from_sites
+from cms_templates.tests.models import PluginModelB
+
+_SIZES = (10, 100, 1000)
+
+
+class _Dataset(object):
+    """
+    `size` sites, templates, pages and plugins. Template t<i> extends the
+    base template and is assigned to site 0 and to site <i>, whose page
+    uses it directly and through a plugin. The base and shared templates
+    are assigned to all the sites.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.prefix = 'd%d-' % size
+        self.sites = [
+            Site.objects.create(domain='%ssite%d.test' % (self.prefix, i),
+                                name='%ssite%d' % (self.prefix, i))
+            for i in range(size)]
+        self.base = Template.objects.create(
+            name=self.prefix + 'base',
+            content='{% block content %}{% endblock content %}')
+        self.shared = Template.objects.create(
+            name=self.prefix + 'shared', content='shared')
+        self.templates = [
+            Template.objects.create(
+                name='%st%d' % (self.prefix, i),
+                content='{%% extends "%sbase" %%}' % self.prefix)
+            for i in range(size)]
+
+        assignments = set()
+        for template in (self.base, self.shared):
+            assignments.update((template.pk, site.pk) for site in self.sites)
+        for site, template in zip(self.sites, self.templates):
+            assignments.add((template.pk, self.sites[0].pk))
+            assignments.add((template.pk, site.pk))
+        through = Template.sites.through
+        through.objects.bulk_create(
+            [through(template_id=template_id, site_id=site_id)
+             for template_id, site_id in sorted(assignments)])
+
+        self.pages = []
+        for i, (site, template) in enumerate(zip(self.sites, self.templates)):
+            page = Page.objects.create(template=template.name, site=site)
+            Title.objects.create(page=page, language='en',
+                                 title='%spage%d' % (self.prefix, i))
+            placeholder = Placeholder.objects.create(slot='main')
+            page.placeholders.add(placeholder)
+            PluginModelB.objects.create(
+                plugin_type='PluginB', some_template_name=template.name,
+                placeholder=placeholder)
+            self.pages.append(page)
+
+
+class TestQueryBudgets(TestCase):
+
+    report = []
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.sizes = _SIZES
+        cls.datasets = dict((size, _Dataset(size)) for size in cls.sizes)
+
+    @classmethod
+    def tearDownClass(cls):
+        super(TestQueryBudgets, cls).tearDownClass()
+        lines = ['', '%-24s %6s %8s %10s' % ('hot path', 'size', 'queries',
+                                             'seconds')]
+        for label, size, queries, elapsed in cls.report:
+            lines.append('%-24s %6d %8d %10.3f' % (label, size, queries,
+                                                   elapsed))
+        sys.__stderr__.write('\n'.join(lines) + '\n')
+
+    def assertBudget(self, label, func, extra_queries=0, seconds=1):
+        """
+        Runs func(dataset) on the dataset of each size with empty caches.
+        Checks that its number of queries grows by at most `extra_queries`
+        for each tenfold increase of the data and, when the time budgets
+        are enabled, that it runs within `seconds` on the largest dataset.
+        """
+        smallest = self.sizes[0]
+        # the queries made once per process are not counted
+        func(self.datasets[smallest])
+
+        counts = {}
+        for size in self.sizes:
+            cache.clear()
+            with CaptureQueriesContext(connection) as queries:
+                started = time.time()
+                func(self.datasets[size])
+                elapsed = time.time() - started
+            counts[size] = len(queries)
+            self.report.append((label, size, counts[size], elapsed))
+
+        for size in self.sizes[1:]:
+            allowed = counts[smallest] + extra_queries * int(round(
+                math.log10(float(size) / smallest)))
+            self.assertLessEqual(counts[size], allowed, (
+                '%s made %d queries for %d items and %d for %d items '
+                '(at most %d allowed)' % (label, counts[smallest], smallest,
+                                          counts[size], size, allowed)))
+        if os.environ.get('CMS_TEMPLATES_TIME_BUDGETS'):
+            self.assertLessEqual(elapsed, seconds, (
+                '%s took %.3fs for %d items (budget %ss)' % (
+                    label, elapsed, self.sizes[-1], seconds)))
+
+    def _assert_valid_template_form(self, instance, name, content, sites):
+        now = timezone.now().strftime('%Y-%m-%d %H:%M:%S')
+        form = ExtendedTemplateAdminForm(instance=instance, data={
+            'name': name, 'content': content,
+            'sites': [site.pk for site in sites],
+            'creation_date': now, 'last_changed': now})
+        form.full_clean()
+        self.assertNotIn('__all__', form.errors)
+
+    @patch('cms_templates.settings.error_pages_limit', 5)
+    def test_format_pages(self):
+        self.assertBudget('format_pages', lambda data: _format_pages(
+            Page.objects.filter(site__domain__startswith=data.prefix)))
+
+    def test_plugin_templates(self):
+        def plugin_templates(data):
+            templates = get_plugin_templates_from_sites(
+                [site.pk for site in data.sites])
+            self.assertEqual(len(templates), data.size)
+        # the sites are chunked in the query of the plugins
+        self.assertBudget('plugin_templates', plugin_templates, 2)
+
+    def _clean_new_template(self, data):
+        content = ''.join('{%% include "%s" %%}' % template.name
+                          for template in data.templates)
+        self._assert_valid_template_form(
+            None, data.prefix + 'new', content, data.sites[:1])
+
+    @patch('cms_templates.settings.static_analysis', True)
+    def test_template_clean(self):
+        self.assertBudget('template_clean', self._clean_new_template, 2, 5)
+
+    @patch('cms_templates.settings.static_analysis', True)
+    @patch('cms_templates.settings.edges_only_analysis', True)
+    def test_template_clean_edges_only(self):
+        self.assertBudget('template_clean_edges_only',
+                          self._clean_new_template, 2, 5)
+
+    @patch('cms_templates.settings.static_analysis', True)
+    def test_template_clean_unassigning_sites(self):
+        def clean(data):
+            # the sites assigned by default to new templates are kept
+            kept = [data.sites[0]] + list(data.shared.sites.exclude(
+                domain__startswith=data.prefix))
+            self._assert_valid_template_form(
+                data.shared, data.shared.name, data.shared.content, kept)
+        self.assertBudget('template_unassign_sites', clean, 5, 5)
+
+    @patch('cms_templates.settings.static_analysis', True)
+    @patch('cms_templates.settings.site_full_validation', True)
+    def test_site_clean_templates(self):
+        def clean(data):
+            site = data.sites[0]
+            form = ExtendedSiteAdminForm(instance=site, data={
+                'domain': site.domain, 'name': site.name,
+                'templates': list(site.template_set.values_list(
+                    'id', flat=True))})
+            self.assertTrue(form.is_valid(), form.errors)
+        self.assertBudget('site_clean_templates', clean, 3, 5)
+
+    def test_template_usages(self):
+        def usages(data):
+            self.assertEqual(
+                len(get_template_usages(data.base)['child_templates']),
+                data.size)
+        self.assertBudget('template_usages', usages)
+
+    def test_site_template_choices(self):
+        def choices(data):
+            # the templates of site 0 and the inheritance choice
+            self.assertEqual(
+                len(get_site_template_choices(data.sites[0].pk)),
+                data.size + 3)
+        self.assertBudget('site_template_choices', choices)
+
+    def test_change_impact(self):
+        def impact(data):
+            result = get_template_change_impact(
+                data.base, '{%% include "%s" %%}' % data.shared.name)
+            self.assertEqual(len(result['affected_templates']), data.size)
+        self.assertBudget('change_impact', impact, 5, 5)
@@ -32,7 +32,12 @@ DATABASES = {
         'PASSWORD': '',  # Not used with sqlite3.
         'HOST': '',  # Set to empty string for localhost. Not used with sqlite3.
         'PORT': '',  # Set to empty string for default. Not used with sqlite3.
-    }
+    },
+    # stands for a read replica in the DBTEMPLATES_READ_DATABASE tests
+    'replica': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': 'test_replica.db',
+    },
 }
 MIDDLEWARE_CLASSES = (
     'django.middleware.cache.UpdateCacheMiddleware',
@@ -1,14 +1,19 @@
-from django.test import TestCase
+from django.test import TestCase, TransactionTestCase
 from dbtemplates.models import Template
 from django.contrib.sites.models import Site
 from django.contrib.auth.models import User, Group
 from django.contrib.admin.options import ModelAdmin
-from django.core.exceptions import ValidationError
+from django.core.exceptions import ValidationError, ImproperlyConfigured
 from django.test.client import RequestFactory
-from django.template import loader, Context, TemplateDoesNotExist
+from django.template import (loader, Context, TemplateDoesNotExist,
+                             Template as _Template, Engine)
 from django.core import urlresolvers
+from django.core.management import call_command
+from django.core.cache import cache
 from django.conf import settings
 from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
+from django.db import connection, connections
 from djangotoolbox.utils import make_tls_property
 from cms.models.permissionmodels import GlobalPagePermission
 from cms.models import Page, Title, Placeholder
@@ -19,15 +24,46 @@ from cms.test_utils.testcases import (CMSTestCase,
 from datetime import datetime
 from mock import patch, Mock
 from parse import parse
+from StringIO import StringIO
+import json
+import os
 import re
+import shutil
+import tempfile
+import threading
+import time
 
 from cms_templates.recursive_validator import handle_recursive_calls, \
     InfiniteRecursivityError
+from cms_templates.template_analyzer import (get_all_templates_used,
+                                             DBTemplateSource,
+                                             get_validation_engine)
 from cms_templates.tests.models import *
 from cms_templates.admin import (
     RestrictedTemplateAdmin, TemplateUsedException, get_template_usages,
-    _page_usage, _template_usage
+    get_templates_that_use_template, get_template_site_usages, _page_usage,
+    _template_usage, _format_pages, ExtendedSiteAdminForm
 )
+from cms_templates.models import (TemplateDependency, TemplateMetadata,
+                                  InheritedTemplate, get_content_digest)
+from cms_templates.plugins import (get_plugin_templates_from_site,
+                                   get_plugin_templates_from_sites,
+                                   get_plugin_metadata, load_plugin_metadata)
+from cms_templates.dependencies import rebuild_template_dependencies
+from cms_templates.impact import get_template_change_impact
+from cms_templates.inheritance import (filter_pages_using,
+                                       rebuild_inherited_templates)
+from cms_templates.singleflight import SingleFlight
+from cms_templates.middleware import (get_site_template_choices,
+                                      get_site_templates)
+from cms_templates.profiling import profiled
+from cms_templates.releases import (publish_release, rollback_release,
+                                    get_live_release_id)
+from cms_templates.routing import get_read_alias, record_write
+from cms_templates.search import (get_search_backend, search_templates,
+                                  SqliteSearchBackend)
+from cms_templates.transfer import (export_templates, read_templates,
+                                    validate_import, import_templates)
 
 
 def _fix_lang_url(url):
@@ -209,6 +245,42 @@ class AdminParentChildInheritTest(CMSTestCase):
         self.assertIsNot(Template.objects.get(name='first.html'), [])
         self.assertIsNot(Template.objects.get(name='second.html'), [])
 
+    def test_page_form_uses_shared_choices(self):
+        from django.contrib import admin
+        choices = get_site_template_choices(self.site.pk)
+        self.assertIs(choices, get_site_template_choices(self.site.pk))
+        self.assertIn(('first.html', 'first.html'), choices)
+
+        request = RequestFactory().get(URL_CMS_PAGE_ADD)
+        request.user = User.objects.get(username='page_template_test')
+        request.session = self.client.session
+        settings.__class__.CMS_TEMPLATES.value = choices
+        page_admin = admin.site._registry[Page]
+        form = page_admin.get_form(request)
+        self.assertIs(form.base_fields['template'].choices, choices)
+
+        third = Template.objects.create(name='third.html', content='third')
+        third.sites.add(self.site)
+        new_choices = get_site_template_choices(self.site.pk)
+        self.assertIsNot(new_choices, choices)
+        self.assertIn(('third.html', 'third.html'), new_choices)
+
+    def test_page_saved_with_template_unknown_to_the_process(self):
+        # the generation this process sees doesn't change when a template
+        #   is created through another one with a per process cache
+        with patch('cms_templates.middleware.get_templates_generation',
+                   return_value='stale'):
+            self.client.get(URL_CMS_PAGE_ADD)
+            third = Template.objects.create(name='third.html',
+                                            content='third')
+            third.sites.add(self.site)
+            self.assertNotIn(('third.html', 'third.html'),
+                             get_site_template_choices(self.site.pk))
+            self._create_page(template='third.html', slug='third',
+                              title='third')
+            self.assertIn(('third.html', 'third.html'),
+                          get_site_template_choices(self.site.pk))
+
     def _create_page(self, template, slug, title, parent_id=None):
         """
         Creates a page with the template, slug, title, and parent.
@@ -443,6 +515,73 @@ class TestTemplateValidation(TestCase, TestTemplateValidationBaseMixin):
                 '{% include "templC" %}'
                 '{% endaddtoblock %}'), [1], 'missing_template_use')
 
+    def test_nonexistent_template_use_static_analysis(self):
+        with patch('cms_templates.settings.static_analysis', True):
+            self.test_nonexistent_template_use()
+
+    def test_nonexistent_template_use_edges_only(self):
+        with patch('cms_templates.settings.edges_only_analysis', True):
+            self.test_nonexistent_template_use()
+
+    def test_validation_does_not_change_default_engine(self):
+        self.assertTrue(get_validation_engine().debug)
+        self.assertIsNot(get_validation_engine(), Engine.get_default())
+
+        debug_during_clean = []
+
+        def record_debug(*args, **kwargs):
+            debug_during_clean.append(Engine.get_default().debug)
+
+        with patch('cms_templates.admin.handle_recursive_calls',
+                   side_effect=record_debug):
+            self._update_template('templA', 'content', [1])
+        self.assertEqual(debug_during_clean, [Engine.get_default().debug])
+        self.assertFalse(Engine.get_default().debug)
+
+    def test_unchanged_template_is_not_revalidated(self):
+        self._update_template('templA', 'content', [1])
+        templA = Template.objects.get(name='templA')
+        with patch('cms_templates.admin.handle_recursive_calls') as validate:
+            self._update_template('templA', 'content', [1], templA.id)
+        self.assertFalse(validate.called)
+        self.assertEqual(list(templA.sites.values_list('id', flat=True)), [1])
+
+        with patch('cms_templates.admin.handle_recursive_calls') as validate:
+            self._update_template('templA', 'changed', [1], templA.id)
+        self.assertTrue(validate.called)
+
+    def test_template_picker(self):
+        for i in range(3):
+            Template.objects.create(name='picker%d' % i, content='content')
+        url = urlresolvers.reverse('admin:dbtemplates_template_lookup')
+        with patch.object(RestrictedTemplateAdmin, 'lookup_page_size', 2):
+            data = json.loads(self.client.get(url, {'q': 'picker'}).content)
+            self.assertEqual([t['name'] for t in data['results']],
+                             ['picker0', 'picker1'])
+            self.assertTrue(data['more'])
+            data = json.loads(self.client.get(
+                url, {'q': 'picker', 'page': 2}).content)
+            self.assertEqual([t['name'] for t in data['results']],
+                             ['picker2'])
+            self.assertFalse(data['more'])
+
+        site = Site.objects.create(name='picker', domain='picker.com')
+        Template.objects.get(name='picker1').sites.add(site)
+        response = self.client.get(self._site_url(site.id))
+        self.assertContains(response, '>picker1</option>')
+        self.assertNotContains(response, '>picker0</option>')
+
+    def test_template_picker_requires_change_permission(self):
+        user = User.objects.create_user(
+            username='picker_user', password='x',
+            email='picker_user@templates.com')
+        user.is_staff = True
+        user.save()
+        self.client.login(username='picker_user', password='x')
+        url = urlresolvers.reverse('admin:dbtemplates_template_lookup')
+        self.assertEqual(self.client.get(url, {'q': 'picker'}).status_code,
+                         403)
+
     def test_templates_use_sites_assigned(self):
         templA = Template.objects.create(name='templA')
         templA.content = 'content'
@@ -533,6 +672,52 @@ class TestTemplateValidation(TestCase, TestTemplateValidationBaseMixin):
         self._trigger_validation_error_on_template_form(
             'templA', 'content', [1], 'missing_template_use', templA.id)
 
+    def _unassign_sites_queries(self, sites_count):
+        sites = [Site.objects.create(name='s%d' % i, domain='s%d.org' % i)
+                 for i in range(sites_count)]
+        templA = Template.objects.create(name='templA', content='content')
+        templB = Template.objects.create(
+            name='templB', content='{% include "templC" %}')
+        templC = Template.objects.create(name='templC', content='content')
+        for templ in [templA, templB, templC]:
+            templ.sites.add(*sites)
+        for site in sites:
+            Page.objects.create(template='templB', site=site)
+        with CaptureQueriesContext(connection) as queries:
+            self._update_template('templA', 'content', [1], templA.id)
+        Template.objects.all().delete()
+        return len(queries)
+
+    def test_sites_unassigned_queries_do_not_depend_on_sites(self):
+        self.assertEqual(self._unassign_sites_queries(2),
+                         self._unassign_sites_queries(6))
+
+    def _add_template_queries(self, used_count):
+        site = Site.objects.get(id=1)
+        names = ['used%d_%d' % (used_count, i) for i in range(used_count)]
+        for name in names:
+            Template.objects.create(name=name, content='content').sites.add(site)
+        content = ''.join('{%% include "%s" %%}' % name for name in names)
+        with CaptureQueriesContext(connection) as queries:
+            self._update_template('templ%d' % used_count, content, [1])
+        return len(queries)
+
+    @patch('cms_templates.settings.static_analysis', True)
+    def test_used_templates_queries_do_not_depend_on_templates(self):
+        self.assertEqual(self._add_template_queries(2),
+                         self._add_template_queries(8))
+
+    def test_sites_unassigned_from_many_sites(self):
+        sites = [Site.objects.create(name='s%d' % i, domain='s%d.org' % i)
+                 for i in range(3)]
+        templA = Template.objects.create(name='templA', content='content')
+        templB = Template.objects.create(
+            name='templB', content='{% include "templA" %}')
+        templA.sites.add(*sites)
+        templB.sites.add(sites[-1])
+        self._trigger_validation_error_on_template_form(
+            'templA', 'content', [1], 'site_template_use', templA.id)
+
     def test_site_has_all_templates_required(self):
         created = []
         for t_name in ['templA', 'templB', 'templC', 'templD']:
@@ -599,6 +784,28 @@ class TestTemplateValidation(TestCase, TestTemplateValidationBaseMixin):
             s.name, s.domain, [templA.id, templB.id, templC.id],
             'orphan', s.id)
 
+    def test_site_templates_incremental_validation(self):
+        s = Site.objects.get(id=1)
+        other_site = Site.objects.create(name='other', domain='other.org')
+        templA = Template.objects.create(
+            name='templA', content='{% include "templB" %}')
+        templB = Template.objects.create(name='templB', content='content')
+        templC = Template.objects.create(name='templC', content='content')
+        for templ in [templA, templB, templC]:
+            templ.sites.add(s, other_site)
+        # the dependency index still knows that templA uses templB
+        Template.objects.filter(id=templA.id).update(content='{% invalid %}')
+
+        with patch('cms_templates.settings.site_full_validation', True):
+            self._trigger_validation_error_on_site_form(
+                s.name, s.domain, [templA.id, templB.id], 'syntax_error',
+                s.id)
+        # only the templates affected by unassigning templC are checked
+        self._no_validation_error_on_site_form(
+            s.name, s.domain, [templA.id, templB.id], s.id)
+        self._trigger_validation_error_on_site_form(
+            s.name, s.domain, [templA.id], 'syntax_error', s.id)
+
     def _test_menu_tag_template(self, tag_expression):
         templ_menu = Template.objects.create(name='menu')
         templ_menu.content = "{% load menu_tags %}" + tag_expression
@@ -748,6 +955,786 @@ class TestTemplateValidation(TestCase, TestTemplateValidationBaseMixin):
             site.id)
 
 
+class TestStaticAnalysis(TestCase):
+
+    def setUp(self):
+        Template.objects.create(name='base', content=(
+            '{% block content %}{% include "inc" %}{% endblock content %}'))
+        Template.objects.create(name='inc', content=(
+            '{% load menu_tags %}{% show_menu 0 100 100 100 "menu" %}'))
+        Template.objects.create(name='menu', content='menu')
+
+    def test_db_templates_resolved_without_loaders(self):
+        content = '{% extends "base" %}'
+        expected = set(get_all_templates_used(_Template(content).nodelist))
+        self.assertEqual(expected, set(['base', 'inc', 'menu']))
+
+        source = DBTemplateSource()
+        with patch('cms_templates.template_analyzer.get_template') as mock:
+            # one query for each level of dependencies
+            with self.assertNumQueries(3):
+                used = get_all_templates_used(
+                    _Template(content).nodelist, source=source)
+        self.assertEqual(set(used), expected)
+        self.assertFalse(mock.called)
+
+    def test_missing_template(self):
+        source = DBTemplateSource()
+        with self.assertRaises(TemplateDoesNotExist):
+            get_all_templates_used(
+                _Template('{% include "NonExistent" %}').nodelist,
+                source=source)
+        self.assertEqual(source.get_content('NonExistent'), None)
+
+
+class TestDependencyIndex(TestCase):
+
+    def setUp(self):
+        self.base = Template.objects.create(name='base', content='base')
+        self.inc = Template.objects.create(
+            name='inc', content='{% extends "base" %}')
+        self.page = Template.objects.create(
+            name='page', content='{% include "inc" %}')
+
+    def _dependencies(self, template):
+        return set(template.dependencies.values_list('name', flat=True))
+
+    def test_index_updated_on_save(self):
+        self.assertEqual(self._dependencies(self.page), set(['inc']))
+        self.page.content = '{% include "base" %}{% invalid_tag %}'
+        self.page.save()
+        self.assertEqual(self._dependencies(self.page), set(['base']))
+
+    def test_templates_that_use_template(self):
+        with self.assertNumQueries(1):
+            self.assertEqual(
+                get_templates_that_use_template('base'), [self.inc])
+        self.assertEqual(
+            get_templates_that_use_template('base', transitive=True),
+            [self.inc, self.page])
+        self.assertEqual(get_templates_that_use_template('page'), [])
+
+    def test_unchanged_content_is_not_reindexed(self):
+        self.assertEqual(
+            TemplateMetadata.objects.get(template=self.page).content_digest,
+            get_content_digest(self.page.content))
+        with patch('cms_templates.dependencies.extract_dependencies') as extract:
+            self.page.save()
+        self.assertFalse(extract.called)
+        self.assertEqual(self._dependencies(self.page), set(['inc']))
+
+    def test_rebuild(self):
+        TemplateDependency.objects.all().delete()
+        TemplateMetadata.objects.all().delete()
+        self.assertEqual(rebuild_template_dependencies(), 2)
+        self.assertEqual(get_templates_that_use_template('inc'), [self.page])
+        self.assertEqual(TemplateMetadata.objects.count(), 3)
+
+    @patch('cms_templates.settings.static_analysis', True)
+    def test_scan_without_index(self):
+        with patch('cms_templates.settings.dependency_index', False):
+            self.assertEqual(
+                get_templates_that_use_template('base', transitive=True),
+                [self.inc, self.page])
+
+
+class TestPluginTemplates(TestCase):
+
+    def setUp(self):
+        self.site = Site.objects.create(name='s1', domain='example1.com')
+        self.template = Template.objects.create(name='plugin', content='a')
+        page = Page.objects.create(template='plugin', site=self.site)
+        self.placeholder = Placeholder.objects.create(slot='main')
+        page.placeholders.add(self.placeholder)
+        PluginModelA.objects.create(
+            plugin_type='PluginA', some_template=self.template,
+            placeholder=self.placeholder)
+
+    def test_single_query(self):
+        with self.assertNumQueries(1):
+            templates = get_plugin_templates_from_site(self.site)
+        self.assertEqual(dict(templates), {'plugin': set(['PluginBaseA'])})
+
+        # bulk updates are seen too
+        PluginModelA.objects.update(some_template=None)
+        self.assertEqual(dict(get_plugin_templates_from_site(self.site)), {})
+        PluginModelA.objects.update(some_template=self.template)
+
+        plugin = PluginModelB.objects.create(
+            plugin_type='PluginB', some_template_name='other',
+            placeholder=self.placeholder)
+        self.assertEqual(dict(get_plugin_templates_from_site(self.site)), {
+            'plugin': set(['PluginBaseA']), 'other': set(['PluginBaseB'])})
+        plugin.delete()
+        self.assertEqual(dict(get_plugin_templates_from_site(self.site)),
+                         {'plugin': set(['PluginBaseA'])})
+
+    @patch('cms_templates.plugins._QUERY_CHUNK_SIZE', 2)
+    def test_sites_are_chunked(self):
+        sites = [self.site] + [
+            Site.objects.create(name='s%d' % i, domain='example%d.com' % i)
+            for i in range(2, 4)]
+        for site in sites[1:]:
+            page = Page.objects.create(template='plugin', site=site)
+            placeholder = Placeholder.objects.create(slot='main')
+            page.placeholders.add(placeholder)
+            PluginModelB.objects.create(
+                plugin_type='PluginB', some_template_name='plugin',
+                placeholder=placeholder)
+        # one site per query for the two plugin models
+        with self.assertNumQueries(3):
+            templates = get_plugin_templates_from_sites(
+                [site.id for site in sites])
+        self.assertEqual(dict(templates[self.site.id]),
+                         {'plugin': set(['PluginBaseA'])})
+        for site in sites[1:]:
+            self.assertEqual(dict(templates[site.id]),
+                             {'plugin': set(['PluginBaseB'])})
+
+    def test_plugin_metadata(self):
+        metadata = get_plugin_metadata()
+        self.assertIsInstance(metadata, tuple)
+        self.assertEqual(
+            [(plugin.plugin_name, plugin.model, plugin.template_name_attr)
+             for plugin in metadata],
+            [('PluginBaseA', PluginModelA, 'some_template__name'),
+             ('PluginBaseB', PluginModelB, 'some_template_name')])
+
+    def test_invalid_plugin_reference(self):
+        with patch('cms_templates.settings.PLUGIN_TEMPLATE_REFERENCES',
+                   ['PluginBaseA', 'MissingPlugin']):
+            self.assertRaises(ImproperlyConfigured, load_plugin_metadata)
+        # the table computed when the app was loaded is kept
+        self.assertEqual(len(get_plugin_metadata()), 2)
+
+
+class ValidationDataMixin(object):
+
+    def setUp(self):
+        self.site = Site.objects.create(name='s1', domain='example1.com')
+        for name, content in [('base', 'base'),
+                              ('page', '{% extends "base" %}'),
+                              ('broken', '{% invalid_tag %}'),
+                              ('missing', '{% include "nonexistent" %}'),
+                              ('cycleA', '{% include "cycleB" %}'),
+                              ('cycleB', '{% include "cycleA" %}')]:
+            Template.objects.create(name=name, content=content)
+        Template.objects.get(name='page').sites.add(self.site)
+        Page.objects.create(template='other', site=self.site)
+
+    def _validate(self, processes=1):
+        stdout = StringIO()
+        call_command('validate_cms_templates', processes=processes,
+                     stdout=stdout)
+        return json.loads(stdout.getvalue())
+
+
+class TestValidateTemplates(ValidationDataMixin, TestCase):
+
+    def test_report(self):
+        report = self._validate()
+        self.assertEqual(report['templates'], 6)
+        self.assertEqual(
+            sorted((error['code'], error['template'], error['site'])
+                   for error in report['errors']),
+            [('all_required', 'page', 'example1.com'),
+             ('infinite_recursivity', 'cycleA', None),
+             ('infinite_recursivity', 'cycleB', None),
+             ('missing_template_use', 'missing', None),
+             ('nonexistent_in_pages', 'other', 'example1.com'),
+             ('syntax_error', 'broken', None)])
+
+    def test_edges_only(self):
+        stdout = StringIO()
+        call_command('validate_cms_templates', processes=1, edges_only=True,
+                     stdout=stdout)
+        report = json.loads(stdout.getvalue())
+        self.assertEqual(report['templates'], 6)
+        self.assertEqual(
+            sorted((error['code'], error['template'], error['site'])
+                   for error in report['errors']),
+            sorted((error['code'], error['template'], error['site'])
+                   for error in self._validate()['errors']))
+        self.assertIn('process', report['peak_memory'])
+
+    def test_consistent_templates(self):
+        Template.objects.exclude(name__in=['base', 'page']).delete()
+        Template.objects.get(name='base').sites.add(self.site)
+        Page.objects.all().delete()
+        self.assertEqual(self._validate()['errors'], [])
+
+    def test_cycle_message(self):
+        messages = dict((error['template'], error['message'])
+                        for error in self._validate()['errors']
+                        if error['code'] == 'infinite_recursivity')
+        self.assertIn('<cycleA> uses (include) <cycleB>, '
+                      '<cycleB> uses (include) <cycleA>, ', messages['cycleA'])
+        self.assertIn('<cycleB> uses (include) <cycleA>, '
+                      '<cycleA> uses (include) <cycleB>, ', messages['cycleB'])
+
+
+class TestValidateTemplatesWorkers(ValidationDataMixin, TransactionTestCase):
+    # the workers are forked after the database connection is closed, so
+    #   the data they read has to be committed
+
+    def test_report(self):
+        report = self._validate(processes=2)
+        self.assertEqual(report['templates'], 6)
+        self.assertEqual(
+            sorted((error['code'], error['template'], error['site'])
+                   for error in report['errors']),
+            [('all_required', 'page', 'example1.com'),
+             ('infinite_recursivity', 'cycleA', None),
+             ('infinite_recursivity', 'cycleB', None),
+             ('missing_template_use', 'missing', None),
+             ('nonexistent_in_pages', 'other', 'example1.com'),
+             ('syntax_error', 'broken', None)])
+        self.assertIn('workers', report['peak_memory'])
+
+
+class TestChangeImpact(TestCase):
+
+    def setUp(self):
+        self.site = Site.objects.create(name='s1', domain='example1.com')
+        self.base = Template.objects.create(name='base', content='base')
+        self.page = Template.objects.create(
+            name='page', content='{% extends "base" %}')
+        Template.objects.create(name='header', content='header')
+        self.base.sites.add(self.site)
+        self.page.sites.add(self.site)
+        Page.objects.create(template='page', site=self.site)
+
+    def _site_impact(self, impact, domain):
+        return [site for site in impact['sites'] if site['site'] == domain]
+
+    def test_impact(self):
+        impact = get_template_change_impact(
+            self.base, '{% include "header" %}{% include "nonexistent" %}')
+        self.assertEqual(impact['added'], ['header', 'nonexistent'])
+        self.assertEqual(impact['removed'], [])
+        self.assertEqual(impact['missing'], ['nonexistent'])
+        self.assertEqual(impact['syntax_error'], None)
+        self.assertFalse(impact['infinite_recursivity'])
+        self.assertEqual(impact['affected_templates'], ['page'])
+        self.assertEqual(self._site_impact(impact, 'example1.com'), [
+            {'site': 'example1.com', 'pages': 1, 'plugins': 0,
+             'unassigned': ['header']}])
+
+    def test_cycle(self):
+        impact = get_template_change_impact(self.base, '{% include "page" %}')
+        self.assertTrue(impact['infinite_recursivity'])
+
+    def test_view(self):
+        User.objects.create_superuser(
+            username='impact_user', password='x',
+            email='impact_user@templates.com')
+        self.client.login(username='impact_user', password='x')
+        session = self.client.session
+        session['cms_admin_site'] = 1
+        session.save()
+        url = urlresolvers.reverse(
+            'admin:dbtemplates_template_impact', args=[self.page.id])
+        self.assertEqual(self.client.get(url).status_code, 405)
+        response = self.client.post(url, {'content': '{% dummy %}'})
+        impact = json.loads(response.content)
+        self.assertEqual(impact['removed'], ['base'])
+        self.assertNotEqual(impact['syntax_error'], None)
+
+
+class TestUsageCounters(TestCase):
+
+    def setUp(self):
+        self.site = Site.objects.create(name='s1', domain='example1.com')
+        self.base = Template.objects.create(name='base', content='base')
+        self.page_template = Template.objects.create(
+            name='page', content='{% extends "base" %}')
+        self.placeholder = Placeholder.objects.create(slot='main')
+
+    def _counters(self, template):
+        return TemplateMetadata.objects.filter(template=template).values_list(
+            'page_count', 'dependent_count', 'plugin_count')[0]
+
+    def test_counters_follow_changes(self):
+        self.assertEqual(self._counters(self.base), (0, 1, 0))
+        page = Page.objects.create(template='page', site=self.site)
+        self.assertEqual(self._counters(self.page_template), (1, 0, 0))
+
+        page = Page.objects.get(id=page.id)
+        page.template = 'base'
+        page.save()
+        self.assertEqual(self._counters(self.page_template), (0, 0, 0))
+        self.assertEqual(self._counters(self.base), (1, 1, 0))
+
+        PluginModelA.objects.create(
+            plugin_type='PluginA', some_template=self.base,
+            placeholder=self.placeholder)
+        plugin = PluginModelB.objects.create(
+            plugin_type='PluginB', some_template_name='page',
+            placeholder=self.placeholder)
+        self.assertEqual(self._counters(self.base), (1, 1, 1))
+        self.assertEqual(self._counters(self.page_template), (0, 0, 1))
+        plugin.delete()
+        self.assertEqual(self._counters(self.page_template), (0, 0, 0))
+
+        self.page_template.delete()
+        self.assertEqual(self._counters(self.base), (1, 0, 1))
+        Page.objects.get(id=page.id).delete()
+        self.assertEqual(self._counters(self.base), (0, 0, 1))
+
+    def test_rebuild(self):
+        Page.objects.create(template='page', site=self.site)
+        TemplateMetadata.objects.update(
+            page_count=5, dependent_count=5, plugin_count=5)
+        call_command('rebuild_template_counters', stdout=StringIO())
+        self.assertEqual(self._counters(self.base), (0, 1, 0))
+        self.assertEqual(self._counters(self.page_template), (1, 0, 0))
+
+    def test_rebuild_creates_missing_metadata(self):
+        Template.objects.create(name='other', content='other')
+        TemplateMetadata.objects.exclude(template=self.base).delete()
+        call_command('rebuild_template_counters', stdout=StringIO())
+        self.assertEqual(self._counters(self.page_template), (0, 0, 0))
+        self.assertEqual(
+            TemplateMetadata.objects.get(template__name='other').content_digest,
+            get_content_digest('other'))
+
+    def test_save_without_template_change(self):
+        page = Page.objects.create(template='page', site=self.site)
+        page = Page.objects.get(id=page.id)
+        page.save()
+        self.assertEqual(self._counters(self.page_template), (1, 0, 0))
+
+    def test_changelist(self):
+        Page.objects.create(template='page', site=self.site)
+        User.objects.create_superuser(
+            username='counters_user', password='x',
+            email='counters_user@templates.com')
+        self.client.login(username='counters_user', password='x')
+        session = self.client.session
+        session['cms_admin_site'] = 1
+        session.save()
+        url = urlresolvers.reverse('admin:dbtemplates_template_changelist')
+        response = self.client.get(url, {'usage': 'unused'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(list(response.context['cl'].result_list), [])
+        Page.objects.all().delete()
+        response = self.client.get(url, {'usage': 'unused'})
+        self.assertEqual(list(response.context['cl'].result_list),
+                         [self.page_template])
+
+
+class TestInheritedTemplates(TestCase):
+
+    def setUp(self):
+        self.site = Site.objects.create(domain='inherit.org', name='inherit')
+        for name in ('parent', 'other'):
+            Template.objects.create(
+                name=name, content=name).sites.add(self.site)
+        inherit = settings.CMS_TEMPLATE_INHERITANCE_MAGIC
+        self.parent = Page.objects.create(template='parent', site=self.site)
+        self.child = Page.objects.create(
+            template=inherit, site=self.site, parent=self.parent)
+        self.grandchild = Page.objects.create(
+            template=inherit, site=self.site, parent=self.child)
+
+    def _pages_using(self, name):
+        return set(filter_pages_using(Page.objects.all(), [name])
+                   .values_list('id', flat=True))
+
+    def test_subtree_follows_changes(self):
+        self.assertEqual(self._pages_using('parent'), set(
+            [self.parent.id, self.child.id, self.grandchild.id]))
+
+        self.parent.template = 'other'
+        self.parent.save()
+        self.assertEqual(self._pages_using('parent'), set())
+        self.assertEqual(self._pages_using('other'), set(
+            [self.parent.id, self.child.id, self.grandchild.id]))
+
+        self.child.template = 'parent'
+        self.child.save()
+        self.assertEqual(self._pages_using('parent'), set(
+            [self.child.id, self.grandchild.id]))
+
+    def test_rebuild(self):
+        InheritedTemplate.objects.all().delete()
+        self.assertEqual(rebuild_inherited_templates(), 2)
+        self.assertEqual(self._pages_using('parent'), set(
+            [self.parent.id, self.child.id, self.grandchild.id]))
+
+    def _site_form(self, *names):
+        return ExtendedSiteAdminForm(instance=self.site, data={
+            'domain': self.site.domain, 'name': self.site.name,
+            'templates': list(Template.objects.filter(
+                name__in=names).values_list('id', flat=True))})
+
+    def test_inherited_pages_prevent_unassigning(self):
+        form = self._site_form('other')
+        self.assertFalse(form.is_valid())
+        error = form.errors['templates'][0]
+        self.assertIn('parent', error)
+        for page in (self.parent, self.child, self.grandchild):
+            self.assertIn('(%d)' % page.id, error)
+
+        # the pages inherit the new template of their parent
+        self.parent = Page.objects.get(id=self.parent.id)
+        self.parent.template = 'other'
+        self.parent.save()
+        self.assertNotIn('templates', self._site_form('other').errors)
+        error = self._site_form('parent').errors['templates'][0]
+        self.assertIn('other', error)
+        for page in (self.parent, self.child, self.grandchild):
+            self.assertIn('(%d)' % page.id, error)
+
+
+class TestReadDatabase(TestCase):
+    multi_db = True
+
+    def setUp(self):
+        cache.clear()
+        self.site = Site.objects.create(domain='read.org', name='read')
+        Site.objects.using('replica').create(
+            id=self.site.id, domain='read.org', name='read')
+        self.template = Template.objects.create(name='page', content='page')
+        self.template.sites.add(self.site)
+        Page.objects.create(template='page', site=self.site)
+
+    def test_reads_from_replica(self):
+        with patch('cms_templates.settings.read_database', 'replica'):
+            self.assertEqual(get_read_alias(), 'replica')
+            # the writes did not reach the replica
+            self.assertIsNone(get_template_usages(self.template))
+            self.assertFalse(get_site_templates(self.site.id).exists())
+        self.assertTrue(get_template_usages(self.template))
+        self.assertTrue(get_site_templates(self.site.id).exists())
+
+    def test_read_your_writes(self):
+        with patch('cms_templates.settings.read_database', 'replica'), \
+                patch('cms_templates.settings.read_your_writes_window', 5):
+            record_write()
+            self.assertEqual(get_read_alias(), 'default')
+            self.assertTrue(get_template_usages(self.template))
+            cache.clear()
+            self.assertEqual(get_read_alias(), 'replica')
+
+    def test_checks_read_default(self):
+        from django.contrib import admin
+        template_admin = admin.site._registry[Template]
+        placeholder = Placeholder.objects.create(slot='main')
+        Page.objects.get(site=self.site).placeholders.add(placeholder)
+        PluginModelB.objects.create(
+            plugin_type='PluginB', some_template_name='page',
+            placeholder=placeholder)
+        with patch('cms_templates.settings.read_database', 'replica'):
+            self.assertEqual(
+                get_plugin_templates_from_site(self.site).keys(), ['page'])
+            self.assertRaises(TemplateUsedException,
+                              template_admin.delete_model, None, self.template)
+
+
+class TestImportExport(TestCase):
+
+    def setUp(self):
+        self.site = Site.objects.create(domain='import.org', name='import')
+        self.shared = Template.objects.create(name='shared', content='shared')
+
+    def _read(self, *records):
+        return read_templates(StringIO('\n'.join(
+            json.dumps(record) for record in records)))
+
+    def _codes(self, templates):
+        return sorted((error['code'], error['template'])
+                      for error in validate_import(templates))
+
+    def test_export(self):
+        self.shared.sites.add(self.site)
+        stream = StringIO()
+        self.assertEqual(export_templates(stream, ['shared']), 1)
+        stream.seek(0)
+        self.assertEqual(read_templates(stream), {
+            'shared': ('shared', frozenset(['import.org']))})
+
+    def test_command_round_trip(self):
+        self.shared.sites.add(self.site)
+        Template.objects.create(name='multiline', content='a\nb\n')
+        output = StringIO()
+        call_command('export_cms_templates', 'multiline', 'shared',
+                     stdout=output)
+        lines = output.getvalue().splitlines()
+        self.assertEqual(len(lines), 2)
+        self.assertNotIn('', lines)
+
+        Template.objects.filter(name='multiline').delete()
+        self.shared.sites.clear()
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'templates.jsonl')
+        with open(path, 'w') as stream:
+            stream.write(output.getvalue())
+        call_command('import_cms_templates', path, stdout=StringIO())
+        self.assertEqual(Template.objects.get(name='multiline').content,
+                         'a\nb\n')
+        self.assertEqual(list(self.shared.sites.all()), [self.site])
+
+    def test_import_whole_set(self):
+        self.shared.sites.add(self.site)
+        # the partial is imported after the template that extends it
+        templates = self._read(
+            {'name': 'page', 'content': '{% extends "base" %}',
+             'sites': ['import.org']},
+            {'name': 'base', 'content': '{% include "shared" %}',
+             'sites': ['import.org']})
+        self.assertEqual(self._codes(templates), [])
+        self.assertEqual(import_templates(templates), (2, 0))
+        self.assertEqual(
+            set(Template.objects.get(name='base').sites.all()),
+            set([self.site]))
+        self.assertEqual(set(TemplateDependency.objects.filter(
+            template__name='page').values_list('name', flat=True)),
+            set(['base']))
+        self.assertEqual(import_templates(templates), (0, 0))
+
+        templates['base'] = ('changed', frozenset(['import.org']))
+        self.assertEqual(import_templates(templates), (0, 1))
+        self.assertEqual(Template.objects.get(name='base').content, 'changed')
+
+    def test_invalid_set(self):
+        templates = self._read(
+            {'name': 'a', 'content': '{% include "b" %}'},
+            {'name': 'b', 'content': '{% include "a" %}'},
+            {'name': 'c', 'content': '{% include "missing" %}'},
+            {'name': 'd', 'content': '{% include "shared" %}',
+             'sites': ['import.org']})
+        self.assertEqual(self._codes(templates), [
+            ('infinite_recursivity', 'a'), ('infinite_recursivity', 'b'),
+            ('missing_sites', 'shared'), ('missing_template_use', 'c')])
+
+    def test_unassigned_site_in_use(self):
+        self.shared.sites.add(self.site)
+        Page.objects.create(template='shared', site=self.site)
+        templates = self._read({'name': 'shared', 'content': 'shared'})
+        self.assertEqual(self._codes(templates), [('page_use', 'shared')])
+
+
+class TestTemplateReleases(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.site = Site.objects.create(domain='release.org', name='release')
+        settings.__class__.SITE_ID = make_tls_property()
+        settings.__class__.SITE_ID.value = self.site.id
+        self.template = Template.objects.create(name='themed', content='v1')
+        self.template.sites.add(self.site)
+
+    def _render(self):
+        return get_validation_engine().get_template('themed').render(Context())
+
+    def test_publish_and_rollback(self):
+        first = publish_release([self.site])
+        self.template.content = 'v2'
+        self.template.save()
+        # drafts are not live
+        self.assertEqual(self._render(), 'v1')
+
+        publish_release([self.site])
+        self.assertEqual(self._render(), 'v2')
+        self.assertEqual(rollback_release([self.site]), {self.site.id: first})
+        self.assertEqual(self._render(), 'v1')
+
+    def test_live_release_kept_in_process(self):
+        self.assertIsNone(get_live_release_id(self.site.id))
+        # the sites that never published don't query the pointer again
+        with self.assertNumQueries(0):
+            self.assertIsNone(get_live_release_id(self.site.id))
+        with patch('cms_templates.releases.cache') as release_cache:
+            self.assertIsNone(get_live_release_id(self.site.id))
+        self.assertFalse(release_cache.get.called)
+
+        release = publish_release([self.site])
+        self.assertEqual(get_live_release_id(self.site.id), release.id)
+
+    def test_rollback_each_site(self):
+        other = Site.objects.create(domain='other.org', name='other')
+        first = publish_release([other])
+        second = publish_release([self.site, other])
+        publish_release([self.site])
+        self.assertEqual(rollback_release([self.site, other]),
+                         {self.site.id: second, other.id: first})
+        self.assertEqual(rollback_release([self.site]), {})
+
+    def test_choices_follow_release(self):
+        publish_release([self.site])
+        Template.objects.create(name='draft', content='draft').sites.add(
+            self.site)
+        names = [name for name, title
+                 in get_site_template_choices(self.site.id)]
+        self.assertIn('themed', names)
+        self.assertNotIn('draft', names)
+
+    def test_choices_include_orphans(self):
+        Template.objects.create(name='orphan', content='orphan')
+        publish_release([self.site])
+        names = [name for name, title
+                 in get_site_template_choices(self.site.id)]
+        self.assertNotIn('orphan', names)
+        with patch('cms_templates.settings.include_orphan', True):
+            cache.clear()
+            names = [name for name, title
+                     in get_site_template_choices(self.site.id)]
+        self.assertIn('orphan', names)
+
+
+class TestProfiling(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def test_slow_calls_are_saved(self):
+        @profiled('slow', lambda name: 'template_%s' % name)
+        def validate(name):
+            return name
+
+        with patch('cms_templates.settings.profile_dir', self.directory), \
+                patch('cms_templates.settings.profile_threshold', 0), \
+                patch('cms_templates.settings.profile_max_files', 2):
+            for name in ('a', 'b', 'c'):
+                self.assertEqual(validate(name), name)
+        files = os.listdir(self.directory)
+        self.assertEqual(len(files), 2)
+        self.assertTrue(all(f.startswith('slow-template_') and
+                            f.endswith('.pstats') for f in files))
+
+    def test_disabled(self):
+        @profiled('slow')
+        def validate():
+            return 'valid'
+
+        with patch('cms_templates.settings.profile_threshold', 0):
+            self.assertEqual(validate(), 'valid')
+        with patch('cms_templates.settings.profile_dir', self.directory), \
+                patch('cms_templates.settings.profile_threshold', 0), \
+                patch('cms_templates.settings.profile_sample_rate', 0):
+            self.assertEqual(validate(), 'valid')
+        self.assertEqual(os.listdir(self.directory), [])
+
+
+class TestContentSearch(TestCase):
+
+    def setUp(self):
+        # the migrations that create the index don't run for the tests
+        call_command('rebuild_template_search_index', stdout=StringIO())
+        Template.objects.create(name='button',
+                                content='<a class="btn-primary">Buy</a>')
+        self.other = Template.objects.create(
+            name='other', content='{% block sidebar %}{% endblock %}')
+
+    def _search(self, text):
+        return set(search_templates(Template.objects.all(), text)
+                   .values_list('name', flat=True))
+
+    def test_index_follows_changes(self):
+        self.assertEqual(self._search('btn-primary'), set(['button']))
+        self.assertEqual(self._search('block sidebar'), set(['other']))
+
+        self.other.content = '<span class="btn-primary"></span>'
+        self.other.save()
+        self.assertEqual(self._search('btn-primary'),
+                         set(['button', 'other']))
+        self.other.delete()
+        self.assertEqual(self._search('btn-primary'), set(['button']))
+
+    def test_text_without_words(self):
+        self.assertEqual(self._search('{%'), set(['other']))
+        self.assertEqual(self._search('</'), set(['button']))
+
+    def test_search_without_index(self):
+        backend = get_search_backend()
+        if isinstance(backend, SqliteSearchBackend):
+            connection.cursor().execute('DROP TABLE cms_templates_content_fts')
+        # the searches don't create it
+        self.assertEqual(self._search('btn-primary'), set(['button']))
+        self.assertEqual(self._search('block sidebar'), set(['other']))
+        if isinstance(backend, SqliteSearchBackend):
+            self.assertFalse(backend._has_table())
+
+    def test_backend_uses_current_connection(self):
+        self.assertIs(get_search_backend('default').connection,
+                      connections['default'])
+        self.assertIsNot(get_search_backend('default'),
+                         get_search_backend('default'))
+
+    def test_changelist_search(self):
+        template_admin = RestrictedTemplateAdmin(Template, Mock())
+        for term, expected in (('btn-primary', ['button']),
+                               ('oth', ['other'])):
+            queryset, distinct = template_admin.get_search_results(
+                Mock(), Template.objects.all(), term)
+            self.assertEqual(
+                sorted(queryset.values_list('name', flat=True)), expected)
+
+
+class TestSingleFlight(TestCase):
+
+    def test_concurrent_calls_share_result(self):
+        flight = SingleFlight('cms_templates:test', timeout=0)
+        started, release = threading.Event(), threading.Event()
+        calls, results = [], []
+
+        def compute():
+            calls.append(1)
+            started.set()
+            release.wait()
+            return 'result'
+
+        def call():
+            results.append(flight.do('key', compute))
+
+        threads = [threading.Thread(target=call) for i in range(3)]
+        threads[0].start()
+        started.wait()
+        for thread in threads[1:]:
+            thread.start()
+        # let the other threads find the running call
+        time.sleep(0.1)
+        release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, ['result'] * 3)
+        self.assertEqual(flight.do('key', lambda: 'again'), 'again')
+
+    def test_result_shared_between_processes(self):
+        # the instances don't share their calls, like two processes
+        flights = [SingleFlight('cms_templates:test', timeout=5)
+                   for i in range(2)]
+        started, release = threading.Event(), threading.Event()
+        calls, results = [], []
+
+        def compute():
+            calls.append(1)
+            started.set()
+            release.wait()
+            return 'shared'
+
+        def call(flight):
+            results.append(flight.do('key', compute))
+
+        threads = [threading.Thread(target=call, args=(flight,))
+                   for flight in flights]
+        threads[0].start()
+        started.wait()
+        threads[1].start()
+        # let the second one wait for the lock held by the first one
+        time.sleep(0.2)
+        release.set()
+        for thread in threads:
+            thread.join()
+        cache.delete('%s:result' % flights[0]._cache_key('key'))
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, ['shared'] * 2)
+
+
 class InfiniteRecursivityErrorTest(TestCase):
 
     tpl1 = """
@@ -829,11 +1816,15 @@ class TestAdminOperations(TestCase):
 
         def _make_expected(expected):
             pages = {
-                self.site: [_page_usage(page)
+                self.site: [_page_usage(page.id, page.get_title())
                             for page in expected.get('pages', [])]
             } if expected.get('pages') else {}
+            page_counts = {
+                self.site: len(expected['pages'])
+            } if expected.get('pages') else {}
             return {
                 'pages': pages,
+                'page_counts': page_counts,
                 'child_templates': [_template_usage(tmp)
                                     for tmp in expected.get('templates', [])],
             }
@@ -853,3 +1844,33 @@ class TestAdminOperations(TestCase):
             else:
                 self.assertEqual(actual, None,
                                  "No usage should be found for {}".format(template))
+
+    @patch('cms_templates.settings.usage_pages_limit', 2)
+    def test_template_usages_are_capped(self):
+        for i in range(4):
+            Page.objects.create(template="page_template", site=self.site)
+        with self.assertNumQueries(5):
+            usages = get_template_usages(self.page_template)
+        self.assertEqual(usages['page_counts'], {self.site: 5})
+        self.assertEqual(len(usages['pages'][self.site]), 2)
+
+        detail = get_template_site_usages(self.page_template, self.site.id, 3)
+        self.assertEqual(detail.paginator.count, 5)
+        self.assertEqual(len(detail.object_list), 1)
+        detail = get_template_site_usages(self.page_template, self.site.id, 'x')
+        self.assertEqual(detail.number, 1)
+
+    @patch('cms_templates.settings.error_pages_limit', 3)
+    def test_format_pages_is_capped(self):
+        pages = [self.page] + [
+            Page.objects.create(template="page_template", site=self.site)
+            for i in range(4)]
+        Title.objects.create(page=self.page, language='en', title='first')
+        page_qs = Page.objects.filter(template="page_template")
+        with self.assertNumQueries(3):
+            formatted = _format_pages(page_qs)
+        self.assertEqual(formatted, 'first(%d), (%d), (%d) +2 more' % tuple(
+            page.id for page in pages[:3]))
+        with self.assertNumQueries(2):
+            self.assertEqual(_format_pages(page_qs.filter(id=self.page.id)),
+                             'first(%d)' % self.page.id)
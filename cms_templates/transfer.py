@@ -0,0 +1,287 @@
+import json
+from collections import defaultdict
+from itertools import chain
+
+from django.contrib.sites.models import Site
+from django.db import transaction
+from django.db.models import Case, When, Value, TextField
+from django.utils import timezone
+from cms.models import Page
+from dbtemplates.models import Template
+from dbtemplates.utils.cache import remove_cached_template
+
+from cms_templates.dependencies import (get_dependent_names,
+                                        rebuild_template_dependencies)
+from cms_templates.counters import update_dependent_counts
+from cms_templates.dependency_graph import TemplateDependencyGraph
+from cms_templates.inheritance import (filter_pages_using,
+                                       get_effective_templates)
+from cms_templates.middleware import bump_templates_generation
+from cms_templates.models import TemplateDependency
+from cms_templates.plugins import _query_plugin_template_references
+from cms_templates.routing import record_write
+from cms_templates.search import get_search_backend
+from cms_templates.template_analyzer import _chunks
+from cms_templates.validation import (check_graph_template, _error,
+                                      _format_ids, _TEMPLATE_MESSAGES)
+
+_UPDATE_CHUNK_SIZE = 100
+
+
+def export_templates(stream, names=None):
+    """
+    Writes the templates `names` (all by default) to `stream` as JSON
+    Lines, one {"name", "content", "sites"} object per template, sorted by
+    name. `sites` are the domains of the sites assigned to the template.
+    Returns the number of templates written.
+    """
+    templates = Template.objects.order_by('name')
+    assignments = Template.sites.through.objects.order_by('site__domain')
+    if names is not None:
+        templates = templates.filter(name__in=names)
+        assignments = assignments.filter(template__name__in=names)
+    domains = defaultdict(list)
+    for template_id, domain in assignments.values_list(
+            'template', 'site__domain').iterator():
+        domains[template_id].append(domain)
+
+    count = 0
+    for pk, name, content in templates.values_list(
+            'pk', 'name', 'content').iterator():
+        # a single write ending with the newline, as OutputWrapper (the
+        #   stdout of the commands) only adds one to lines without it
+        stream.write(json.dumps({'name': name, 'content': content,
+                                 'sites': domains[pk]}, sort_keys=True) + '\n')
+        count += 1
+    return count
+
+
+def read_templates(stream):
+    """
+    Reads the JSON Lines written by export_templates from `stream`.
+    Returns {name: (content, frozenset(site domains))}. Raises ValueError
+    for invalid or duplicated templates.
+    """
+    templates = {}
+    for number, line in enumerate(stream, 1):
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+            name, content = record['name'], record['content']
+            domains = frozenset(record.get('sites', []))
+        except (ValueError, KeyError, TypeError) as e:
+            raise ValueError('Line %d is not a valid template: %s' % (
+                number, e))
+        if name in templates:
+            raise ValueError('Line %d: template %s is duplicated.' % (
+                number, name))
+        templates[name] = (content, domains)
+    return templates
+
+
+def _get_assignments(names):
+    """Returns {template name: set(site domains)} for the db templates."""
+    assigned = defaultdict(set)
+    for chunk in _chunks(names):
+        for name, domain in Template.sites.through.objects.filter(
+                template__name__in=chunk).values_list(
+                'template__name', 'site__domain'):
+            assigned[name].add(domain)
+    return assigned
+
+
+def _get_db_names(names):
+    found = set()
+    for chunk in _chunks(names):
+        found.update(Template.objects.filter(name__in=chunk).values_list(
+            'name', flat=True))
+    return found
+
+
+def _check_site_coverage(graph, templates, dependents, sites):
+    """
+    Checks that the templates used by the imported templates and by the
+    templates that use them are assigned to all the sites of those
+    templates, once the import is done.
+    """
+    closures = {}
+    for name in chain(templates, dependents):
+        try:
+            closures[name] = graph.get_closure(name)
+        except Exception:
+            # reported once for the template
+            continue
+    used = set(chain.from_iterable(closures.values()))
+    stored = set(templates) | _get_db_names(used - set(templates))
+    assigned = _get_assignments((used | set(dependents)) - set(templates))
+    for name, (content, domains) in templates.iteritems():
+        assigned[name] = set(domains) & set(sites)
+
+    missing = defaultdict(set)
+    for name, closure in closures.iteritems():
+        for used_name in closure & stored:
+            missing[used_name].update(assigned[name] - assigned[used_name])
+    return [_error('missing_sites', _TEMPLATE_MESSAGES['missing_sites']
+                   .format(name, ', '.join(sorted(domains))), template=name)
+            for name, domains in sorted(missing.items()) if domains]
+
+
+def _check_unassigned_usages(templates):
+    """
+    Checks that the pages and plugins of the sites unassigned from the
+    imported templates do not use them.
+    """
+    unassigned = set()
+    domains = {}
+    for chunk in _chunks(templates):
+        for name, site_id, domain in Template.sites.through.objects.filter(
+                template__name__in=chunk).values_list(
+                'template__name', 'site', 'site__domain'):
+            if domain not in templates[name][1]:
+                unassigned.add((name, site_id))
+                domains[site_id] = domain
+    if not unassigned:
+        return []
+    site_ids = set(domains)
+    names = set(name for name, site_id in unassigned)
+
+    errors = []
+    pages = defaultdict(set)
+    for name, site_id, page_id in get_effective_templates(
+            filter_pages_using(Page.objects.filter(site__in=site_ids), names),
+            'site', 'id'):
+        if (name, site_id) in unassigned:
+            pages[(name, site_id)].add(page_id)
+    for (name, site_id), page_ids in sorted(pages.items()):
+        errors.append(_error('page_use', _TEMPLATE_MESSAGES['page_use'].format(
+            domains[site_id], _format_ids(page_ids)),
+            template=name, site=domains[site_id], pages=page_ids))
+
+    plugins = defaultdict(lambda: (set(), set()))
+    for site_id, name, plugin, page_id in \
+            _query_plugin_template_references(site_ids):
+        if (name, site_id) in unassigned:
+            plugins[(name, site_id)][0].add(plugin)
+            plugins[(name, site_id)][1].add(page_id)
+    for (name, site_id), (plugin_names, page_ids) in sorted(plugins.items()):
+        errors.append(_error(
+            'plugin_template_use', _TEMPLATE_MESSAGES['plugin_template_use']
+            .format(domains[site_id], ', '.join(sorted(plugin_names)),
+                    _format_ids(page_ids)),
+            template=name, site=domains[site_id], pages=page_ids))
+    return errors
+
+
+def validate_import(templates):
+    """
+    Checks the templates read by read_templates as a whole, as if they
+    were all imported at once: syntax errors, cycles and missing templates
+    of the imported templates and of the templates that use them, the
+    sites the templates they use have to be assigned to, and the pages and
+    plugins of the sites they are unassigned from.
+
+    Returns the errors found, as validate_templates does.
+    """
+    domains = set(chain.from_iterable(
+        domains for content, domains in templates.itervalues()))
+    sites = dict(Site.objects.filter(domain__in=domains).values_list(
+        'domain', 'id'))
+    errors = [_error('nonexistent_site', 'Site %s does not exist.' % domain,
+                     site=domain)
+              for domain in sorted(domains - set(sites))]
+
+    graph = TemplateDependencyGraph()
+    for name, (content, template_domains) in templates.iteritems():
+        graph.add_content(name, content)
+    dependents = get_dependent_names(templates, transitive=True)
+    graph.add_templates(dependents)
+
+    for name in sorted(set(templates) | dependents):
+        errors.extend(check_graph_template(graph, name))
+    errors.extend(_check_site_coverage(graph, templates, dependents, sites))
+    errors.extend(_check_unassigned_usages(templates))
+    return errors
+
+
+def import_templates(templates):
+    """
+    Creates or updates the templates read by read_templates, and replaces
+    their sites, in a single transaction using bulk queries. Templates
+    whose content and sites did not change are not written.
+
+    Returns (number of templates created, number of templates updated).
+    """
+    sites = dict(Site.objects.values_list('domain', 'id'))
+    existing = {}
+    for chunk in _chunks(templates):
+        for pk, name, content in Template.objects.filter(
+                name__in=chunk).values_list('pk', 'name', 'content'):
+            existing[name] = (pk, content)
+    current_sites = _get_assignments(existing)
+
+    to_create = sorted(set(templates) - set(existing))
+    changed_content = sorted(
+        name for name, (pk, content) in existing.iteritems()
+        if templates[name][0] != content)
+    changed_sites = sorted(
+        name for name in templates
+        if name not in existing or current_sites[name] != templates[name][1])
+    now = timezone.now()
+
+    with transaction.atomic():
+        Template.objects.bulk_create(
+            [Template(name=name, content=templates[name][0])
+             for name in to_create], batch_size=500)
+        ids = dict((name, pk) for name, (pk, content) in existing.iteritems())
+        for chunk in _chunks(to_create):
+            ids.update(Template.objects.filter(
+                name__in=chunk).values_list('name', 'pk'))
+
+        for chunk in _chunks(changed_content, _UPDATE_CHUNK_SIZE):
+            Template.objects.filter(pk__in=[ids[name] for name in chunk]).update(
+                content=Case(*[When(pk=ids[name],
+                                    then=Value(templates[name][0]))
+                               for name in chunk],
+                             output_field=TextField()),
+                last_changed=now)
+
+        through = Template.sites.through
+        for chunk in _chunks(changed_sites):
+            through.objects.filter(
+                template__in=[ids[name] for name in chunk]).delete()
+        through.objects.bulk_create(
+            [through(template_id=ids[name], site_id=sites[domain])
+             for name in changed_sites
+             for domain in sorted(templates[name][1])],
+            batch_size=500)
+
+        written = sorted(set(to_create) | set(changed_content) |
+                         set(changed_sites))
+        previously_used = set()
+        for chunk in _chunks(written):
+            written_ids = [ids[name] for name in chunk]
+            previously_used.update(TemplateDependency.objects.filter(
+                template__in=written_ids).values_list('name', flat=True))
+            rebuild_template_dependencies(
+                Template.objects.filter(pk__in=written_ids))
+        # the templates they used before and use now are recounted
+        now_used = set()
+        for chunk in _chunks(written):
+            now_used.update(TemplateDependency.objects.filter(
+                template__name__in=chunk).values_list('name', flat=True))
+        update_dependent_counts(previously_used | now_used)
+
+    # the bulk queries don't send the signals that keep the caches and the
+    #   content index valid
+    search_backend = get_search_backend()
+    for chunk in _chunks(written):
+        for template in Template.objects.filter(
+                name__in=chunk).prefetch_related('sites'):
+            remove_cached_template(template)
+            search_backend.update(template.pk, template.content)
+    if changed_sites:
+        bump_templates_generation()
+    if written:
+        record_write()
+    return len(to_create), len(written) - len(to_create)
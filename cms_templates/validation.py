@@ -0,0 +1,284 @@
+import time
+from collections import defaultdict
+from itertools import chain
+from multiprocessing import Pool
+
+from django.contrib.sites.models import Site
+from django.db import connection
+from django.template.base import (Template as _Template, TemplateSyntaxError,
+                                  TemplateDoesNotExist)
+from django.utils.encoding import force_text
+from pygraph.classes.digraph import digraph
+from cms.models import Page
+from dbtemplates.models import Template
+
+from cms_templates import settings as cms_templates_settings
+from cms_templates.admin import (ExtendedTemplateAdminForm,
+                                 ExtendedSiteAdminForm)
+from cms_templates.dependency_graph import TemplateDependencyGraph
+from cms_templates.inheritance import get_effective_templates
+from cms_templates.plugins import _query_plugin_template_references
+from cms_templates.profiling import get_peak_memory
+from cms_templates.recursive_validator import (
+    InfiniteRecursivityError, format_recursive_msg, get_called_templates)
+from cms_templates.template_analyzer import (get_templates_referenced,
+                                             get_validation_engine, _chunks)
+
+_TEMPLATE_MESSAGES = ExtendedTemplateAdminForm.custom_error_messages
+_SITE_MESSAGES = ExtendedSiteAdminForm.custom_error_messages
+
+_EDGES_CHUNK_SIZE = 100
+_SITES_CHUNK_SIZE = 100
+
+# the dependency graph of all templates and the names of the db templates;
+#   they are set before the site workers are forked so all of them share it
+_graph = None
+_db_names = frozenset()
+
+
+def _error(code, message, template=None, site=None, pages=None):
+    error = {'code': code, 'message': message,
+             'template': template, 'site': site}
+    if pages is not None:
+        error['pages'] = sorted(pages)
+    return error
+
+
+def _format_ids(ids):
+    return ', '.join(str(_id) for _id in sorted(ids))
+
+
+def _run(func, items, processes):
+    """
+    Returns the results of `func` for each of `items`, computed by a pool
+    of `processes` worker processes (one per CPU by default).
+    """
+    if processes == 1:
+        return map(func, items)
+    # forked workers must not share the database connection
+    connection.close()
+    pool = Pool(processes)
+    try:
+        return pool.map(func, items)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def _extract_edges(templates):
+    """
+    Returns (name, names of the templates used directly or the compile
+    error) for each (name, content) from `templates`.
+    """
+    engine = get_validation_engine()
+    extracted = []
+    for name, content in templates:
+        try:
+            edges = get_templates_referenced(
+                _Template(content, name=name, engine=engine).nodelist)
+        except Exception as e:
+            edges = TemplateSyntaxError(force_text(e))
+        extracted.append((name, edges))
+    return extracted
+
+
+def _extract_db_edges(names):
+    """
+    Returns the edges of the db templates `names`, as _extract_edges does.
+    Their contents are fetched by the worker and released once their edges
+    are extracted.
+    """
+    return _extract_edges(Template.objects.filter(name__in=names)
+                          .values_list('name', 'content').iterator())
+
+
+def _find_cycle(graph, name):
+    """Returns the templates of a cycle that starts with template `name`."""
+    parents = {}
+    to_visit = [name]
+    while to_visit:
+        current = to_visit.pop(0)
+        for used in graph.get_edges(current):
+            if used == name:
+                cycle = [current]
+                while cycle[-1] != name:
+                    cycle.append(parents[cycle[-1]])
+                return cycle[::-1]
+            if used not in parents:
+                parents[used] = current
+                to_visit.append(used)
+    return []
+
+
+def _get_cycle_error(cycle):
+    """
+    Returns the InfiniteRecursivityError of the templates of `cycle`, whose
+    edges are labelled with the tags that use the next template, as the
+    ones raised by the template admin form.
+    """
+    contents = dict(Template.objects.filter(name__in=cycle)
+                    .values_list('name', 'content'))
+    call_graph = digraph()
+    call_graph.add_nodes(cycle)
+    for caller, callee in zip(cycle, cycle[1:] + cycle[:1]):
+        commands = [command for used, command, _ in get_called_templates(
+            contents.get(caller, ''), caller) if used == callee]
+        call_graph.add_edge((caller, callee),
+                            label=commands[0] if commands else '')
+    return InfiniteRecursivityError(cycle, call_graph)
+
+
+def check_graph_template(graph, name):
+    """
+    Returns the errors of template `name` of `graph`: syntax errors,
+    missing templates and cycles.
+    """
+    try:
+        used = graph.get_closure(name)
+    except TemplateSyntaxError as e:
+        return [_error('syntax_error', _TEMPLATE_MESSAGES['syntax_error']
+                       .format(name, e), template=name)]
+    except TemplateDoesNotExist as e:
+        return [_error('missing_template_use',
+                       _TEMPLATE_MESSAGES['missing_template_use']
+                       .format(name, e), template=name)]
+    if name in used:
+        msg = format_recursive_msg(
+            name, _get_cycle_error(_find_cycle(graph, name)))
+        return [_error('infinite_recursivity',
+                       _TEMPLATE_MESSAGES['infinite_recursivity'].format(msg),
+                       template=name)]
+    return []
+
+
+def _check_template(name):
+    return check_graph_template(_graph, name)
+
+
+def _check_site(site):
+    """
+    Checks that the templates used by the assigned templates, the pages
+    and the plugins of a site are assigned to the site.
+    """
+    domain, assigned, page_templates, plugin_templates = site
+    errors = []
+    for name in sorted(assigned):
+        try:
+            used = _graph.get_closure(name)
+        except (TemplateSyntaxError, TemplateDoesNotExist):
+            # reported once for the template
+            continue
+        not_assigned = (used & _db_names) - assigned
+        if not_assigned:
+            errors.append(_error('all_required', _SITE_MESSAGES['all_required']
+                                 .format(', '.join(sorted(not_assigned)), name),
+                                 template=name, site=domain))
+
+    for name, page_ids in sorted(page_templates.items()):
+        if name in assigned:
+            continue
+        code = ('required_in_pages' if name in _db_names
+                else 'nonexistent_in_pages')
+        errors.append(_error(code, _SITE_MESSAGES[code].format(
+            name, _format_ids(page_ids)),
+            template=name, site=domain, pages=page_ids))
+
+    for name, (plugins, page_ids) in sorted(plugin_templates.items()):
+        if name in assigned:
+            continue
+        code = ('required_in_plugins' if name in _db_names
+                else 'nonexistent_in_plugins')
+        errors.append(_error(code, _SITE_MESSAGES[code].format(
+            name, ', '.join(sorted(plugins)), _format_ids(page_ids)),
+            template=name, site=domain, pages=page_ids))
+    return errors
+
+
+def _get_sites_data(site_domains):
+    """
+    Returns (domain, assigned template names, {page template: page ids},
+    {plugin template: (plugins, page ids)}) for each site.
+    """
+    assigned = defaultdict(set)
+    for site_id, name in Template.sites.through.objects.values_list(
+            'site', 'template__name').iterator():
+        assigned[site_id].add(name)
+
+    page_templates = defaultdict(lambda: defaultdict(set))
+    for name, site_id, page_id in get_effective_templates(
+            Page.objects.order_by(), 'site', 'id'):
+        if name:
+            page_templates[site_id][name].add(page_id)
+
+    plugin_templates = defaultdict(
+        lambda: defaultdict(lambda: (set(), set())))
+    for chunk in _chunks(site_domains.keys(), _SITES_CHUNK_SIZE):
+        for site_id, name, plugin, page_id in \
+                _query_plugin_template_references(chunk):
+            plugins, page_ids = plugin_templates[site_id][name]
+            plugins.add(plugin)
+            page_ids.add(page_id)
+
+    return [(domain, assigned[site_id], dict(page_templates[site_id]),
+             dict(plugin_templates[site_id]))
+            for site_id, domain in sorted(site_domains.items(),
+                                          key=lambda item: item[1])]
+
+
+def validate_templates(processes=None, edges_only=None):
+    """
+    Checks that all the templates of the installation are consistent: they
+    compile, have no cycles or missing dependencies, and the templates
+    used by each site are assigned to it. The templates are compiled and
+    the sites are checked by a pool of `processes` worker processes (one
+    per CPU by default) that share a single dependency graph.
+
+    With `edges_only` (DBTEMPLATES_EDGES_ONLY_ANALYSIS by default) this
+    process only keeps the names of the templates and their edges: each
+    worker fetches the contents of its chunk of templates.
+
+    Returns a report with the errors found, described by the same
+    messages as the template and site admin forms, and the peak memory
+    (KB) of this process and of its workers.
+    """
+    global _graph, _db_names
+    started = time.time()
+    if edges_only is None:
+        edges_only = cms_templates_settings.edges_only_analysis
+
+    if edges_only:
+        names = list(Template.objects.values_list('name', flat=True))
+        extracted = _run(_extract_db_edges,
+                         list(_chunks(names, _EDGES_CHUNK_SIZE)), processes)
+    else:
+        contents = dict(Template.objects.values_list('name', 'content'))
+        names = list(contents)
+        extracted = _run(
+            _extract_edges, list(_chunks(contents.items(), _EDGES_CHUNK_SIZE)),
+            processes)
+    graph = TemplateDependencyGraph()
+    for name, edges in chain.from_iterable(extracted):
+        graph.set_edges(name, edges)
+
+    _graph, _db_names = graph, frozenset(names)
+    try:
+        # templates that are not stored in the db are resolved through the
+        #   loaders by this process, so the workers get a complete graph
+        errors = list(chain.from_iterable(
+            _check_template(name) for name in sorted(names)))
+        site_domains = dict(Site.objects.values_list('id', 'domain'))
+        errors.extend(chain.from_iterable(_run(
+            _check_site, _get_sites_data(site_domains), processes)))
+    finally:
+        _graph, _db_names = None, frozenset()
+
+    return {
+        'templates': len(names),
+        'sites': len(site_domains),
+        'errors': errors,
+        'seconds': round(time.time() - started, 2),
+        'peak_memory': {
+            'process': get_peak_memory(),
+            'workers': get_peak_memory(children=True),
+        },
+    }
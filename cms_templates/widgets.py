@@ -0,0 +1,43 @@
+from django.core.urlresolvers import reverse
+from django.forms.utils import flatatt
+from django.forms.widgets import SelectMultiple
+from django.utils.encoding import force_text
+from django.utils.html import format_html, format_html_join
+from django.utils.safestring import mark_safe
+
+from dbtemplates.models import Template
+
+from cms_templates.template_analyzer import _chunks
+
+
+class TemplatePickerWidget(SelectMultiple):
+    """
+    Multiple select for templates that renders only the selected ones.
+    The other templates are searched by name, a page at a time, through
+    the template admin lookup view, so the page never loads all of them.
+    """
+
+    class Media:
+        js = ('cms_templates/js/template_picker.js', )
+
+    def _get_selected(self, value):
+        ids = [force_text(pk) for pk in value or [] if pk]
+        if not ids:
+            return []
+        selected = []
+        for chunk in _chunks(ids):
+            selected.extend(Template.objects.filter(pk__in=chunk).values_list(
+                'id', 'name'))
+        return sorted(selected, key=lambda template: template[1])
+
+    def render(self, name, value, attrs=None, choices=()):
+        final_attrs = self.build_attrs(attrs, name=name)
+        final_attrs['multiple'] = 'multiple'
+        final_attrs['class'] = 'cms-templates-picker'
+        final_attrs['data-lookup-url'] = reverse(
+            'admin:dbtemplates_template_lookup')
+        options = format_html_join(
+            '\n', '<option value="{0}" selected="selected">{1}</option>',
+            self._get_selected(value))
+        return mark_safe(u'%s\n%s\n</select>' % (
+            format_html('<select{0}>', flatatt(final_attrs)), options))